@@ -0,0 +1,123 @@
+import io
+import logging
+import subprocess
+import importlib.util
+from lazy import lazy_import
+from metrics import span
+
+# numpy и PyAV загружаются при первом декодировании, а не при старте бота
+np = lazy_import("numpy")
+# Без PyAV используется ffmpeg через pipe (без временных файлов)
+av = lazy_import("av") if importlib.util.find_spec("av") else None
+
+logger = logging.getLogger('audio_codec')
+
+# Telegram ожидает голосовые сообщения в OGG/Opus, Opus работает на 48 кГц
+OPUS_SAMPLE_RATE = 48000
+OPUS_BITRATE = 32000
+
+class AudioCodecError(Exception):
+    """Ошибка декодирования или кодирования аудио."""
+
+async def download_voice(voice_file) -> bytes:
+    """Скачивает голосовое сообщение в память, минуя диск."""
+    with span("download"):
+        return bytes(await voice_file.download_as_bytearray())
+
+def _decode_av(data, sr):
+    with av.open(io.BytesIO(data)) as container:
+        stream = container.streams.audio[0]
+        source = (stream.codec_context.sample_rate, stream.codec_context.channels)
+        rate = sr or source[0]
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=rate)
+        chunks = []
+        for frame in container.decode(stream):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32), rate, source
+    return np.concatenate(chunks), rate, source
+
+def _encode_av(y, sr, bitrate):
+    buffer = io.BytesIO()
+    with av.open(buffer, "w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=OPUS_SAMPLE_RATE, layout="mono")
+        stream.bit_rate = bitrate
+        resampler = av.AudioResampler(
+            format="flt", layout="mono", rate=OPUS_SAMPLE_RATE,
+            frame_size=stream.codec_context.frame_size or None,
+        )
+        frame = av.AudioFrame.from_ndarray(y.reshape(1, -1), format="flt", layout="mono")
+        frame.sample_rate = sr
+        for resampled in resampler.resample(frame) + resampler.resample(None):
+            for packet in stream.encode(resampled):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+def _run_ffmpeg(args, data):
+    """Запускает ffmpeg, передавая данные через stdin/stdout."""
+    process = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", *args],
+        input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    if process.returncode != 0:
+        raise AudioCodecError(process.stderr.decode("utf-8", "replace").strip())
+    return process.stdout
+
+def _decode_ffmpeg(data, sr):
+    rate = sr or OPUS_SAMPLE_RATE
+    raw = _run_ffmpeg(["-i", "pipe:0", "-f", "f32le", "-ac", "1", "-ar", str(rate), "pipe:1"], data)
+    # Параметры исходной записи ffmpeg здесь не сообщает: считаем ее обычным голосовым сообщением Telegram
+    return np.frombuffer(raw, dtype=np.float32).copy(), rate, (OPUS_SAMPLE_RATE, 1)
+
+def _encode_ffmpeg(y, sr, bitrate):
+    return _run_ffmpeg([
+        "-f", "f32le", "-ar", str(sr), "-ac", "1", "-i", "pipe:0",
+        "-c:a", "libopus", "-b:a", str(bitrate), "-ar", str(OPUS_SAMPLE_RATE), "-f", "ogg", "pipe:1",
+    ], y.tobytes())
+
+def decode_with_source(data, sr=None):
+    """Декодирует OGG/MP3/WAV из памяти в моно float32.
+
+    sr - нужная частота дискретизации (None - исходная файла).
+    Возвращает (массив, частота дискретизации, исходная частота, исходное число каналов).
+    """
+    try:
+        if av is not None:
+            y, rate, source = _decode_av(data, sr)
+        else:
+            y, rate, source = _decode_ffmpeg(data, sr)
+    except AudioCodecError:
+        raise
+    except Exception as e:
+        raise AudioCodecError(f"Не удалось декодировать аудио: {e}") from e
+    return y, rate, *source
+
+def decode(data, sr=None):
+    """Декодирует OGG/MP3/WAV из памяти в моно float32.
+
+    sr - нужная частота дискретизации (None - исходная файла).
+    Возвращает (массив, частота дискретизации).
+    """
+    y, rate, _, _ = decode_with_source(data, sr)
+    return y, rate
+
+def encode_opus(y, sr, bitrate=OPUS_BITRATE):
+    """Кодирует моно сигнал в OGG/Opus, готовый для отправки голосовым сообщением."""
+    y = np.ascontiguousarray(y, dtype=np.float32).reshape(-1)
+    try:
+        if av is not None:
+            return _encode_av(y, sr, bitrate)
+        return _encode_ffmpeg(y, sr, bitrate)
+    except AudioCodecError:
+        raise
+    except Exception as e:
+        raise AudioCodecError(f"Не удалось закодировать аудио: {e}") from e
+
+def to_pcm16(y):
+    """Преобразует float32 сигнал в 16-битный PCM (bytes)."""
+    return (np.clip(y, -1.0, 1.0) * 32767).astype("<i2").tobytes()
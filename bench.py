@@ -0,0 +1,498 @@
+"""Сквозной бенчмарк конвейеров ботов на локальных заглушках внешних сервисов.
+
+Telegram (fake_telegram), YandexGPT (fake_yandex_gpt), распознавание и синтез
+речи (fake_speech) работают локально с настраиваемой задержкой. Синтетические
+голосовые и текстовые сообщения подаются на webhook бота с заданной частотой
+(открытая нагрузка: следующее сообщение не ждет ответа на предыдущее).
+
+Результат - JSON: p50/p95/p99 сквозной задержки по типам сообщений и по стадиям
+(codec, stt, llm, tts, dsp, telegram), пропускная способность, пиковый RSS.
+
+Запуск:
+    python bench.py [конвейер ...] [--rate 5] [--messages 60] [--chats 10] [--output bench.json]
+
+Конвейеры - имена из service.PIPELINES или модули ботов (main, psycho_1, ...).
+Каждый конвейер измеряется в отдельном процессе, чтобы пиковый RSS и
+загруженные модули одного конвейера не влияли на другой.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import platform
+import tempfile
+import subprocess
+import contextvars
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from fake_telegram import FakeTelegram
+from fake_yandex_gpt import FakeYandexGPT
+
+# Какие сообщения отправляет каждый конвейер: подготовка чата (не измеряется)
+# и сообщения, которые чередуются при замере
+SCENARIOS = {
+    "stt": {"setup": [], "messages": ["voice"]},
+    "psycho": {"setup": ["/start"], "messages": ["text"]},
+    "psycho_voice": {"setup": ["/start"], "messages": ["voice", "text"]},
+    "voice_clone": {"setup": ["/start", "voice"], "messages": ["text"]},
+    "voice_effects": {"setup": [], "messages": ["voice"]},
+}
+
+TEXTS = [
+    "Мне тревожно перед экзаменом, не могу уснуть.",
+    "Поссорился с другом и не знаю, как помириться.",
+    "На работе постоянно устаю, ничего не радует.",
+    "Как перестать переживать из-за мелочей?",
+    "Чувствую себя одиноким в новом городе.",
+]
+
+PERCENTILES = (50, 95, 99)
+
+# Обновления, которые сейчас обрабатываются (задача планировщика наследует контекст
+# обработчика): по ним ошибка в логе относится к конкретным сообщениям
+current_updates = contextvars.ContextVar("current_updates", default=())
+
+def percentile(values, q):
+    """Перцентиль с линейной интерполяцией (как numpy.percentile)."""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+def summarize(values):
+    """Сводка задержек в миллисекундах."""
+    if not values:
+        return {"count": 0}
+    summary = {"count": len(values)}
+    for q in PERCENTILES:
+        summary[f"p{q}"] = round(percentile(values, q) * 1000, 1)
+    summary["mean"] = round(sum(values) / len(values) * 1000, 1)
+    summary["max"] = round(max(values) * 1000, 1)
+    return summary
+
+def _rss_mb(pid="self"):
+    """Текущий RSS процесса по /proc (0, если процесс уже завершился)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+class MemorySampler:
+    """Пиковый RSS процесса бота и суммарный - вместе с процессами пула обработки сигнала."""
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_total = 0.0
+
+    def sample(self):
+        total = _rss_mb() + sum(_rss_mb(child.pid) for child in multiprocessing.active_children())
+        self.peak_total = max(self.peak_total, total)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def snapshot(self):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return {
+            "peak_rss_mb": round(peak, 1),
+            # Выборки могут пропустить кратковременный пик самого процесса бота
+            "peak_rss_total_mb": round(max(self.peak_total, peak), 1),
+        }
+
+class StageTimings:
+    """Время стадий обработки: вызовы пула исполнителей, YandexGPT и Bot API."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def add(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def reset(self):
+        self.samples.clear()
+
+    def _timed(self, stage, func):
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage(args) if callable(stage) else stage, time.perf_counter() - started)
+        return timed
+
+    def _timed_stream(self, stage, func):
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            first = None
+            try:
+                async for item in func(*args, **kwargs):
+                    if first is None:
+                        first = time.perf_counter() - started
+                        self.add(f"{stage}_first", first)
+                    yield item
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return timed
+
+    def instrument(self, application):
+        """Подключается к общим объектам процесса (экземплярам, а не классам)."""
+        from workers import get_pool
+        from yandex_gpt import get_gpt_client
+        pool = get_pool()
+        pool.run_io = self._timed(lambda args: args[0], pool.run_io)
+        pool.run_cpu = self._timed(lambda args: args[0], pool.run_cpu)
+        client = get_gpt_client()
+        client.complete = self._timed("llm", client.complete)
+        client.stream_complete = self._timed_stream("llm", client.stream_complete)
+        request = application.bot.request
+        request.do_request = self._timed("telegram", request.do_request)
+
+    def snapshot(self):
+        return {stage: summarize(values) for stage, values in sorted(self.samples.items())}
+
+class ErrorLog(logging.Handler):
+    """Ошибки, которые боты обработали сами (ответили пользователю) и записали в лог."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+        # update_id обновлений, при обработке которых записана ошибка
+        self.updates = set()
+
+    def emit(self, record):
+        self.messages.append(f"{record.name}: {record.getMessage()}"[:300])
+        self.updates.update(current_updates.get())
+
+class BenchGPT(FakeYandexGPT):
+    """Заглушка YandexGPT с разными ответами: иначе кэши скрыли бы нагрузку на синтез."""
+
+    def make_reply(self, payload):
+        return f"{self.reply} Это ответ номер {len(self.requests)}. Я вас слушаю."
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def voice_corpus(seconds_list):
+    """Синтетические голосовые сообщения OGG/Opus разной длины."""
+    from bench_pitch import synthetic_voice
+    from audio_codec import encode_opus
+    corpus = []
+    for i, seconds in enumerate(seconds_list):
+        y, sr, _ = synthetic_voice(110 + 40 * i, seconds=seconds, seed=i)
+        corpus.append(encode_opus(y, sr))
+    return corpus
+
+async def run_pipeline(pipeline, args):
+    """Замер одного конвейера в текущем процессе, возвращает словарь с результатами."""
+    import service
+    import fake_speech
+    from webhook import serve_webhook, WEBHOOK_SECRET
+    from scheduler import get_scheduler
+    from telegram import Update
+
+    fake_speech.install(
+        fake_speech.FakeSpeechRecognition(latency=args.stt_latency),
+        fake_speech.FakeGTTS(latency=args.tts_latency),
+    )
+    application = service.build_application(service.Router([pipeline]), token="123456:bench")
+    errors = []
+    # update_id обновлений, обработчик которых упал или записал ошибку
+    failed = set()
+
+    async def on_error(update, context):
+        errors.append(repr(context.error))
+        if isinstance(update, Update):
+            failed.add(update.update_id)
+
+    application.add_error_handler(on_error)
+    logged = ErrorLog()
+    logging.getLogger().addHandler(logged)
+    timings = StageTimings()
+    timings.instrument(application)
+
+    # Время завершения обработки каждого обновления
+    done = {}
+    processor = application.update_processor
+    process_update = processor.do_process_update
+    # (чат, сообщение) -> update_id для всех отправленных обновлений
+    update_ids = {}
+    # Обработчик может поставить задачу в планировщик и вернуться сразу:
+    # тогда обработка завершается вместе с задачей
+    scheduled = set()
+
+    async def timed_process_update(update, coroutine):
+        current_updates.set((update.update_id,))
+        try:
+            await process_update(update, coroutine)
+        finally:
+            message = update.effective_message
+            if message is None or (message.chat_id, message.message_id) not in scheduled:
+                done[update.update_id] = time.perf_counter()
+
+    processor.do_process_update = timed_process_update
+    scheduler = get_scheduler()
+    submit = scheduler.submit
+
+    def tracked_submit(user_id, chat_id, key, item, runner):
+        async def tracked(items):
+            batch = [update_ids.get((message.chat_id, message.message_id)) for message in items]
+            current_updates.set(tuple(update_id for update_id in batch if update_id is not None))
+            try:
+                await runner(items)
+            finally:
+                for update_id in batch:
+                    if update_id is not None:
+                        done[update_id] = time.perf_counter()
+
+        submit(user_id, chat_id, key, item, tracked)
+        scheduled.add((item.chat_id, item.message_id))
+
+    scheduler.submit = tracked_submit
+
+    loop = asyncio.get_running_loop()
+    telegram = args.telegram
+    memory = MemorySampler()
+    sampler = asyncio.ensure_future(memory.run())
+    stop = asyncio.Event()
+    port = _free_port()
+    server = asyncio.ensure_future(serve_webhook(
+        application, url=f"http://127.0.0.1:{port}/bench", listen="127.0.0.1", port=port,
+        secret_token=WEBHOOK_SECRET, stop_event=stop,
+    ))
+    while telegram.webhook is None:
+        if server.done():
+            server.result()
+        await asyncio.sleep(0.05)
+
+    voices = await loop.run_in_executor(None, voice_corpus, args.voice_seconds)
+    for i, data in enumerate(voices):
+        telegram.add_file(f"bench_voice_{i}", data)
+
+    senders = ThreadPoolExecutor(max_workers=64, thread_name_prefix="bench-sender")
+    rejected = 0
+
+    def make_update(chat_id, kind, number):
+        if kind == "voice":
+            update = telegram.make_update(chat_id, voice_file_id=f"bench_voice_{number % len(voices)}")
+        elif kind == "text":
+            update = telegram.make_update(chat_id, text=f"{TEXTS[number % len(TEXTS)]} ({number})")
+        else:
+            update = telegram.make_update(chat_id, text=kind)
+        update_ids[(chat_id, update["message"]["message_id"])] = update["update_id"]
+        return update
+
+    async def send(update):
+        nonlocal rejected
+        while True:
+            status = await loop.run_in_executor(senders, telegram.post_update, update)
+            if status != 429:
+                return status
+            # Как Telegram: обновление доставляется повторно позже
+            rejected += 1
+            await asyncio.sleep(1)
+
+    async def wait_done(update_ids, timeout):
+        deadline = time.perf_counter() + timeout
+        while not all(update_id in done for update_id in update_ids) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.02)
+
+    scenario = SCENARIOS[pipeline]
+    chats = [100000 + i for i in range(args.chats)]
+
+    # Подготовка чатов и прогрев (не измеряется)
+    async def prepare(chat_id):
+        for kind in scenario["setup"]:
+            update = make_update(chat_id, kind, chat_id)
+            await send(update)
+            await wait_done([update["update_id"]], args.timeout)
+
+    await asyncio.gather(*(prepare(chat_id) for chat_id in chats))
+    warmup = [make_update(chats[i % len(chats)], kind, i)
+              for i in range(args.warmup) for kind in scenario["messages"]]
+    await asyncio.gather(*(send(update) for update in warmup))
+    await wait_done([update["update_id"] for update in warmup], args.timeout)
+    timings.reset()
+    # Ошибки подготовки (например, не загрузился пул обработки сигнала) искажают замер
+    setup_errors = sorted(set(errors + logged.messages))
+    errors.clear()
+    failed.clear()
+    logged.messages.clear()
+    logged.updates.clear()
+
+    # Замер: сообщения по расписанию с частотой rate, по кругу по чатам
+    sent = {}
+    kinds = {}
+    sends = []
+    started = time.perf_counter()
+    for i in range(args.messages):
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        kind = scenario["messages"][i % len(scenario["messages"])]
+        update = make_update(chats[i % len(chats)], kind, i)
+        sent[update["update_id"]] = time.perf_counter()
+        kinds[update["update_id"]] = kind
+        sends.append(asyncio.ensure_future(send(update)))
+    await asyncio.gather(*sends)
+    await wait_done(list(sent), args.timeout)
+
+    # Обработка завершилась, но с ошибкой (бот ответил сообщением об ошибке) - не выполнено
+    failed = {update_id for update_id in failed | logged.updates if update_id in sent}
+    latencies = defaultdict(list)
+    for update_id, sent_at in sent.items():
+        if update_id in done and update_id not in failed:
+            latencies[kinds[update_id]].append(done[update_id] - sent_at)
+            latencies["all"].append(done[update_id] - sent_at)
+    completed = len(latencies["all"])
+    finished = max((done[update_id] for update_id in sent if update_id in done), default=started)
+    intake = processor.intake.snapshot()
+
+    stop.set()
+    await server
+    sampler.cancel()
+    memory.sample()
+    senders.shutdown(wait=False)
+
+    return {
+        "pipeline": pipeline,
+        "module": service.PIPELINES[pipeline],
+        "messages": args.messages,
+        "completed": completed,
+        "failed": len(failed),
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "setup_errors": setup_errors[:5],
+        "logged_errors": len(logged.messages),
+        "logged_error_samples": sorted(set(logged.messages))[:5],
+        "rejected_429": rejected,
+        "duration_s": round(finished - started, 3),
+        "throughput_msg_s": round(completed / (finished - started), 3) if finished > started else 0.0,
+        "latency_ms": {kind: summarize(values) for kind, values in sorted(latencies.items())},
+        "stages_ms": timings.snapshot(),
+        "intake": intake,
+        **memory.snapshot(),
+    }
+
+def run_child(pipeline, args):
+    """Процесс замера одного конвейера: поднимает заглушки и печатает JSON."""
+    # Данные ботов (кэш синтеза, профили, калибровка gTTS по заглушке) - только на время замера
+    with tempfile.TemporaryDirectory(prefix="bench_") as scratch, \
+            FakeTelegram(latency=args.telegram_latency) as telegram, \
+            BenchGPT(latency=args.gpt_latency, stream_delay=args.gpt_stream_delay) as gpt:
+        # Настройки читаются модулями ботов при импорте, поэтому задаются до него
+        os.environ.update({
+            "TG_API_URL": telegram.base_url,
+            "WEBHOOK_URL": "http://127.0.0.1/bench",
+            "YAGPT_URL": gpt.url,
+            "YAGPT_TOKEN": "bench",
+            "FOLDER_ID": "bench",
+            "STT_BACKEND": "google",
+            "TTS_CACHE_DIR": os.path.join(scratch, "tts_cache"),
+            "VOICE_PROFILES_PATH": os.path.join(scratch, "voice_profiles.dat"),
+            "TTS_BASELINE_PATH": os.path.join(scratch, "tts_baseline.json"),
+        })
+        # Заданная высота gTTS пропустила бы калибровку, которую тоже нужно замерить
+        os.environ.pop("TTS_BASELINE_F0", None)
+        # Замеряются конвейеры, а не ограничение частоты сообщений пользователей
+        os.environ.setdefault("SCHED_USER_RATE", "100000")
+        os.environ.setdefault("SCHED_USER_BURST", "100000")
+        args.telegram = telegram
+        import service  # noqa: F401 - настраивает логирование
+        logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+        result = asyncio.run(run_pipeline(pipeline, args))
+    print(json.dumps(result, ensure_ascii=False))
+
+def _config(args):
+    return {
+        name: getattr(args, name) for name in (
+            "rate", "messages", "chats", "warmup", "voice_seconds", "telegram_latency",
+            "gpt_latency", "gpt_stream_delay", "stt_latency", "tts_latency",
+        )
+    }
+
+def _child_args(args):
+    flags = []
+    for name, value in _config(args).items():
+        flag = "--" + name.replace("_", "-")
+        flags += [flag, ",".join(map(str, value)) if isinstance(value, list) else str(value)]
+    return flags + ["--timeout", str(args.timeout)] + (["--verbose"] if args.verbose else [])
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейеров ботов на локальных заглушках")
+    parser.add_argument("pipelines", nargs="*", help="конвейеры (по умолчанию все)")
+    parser.add_argument("--rate", type=float, default=5.0, help="сообщений в секунду")
+    parser.add_argument("--messages", type=int, default=60, help="сколько сообщений замерить")
+    parser.add_argument("--chats", type=int, default=10, help="сколько чатов отправляют сообщения")
+    parser.add_argument("--warmup", type=int, default=2, help="сообщений прогрева каждого типа")
+    parser.add_argument("--voice-seconds", type=lambda value: [float(v) for v in value.split(",")],
+                        default=[3.0, 8.0, 20.0], help="длительности голосовых сообщений")
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--gpt-latency", type=float, default=0.5)
+    parser.add_argument("--gpt-stream-delay", type=float, default=0.03)
+    parser.add_argument("--stt-latency", type=float, default=0.3)
+    parser.add_argument("--tts-latency", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=120.0, help="сколько ждать обработки (секунды)")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument("--verbose", action="store_true", help="логи ботов в stderr")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+def _pipeline_name(name):
+    """Имя конвейера по имени конвейера или модуля бота."""
+    from service import PIPELINES
+    if name in PIPELINES:
+        return name
+    for pipeline, module in PIPELINES.items():
+        if module == name:
+            return pipeline
+    raise SystemExit(f"Неизвестный конвейер: {name}")
+
+def main(argv):
+    args = parse_args(argv)
+    if args.child:
+        run_child(args.child, args)
+        return
+    pipelines = [_pipeline_name(name) for name in args.pipelines] or list(SCENARIOS)
+    results = []
+    for pipeline in pipelines:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", pipeline, *_child_args(args)],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        lines = process.stdout.strip().splitlines()
+        if process.returncode != 0 or not lines:
+            results.append({"pipeline": pipeline, "failed": True, "stderr": process.stderr.strip()[-2000:]})
+        else:
+            results.append(json.loads(lines[-1]))
+        print(f"{pipeline}: {'failed' if results[-1].get('failed') else 'done'}", file=sys.stderr)
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": _config(args),
+        "results": results,
+    }
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
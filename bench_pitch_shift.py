@@ -0,0 +1,153 @@
+"""Сравнение сдвига высоты тона: librosa.effects.pitch_shift с разной передискретизацией
+(res_type, PITCH_SHIFT_RES_TYPE в speech_to_speech_librosa) и rubberband (pyrubberband) -
+по времени и качеству.
+
+Запуск: python bench_pitch_shift.py [--repeat 5] [файлы.wav ...]
+Без аргументов используются синтетические гласные (гармоники с формантами
+/а/, вибрато, шум) с частотой gTTS (24 кГц), для которых известен точный
+результат сдвига. Для каждого движка и сдвига выводятся:
+    ms            - медиана времени сдвига
+    pitch_cents   - ошибка высоты результата (оценка yin) относительно ожидаемой
+    lsd_shift_db  - спектральное расстояние до эталона, где форманты сдвинуты вместе
+                    с высотой (так работают оба движка)
+    lsd_formant_db - то же до эталона с формантами на месте
+rubberband пропускается, если нет pyrubberband или утилиты rubberband.
+"""
+import sys
+import time
+import json
+import shutil
+import argparse
+import statistics
+import numpy as np
+from pitch import estimate_mean_f0
+
+SAMPLE_RATE = 24000
+# Варианты передискретизации librosa (polyphase требует целых частот и не подходит)
+RES_TYPES = ("soxr_hq", "soxr_mq", "soxr_lq", "fft")
+# Форманты гласной /а/: (частота, ширина полосы)
+FORMANTS = ((700, 110), (1220, 120), (2600, 160))
+
+def formant_envelope(frequencies):
+    """Амплитуда огибающей гласной на заданных частотах."""
+    envelope = np.zeros_like(frequencies, dtype=np.float64)
+    for center, bandwidth in FORMANTS:
+        envelope += 1 / (1 + ((frequencies - center) / bandwidth) ** 2)
+    return envelope + 0.01
+
+def synthetic_vowel(f0, shift=0.0, keep_formants=True, sr=SAMPLE_RATE, seconds=4.0, seed=0):
+    """Гласная с основной частотой f0 * 2^(shift/12); форманты на месте или сдвинуты с высотой."""
+    ratio = 2 ** (shift / 12)
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(sr * seconds)) / sr
+    frequency = f0 * ratio * (1 + 0.015 * np.sin(2 * np.pi * 5 * t))
+    phase = 2 * np.pi * np.cumsum(frequency) / sr
+    y = np.zeros_like(t)
+    for k in range(1, int(sr / 2 / (f0 * ratio))):
+        # Без сохранения формант амплитуда гармоники та же, что у исходного голоса
+        amplitude = formant_envelope(np.array([k * f0 * (ratio if keep_formants else 1.0)]))[0]
+        y += amplitude * np.sin(k * phase)
+    y = 0.3 * y / np.max(np.abs(y))
+    return (y + 0.001 * rng.standard_normal(len(t))).astype(np.float32)
+
+def mean_spectrum_db(y, n_fft=2048, hop=512):
+    frames = np.lib.stride_tricks.sliding_window_view(y, n_fft)[::hop] * np.hanning(n_fft)
+    spectrum = np.mean(np.abs(np.fft.rfft(frames, axis=1)), axis=0)
+    db = 20 * np.log10(spectrum + 1e-9)
+    return db - db.max()
+
+def spectral_distance(y, reference, sr=SAMPLE_RATE, fmin=80, fmax=5000):
+    """Среднеквадратичное расстояние средних спектров (дБ) в полосе речи."""
+    a, b = mean_spectrum_db(y), mean_spectrum_db(reference)
+    frequencies = np.fft.rfftfreq(2048, 1 / sr)
+    band = (frequencies >= fmin) & (frequencies <= fmax)
+    return float(np.sqrt(np.mean((a[band] - b[band]) ** 2)))
+
+def engines():
+    """Доступные движки: имя -> функция (y, sr, полутоны)."""
+    import librosa
+    result = {
+        f"librosa:{res_type}": (lambda y, sr, n, res_type=res_type:
+                                librosa.effects.pitch_shift(y, sr=sr, n_steps=n, res_type=res_type))
+        for res_type in RES_TYPES
+    }
+    try:
+        import pyrubberband
+        if shutil.which("rubberband"):
+            result["rubberband"] = pyrubberband.pitch_shift
+    except ImportError:
+        pass
+    return result
+
+def timed(func, repeat):
+    func()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = func()
+        times.append(time.perf_counter() - started)
+    return output, statistics.median(times)
+
+def run_case(name, y, sr, shift, engines, repeat, references=None, f0=None):
+    expected = (f0 or estimate_mean_f0(y, sr)) * 2 ** (shift / 12)
+    result = {"name": name, "shift": shift, "seconds": round(len(y) / sr, 2)}
+    for engine, func in engines.items():
+        output, elapsed = timed(lambda: func(y, sr, shift), repeat)
+        output = np.asarray(output, dtype=np.float32)
+        measured = estimate_mean_f0(output, sr)
+        row = {
+            "ms": round(elapsed * 1000, 1),
+            "pitch_cents": round(1200 * np.log2(measured / expected), 1) if measured else None,
+            "length_ok": len(output) == len(y),
+        }
+        if references is not None:
+            row["lsd_shift_db"] = round(spectral_distance(output, references[0], sr), 2)
+            row["lsd_formant_db"] = round(spectral_distance(output, references[1], sr), 2)
+        result[engine] = row
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="записи голоса (WAV и другие форматы librosa)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--shifts", default="-5,-2,2,5", help="сдвиги в полутонах через запятую")
+    args = parser.parse_args()
+    shifts = [float(value) for value in args.shifts.split(",")]
+    available = engines()
+    if "rubberband" not in available:
+        print("rubberband недоступен (нет pyrubberband или утилиты rubberband), сравнение без него",
+              file=sys.stderr)
+
+    results = []
+    if args.files:
+        import librosa
+        for path in args.files:
+            y, sr = librosa.load(path, sr=None)
+            for shift in shifts:
+                results.append(run_case(path, y, sr, shift, available, args.repeat))
+    else:
+        for f0 in (110, 220):
+            y = synthetic_vowel(f0, seed=f0)
+            for shift in shifts:
+                references = (
+                    synthetic_vowel(f0, shift, keep_formants=False, seed=f0),
+                    synthetic_vowel(f0, shift, keep_formants=True, seed=f0),
+                )
+                results.append(run_case(f"vowel_{f0}Hz", y, SAMPLE_RATE, shift, available,
+                                        args.repeat, references, f0))
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+
+    # Итог по движкам: медианы по всем случаям
+    summary = {}
+    for engine in available:
+        rows = [result[engine] for result in results]
+        summary[engine] = {
+            key: round(statistics.median(abs(row[key]) for row in rows if row.get(key) is not None), 2)
+            for key in ("ms", "pitch_cents", "lsd_shift_db", "lsd_formant_db")
+            if any(row.get(key) is not None for row in rows)
+        }
+    print(json.dumps({"summary": summary}, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
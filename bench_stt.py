@@ -0,0 +1,98 @@
+"""Сравнение запроса в распознавание речи до и после подготовки записи (stt_preprocess).
+
+«До» - запись целиком с исходной частотой (так голосовое сообщение раньше
+экспортировалось в WAV), «после» - моно 16 кГц без тишины по краям, с
+нормализованным уровнем. Для каждого сообщения выводятся байты PCM и FLAC
+(speech_recognition отправляет FLAC), время кодирования FLAC и время распознавания.
+
+Запуск: python bench_stt.py [--backend fake|google] [файлы.ogg ...]
+Без файлов используются синтетические голосовые сообщения (Opus 48 кГц)
+с паузами до и после речи. fake - заглушка распознавания (fake_speech),
+время которой растет с длительностью записи; google требует доступ в сеть.
+"""
+import time
+import json
+import argparse
+import numpy as np
+import speech_recognition
+from audio_codec import OPUS_SAMPLE_RATE, decode, decode_with_source, encode_opus, to_pcm16
+from stt import STT_SAMPLE_RATE, PCM_SAMPLE_WIDTH, GoogleSTT
+import stt_preprocess
+import fake_speech
+
+def synthetic_message(seconds=6.0, lead=1.5, tail=2.0, level=0.03, seed=0):
+    """Голосовое сообщение: тихая «речь» (гармоники со слогами) между паузами, в Opus."""
+    rng = np.random.default_rng(seed)
+    sr = OPUS_SAMPLE_RATE
+    t = np.arange(int(sr * seconds)) / sr
+    f0 = 140 * (1 + 0.05 * np.sin(2 * np.pi * 0.7 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    voice = sum(np.sin(k * phase) / k for k in range(1, 10))
+    syllables = (np.sin(2 * np.pi * 3 * t) > -0.2).astype(float)
+    speech = level * voice * syllables
+    silence = lambda duration: np.zeros(int(sr * duration))
+    y = np.concatenate([silence(lead), speech, silence(tail)])
+    y += 0.0005 * rng.standard_normal(len(y))
+    return encode_opus(y.astype(np.float32), sr)
+
+def payload_before(data):
+    """Что уходило в распознавание раньше: вся запись с исходной частотой."""
+    y, sr = decode(data)
+    return y, sr
+
+def payload_after(data):
+    """Что уходит теперь: моно 16 кГц, обрезанная и нормализованная запись."""
+    y, sr, source_rate, source_channels = decode_with_source(data, STT_SAMPLE_RATE)
+    return stt_preprocess.prepare(y, sr, source_rate, source_channels), sr
+
+def measure(data, prepare, backend):
+    started = time.perf_counter()
+    y, sr = prepare(data)
+    prepare_time = time.perf_counter() - started
+    pcm = to_pcm16(y)
+    started = time.perf_counter()
+    flac = speech_recognition.AudioData(pcm, sr, PCM_SAMPLE_WIDTH).get_flac_data()
+    flac_time = time.perf_counter() - started
+    started = time.perf_counter()
+    try:
+        text = backend.recognize(y, sr)
+    except Exception as e:
+        text = f"<{type(e).__name__}>"
+    recognize_time = time.perf_counter() - started
+    return {
+        "seconds": round(len(y) / sr, 2), "sample_rate": sr,
+        "pcm_bytes": len(pcm), "flac_bytes": len(flac),
+        "prepare_ms": round(prepare_time * 1000, 1), "flac_ms": round(flac_time * 1000, 1),
+        "recognize_ms": round(recognize_time * 1000, 1), "text": text,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="голосовые сообщения (OGG/MP3/WAV)")
+    parser.add_argument("--backend", choices=("fake", "google"), default="fake")
+    args = parser.parse_args()
+
+    if args.backend == "fake":
+        fake_speech.install()
+    backend = GoogleSTT()
+
+    if args.files:
+        messages = [(path, open(path, "rb").read()) for path in args.files]
+    else:
+        messages = [
+            (f"synthetic_{seconds:g}s", synthetic_message(seconds, seed=i))
+            for i, seconds in enumerate((3, 6, 12, 20))
+        ]
+    totals = {"before": {}, "after": {}}
+    for name, data in messages:
+        result = {"name": name}
+        for label, prepare in (("before", payload_before), ("after", payload_after)):
+            result[label] = measure(data, prepare, backend)
+            for key in ("pcm_bytes", "flac_bytes", "flac_ms", "recognize_ms"):
+                totals[label][key] = round(totals[label].get(key, 0) + result[label][key], 1)
+        print(json.dumps(result, ensure_ascii=False))
+    ratio = {key: round(totals["before"][key] / max(totals["after"][key], 1e-9), 1) for key in totals["before"]}
+    print(json.dumps({"total": totals, "before_to_after": ratio}, ensure_ascii=False))
+
+if __name__ == "__main__":
+    main()
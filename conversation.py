@@ -0,0 +1,181 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from yandex_gpt import get_gpt_client
+
+logger = logging.getLogger('conversation')
+
+# Бюджет промпта в токенах: системный промпт + сводка + история + новое сообщение
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "1500"))
+# Сколько последних реплик хранится дословно (кольцевой буфер на чат)
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", "20"))
+# Размер сводки ранней части разговора
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "200"))
+# Память чата удаляется после такого простоя (секунды)
+MEMORY_IDLE_TTL = float(os.getenv("MEMORY_IDLE_TTL", str(6 * 3600)))
+# Сколько чатов помнить одновременно (самые давно активные вытесняются)
+MEMORY_MAX_CHATS = int(os.getenv("MEMORY_MAX_CHATS", "10000"))
+# Оценка длины токена в символах (для русского текста у YandexGPT около 3)
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "3"))
+
+SUMMARY_PROMPT = (
+    "Кратко, в 2-3 предложениях, перескажи, что собеседник рассказал о себе, "
+    "своих чувствах и проблемах. Пиши от третьего лица, без оценок."
+)
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов без обращения к API."""
+    return int(len(text) / CHARS_PER_TOKEN) + 1 if text else 0
+
+def _extractive_summary(summary, turns, max_tokens):
+    """Сводка без LLM: последние высказывания пользователя, обрезанные по бюджету."""
+    parts = [summary] if summary else []
+    parts += [text for role, text, _ in turns if role == "user"]
+    return " ".join(parts)[-int(max_tokens * CHARS_PER_TOKEN):].lstrip()
+
+class Dialogue:
+    """Память одного чата: последние реплики, сводка более ранних и реплики,
+    ожидающие включения в сводку.
+    """
+
+    __slots__ = ("turns", "tokens", "summary", "pending", "last_used", "summary_task")
+
+    def __init__(self, max_turns):
+        # (роль, текст, токены)
+        self.turns = deque(maxlen=max_turns)
+        self.tokens = 0
+        self.summary = ""
+        self.pending = []
+        self.last_used = time.monotonic()
+        self.summary_task = None
+
+    def append(self, role, text):
+        if len(self.turns) == self.turns.maxlen:
+            self.evict_oldest()
+        tokens = estimate_tokens(text)
+        self.turns.append((role, text, tokens))
+        self.tokens += tokens
+
+    def evict_oldest(self):
+        """Вытесняет самый старый обмен репликами (история всегда начинается с пользователя)."""
+        while True:
+            turn = self.turns.popleft()
+            self.tokens -= turn[2]
+            self.pending.append(turn)
+            if not self.turns or self.turns[0][0] == "user":
+                break
+
+class ConversationMemory:
+    """Ограниченная память диалогов для психологических ботов.
+
+    Промпт не превышает token_budget: старые реплики вытесняются из кольцевого
+    буфера и сворачиваются в сводку (через summarizer, иначе - без LLM).
+    """
+
+    def __init__(self, token_budget=MEMORY_TOKEN_BUDGET, max_turns=MEMORY_MAX_TURNS,
+                 summary_tokens=MEMORY_SUMMARY_TOKENS, idle_ttl=MEMORY_IDLE_TTL,
+                 max_chats=MEMORY_MAX_CHATS, summarizer=None):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.summary_tokens = summary_tokens
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        # summarizer(summary, turns) -> str, корутина
+        self.summarizer = summarizer
+        self._dialogues = OrderedDict()
+        self.stats = {"summaries": 0, "summary_errors": 0, "evicted_chats": 0}
+
+    def _dialogue(self, chat_id):
+        self.evict_idle()
+        dialogue = self._dialogues.get(chat_id)
+        if dialogue is None:
+            dialogue = self._dialogues[chat_id] = Dialogue(self.max_turns)
+            while len(self._dialogues) > self.max_chats:
+                self._dialogues.popitem(last=False)
+                self.stats["evicted_chats"] += 1
+        self._dialogues.move_to_end(chat_id)
+        dialogue.last_used = time.monotonic()
+        return dialogue
+
+    def evict_idle(self):
+        """Удаляет память чатов, простаивающих дольше idle_ttl."""
+        deadline = time.monotonic() - self.idle_ttl
+        while self._dialogues:
+            chat_id, dialogue = next(iter(self._dialogues.items()))
+            if dialogue.last_used > deadline:
+                break
+            del self._dialogues[chat_id]
+            self.stats["evicted_chats"] += 1
+
+    def build_messages(self, chat_id, system_prompt, user_text):
+        """Собирает сообщения для YandexGPT в пределах бюджета токенов."""
+        dialogue = self._dialogue(chat_id)
+        system = system_prompt
+        if dialogue.summary:
+            system = f"{system_prompt}\nКратко о предыдущей части разговора: {dialogue.summary}"
+        fixed = estimate_tokens(system) + estimate_tokens(user_text)
+        while dialogue.turns and fixed + dialogue.tokens > self.token_budget:
+            dialogue.evict_oldest()
+        return (
+            [{"role": "system", "text": system}]
+            + [{"role": role, "text": text} for role, text, _ in dialogue.turns]
+            + [{"role": "user", "text": user_text}]
+        )
+
+    def remember(self, chat_id, user_text, reply):
+        """Сохраняет обмен репликами; вытесненные реплики сворачиваются в сводку в фоне."""
+        dialogue = self._dialogue(chat_id)
+        dialogue.append("user", user_text)
+        dialogue.append("assistant", reply)
+        if dialogue.pending and dialogue.summary_task is None:
+            dialogue.summary_task = asyncio.create_task(self._summarize(dialogue))
+
+    async def _summarize(self, dialogue):
+        try:
+            while dialogue.pending:
+                turns, dialogue.pending = dialogue.pending, []
+                summary = None
+                if self.summarizer is not None:
+                    try:
+                        summary = await self.summarizer(dialogue.summary, turns)
+                        self.stats["summaries"] += 1
+                    except Exception as e:
+                        self.stats["summary_errors"] += 1
+                        logger.warning(f"Conversation summary failed, using extractive: {e}")
+                if not summary:
+                    summary = _extractive_summary(dialogue.summary, turns, self.summary_tokens)
+                dialogue.summary = summary[-int(self.summary_tokens * CHARS_PER_TOKEN):]
+        finally:
+            dialogue.summary_task = None
+
+    def reset(self, chat_id):
+        """Забывает разговор в чате (новая сессия)."""
+        dialogue = self._dialogues.pop(chat_id, None)
+        if dialogue is not None and dialogue.summary_task is not None:
+            dialogue.summary_task.cancel()
+
+    def __len__(self):
+        return len(self._dialogues)
+
+def gpt_summarizer(gpt_client, max_tokens=MEMORY_SUMMARY_TOKENS):
+    """Сводка через YandexGPT: прежняя сводка + вытесненные реплики -> новая сводка."""
+    async def summarize(summary, turns):
+        lines = [f"Ранее: {summary}"] if summary else []
+        lines += [f"{'Собеседник' if role == 'user' else 'Психолог'}: {text}" for role, text, _ in turns]
+        return await gpt_client.complete(
+            [{"role": "system", "text": SUMMARY_PROMPT}, {"role": "user", "text": "\n".join(lines)}],
+            temperature=0.2, max_tokens=max_tokens,
+        )
+    return summarize
+
+# Общая память на процесс
+_memory = None
+
+def get_conversation_memory() -> ConversationMemory:
+    """Возвращает общую память диалогов (сводки - через общий клиент YandexGPT)."""
+    global _memory
+    if _memory is None:
+        _memory = ConversationMemory(summarizer=gpt_summarizer(get_gpt_client()))
+    return _memory
@@ -0,0 +1,206 @@
+import os
+import time
+import tempfile
+import asyncio
+import logging
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from scratch import ScratchQuotaExceeded, get_scratch
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+logger = logging.getLogger('dsp_pool')
+
+# Массивы меньше этого размера дешевле передать обычным pickle
+SHM_MIN_BYTES = 64 * 1024
+
+class SharedArray:
+    """Описание массива в разделяемой памяти: передается в процесс вместо самих данных."""
+
+    __slots__ = ("name", "shape", "dtype")
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return (self.name, self.shape, self.dtype)
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype = state
+
+def _to_shared(array):
+    """Копирует массив в новый сегмент разделяемой памяти (в счет квоты scratch)."""
+    shm = get_scratch().create_shared(array.nbytes)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, SharedArray(shm.name, array.shape, array.dtype.str)
+
+# --- код, выполняемый в процессах пула ---
+
+# Сегменты, которые нельзя закрыть сразу: на них еще может ссылаться результат
+_attached = []
+
+def _close_attached():
+    for shm in list(_attached):
+        try:
+            shm.close()
+        except BufferError:
+            continue
+        _attached.remove(shm)
+
+def _attach(value):
+    if isinstance(value, SharedArray):
+        shm = shared_memory.SharedMemory(name=value.name)
+        _attached.append(shm)
+        return np.ndarray(value.shape, dtype=np.dtype(value.dtype), buffer=shm.buf)
+    return value
+
+def _call_with_shared(func, args, kwargs):
+    """Подставляет массивы из разделяемой памяти и вызывает функцию."""
+    _close_attached()
+    args = [_attach(value) for value in args]
+    kwargs = {name: _attach(value) for name, value in kwargs.items()}
+    try:
+        return func(*args, **kwargs)
+    finally:
+        del args, kwargs
+        _close_attached()
+
+def _init_worker(preload, warmups):
+    """Импортирует тяжелые модули и прогревает JIT-ядра один раз при старте процесса."""
+    started = time.perf_counter()
+    # Временные файлы сторонних библиотек - в памяти, в каталоге процесса
+    tempfile.tempdir = get_scratch().directory
+    for name in preload:
+        importlib.import_module(name)
+    for spec in warmups:
+        module, _, function = spec.partition(":")
+        getattr(importlib.import_module(module), function)()
+    logger.info(f"DSP worker {os.getpid()} ready in {time.perf_counter() - started:.2f}s")
+
+def _ping():
+    time.sleep(0.05)
+    return os.getpid()
+
+def warm_librosa():
+    """Компилирует numba-ядра librosa, используемые при анализе голоса, и готовит сдвиг высоты тона."""
+    import librosa
+    sr = 22050
+    y = np.random.default_rng(0).standard_normal(sr).astype(np.float32) * 0.1
+    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
+    librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
+    librosa.effects.pitch_shift(y, sr=sr, n_steps=1, res_type="soxr_mq")
+
+def warm_pitch():
+    """Прогоняет оценку высоты тона на коротком сигнале."""
+    from pitch import yin
+    sr = 16000
+    t = np.arange(sr // 2) / sr
+    yin(np.sin(2 * np.pi * 150 * t), sr)
+
+def warm_torchaudio():
+    """Создает кэшируемые преобразования torchaudio для изменения голоса."""
+    import voice_effects
+    voice_effects.warm_up()
+
+# --- код, выполняемый в основном процессе ---
+
+class DSPPool:
+    """Пул процессов для обработки сигнала с предзагрузкой модулей и передачей массивов
+    через разделяемую память (numpy-массивы в аргументах не сериализуются).
+    """
+
+    def __init__(self, workers, preload=(), warmups=()):
+        self.workers = workers
+        self.preload = tuple(preload)
+        self.warmups = tuple(warmups)
+        self._executor = None
+
+    def configure(self, preload=(), warmups=()):
+        """Добавляет модули для предзагрузки и функции прогрева (до запуска пула)."""
+        if self._executor is not None:
+            logger.warning("DSP pool already started, preload/warmups are ignored")
+            return
+        self.preload += tuple(name for name in preload if name not in self.preload)
+        self.warmups += tuple(spec for spec in warmups if spec not in self.warmups)
+
+    @property
+    def executor(self):
+        # spawn, чтобы не форкать поток event loop
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.preload, self.warmups),
+            )
+        return self._executor
+
+    async def warm_up(self, timeout=300):
+        """Запускает все процессы пула и ждет, пока каждый завершит прогрев."""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        pids = set()
+        while len(pids) < self.workers and time.perf_counter() - started < timeout:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(self.executor, _ping) for _ in range(self.workers))
+            )
+            pids.update(results)
+        logger.info(f"DSP pool: {len(pids)} workers warm in {time.perf_counter() - started:.2f}s")
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет функцию в пуле, передавая крупные массивы через разделяемую память."""
+        segments = []
+
+        def share(value):
+            if isinstance(value, np.ndarray) and value.nbytes >= SHM_MIN_BYTES:
+                try:
+                    shm, shared = _to_shared(value)
+                except ScratchQuotaExceeded as e:
+                    # Квота занята другими сообщениями: массив передается обычным pickle
+                    logger.warning(f"{e}, passing array by pickle")
+                    return value
+                segments.append(shm)
+                return shared
+            return value
+
+        try:
+            shared_args = [share(value) for value in args]
+            shared_kwargs = {name: share(value) for name, value in kwargs.items()}
+            loop = asyncio.get_running_loop()
+            executor = self.executor
+            try:
+                return await loop.run_in_executor(executor, _call_with_shared, func, shared_args, shared_kwargs)
+            except BrokenProcessPool as e:
+                # Процесс пула упал (нехватка памяти, сбой, ошибка прогрева) - сломанный
+                # пул больше не принимает задачи: заменяем его и повторяем задачу один раз
+                logger.warning(f"DSP pool is broken ({e}), restarting it")
+                self.discard(executor)
+                return await loop.run_in_executor(
+                    self.executor, _call_with_shared, func, shared_args, shared_kwargs
+                )
+        finally:
+            scratch = get_scratch()
+            for shm in segments:
+                scratch.release_shared(shm)
+
+    def discard(self, executor=None):
+        """Останавливает сломанный пул; следующая задача запустит новый.
+
+        executor - пул, в котором обнаружена ошибка: если его уже заменили, ничего не делается.
+        """
+        if self._executor is None or (executor is not None and executor is not self._executor):
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def shutdown(self, wait=True):
+        """Останавливает процессы пула."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
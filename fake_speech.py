@@ -0,0 +1,114 @@
+"""Заглушки распознавания (speech_recognition) и синтеза речи (gTTS) для тестов и бенчмарков.
+
+install() подменяет библиотеки в модулях stt и tts, после чего боты работают
+без сети, а задержку «сервисов» можно настроить.
+"""
+import io
+import math
+import time
+import threading
+from tts import _strip_id3
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+av = lazy_import("av")
+
+class FakeSpeechRecognition:
+    """Заменяет модуль speech_recognition: recognize_google возвращает заданный текст
+    через latency + realtime_factor * длительность записи секунд.
+    """
+
+    class UnknownValueError(Exception):
+        pass
+
+    class RequestError(Exception):
+        pass
+
+    def __init__(self, text="Мне тревожно перед экзаменом, не знаю, что делать.",
+                 latency=0.3, realtime_factor=0.05):
+        self.text = text
+        self.latency = latency
+        self.realtime_factor = realtime_factor
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def AudioData(self, frame_data, sample_rate, sample_width):
+        return frame_data, sample_rate, sample_width
+
+    def Recognizer(self):
+        return self
+
+    def recognize_google(self, audio, language=None):
+        frame_data, sample_rate, sample_width = audio
+        seconds = len(frame_data) / (sample_rate * sample_width)
+        time.sleep(self.latency + self.realtime_factor * seconds)
+        with self._lock:
+            self.calls += 1
+            number = self.calls
+        if not frame_data:
+            raise self.UnknownValueError()
+        # Номер запроса делает тексты разными, чтобы кэши не скрывали нагрузку
+        return f"{self.text} ({number})"
+
+def _tone_mp3(seconds=0.5, sample_rate=24000, frequency=220.0):
+    """Короткий тон в mp3: из таких кусков собирается «синтезированная речь»."""
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    y = (0.2 * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+    buffer = io.BytesIO()
+    with av.open(buffer, "w", format="mp3") as container:
+        stream = container.add_stream("mp3", rate=sample_rate, layout="mono")
+        resampler = av.AudioResampler(
+            format=stream.codec_context.format.name, layout="mono", rate=sample_rate,
+            frame_size=stream.codec_context.frame_size or None,
+        )
+        frame = av.AudioFrame.from_ndarray(y.reshape(1, -1), format="flt", layout="mono")
+        frame.sample_rate = sample_rate
+        for resampled in resampler.resample(frame) + resampler.resample(None):
+            for packet in stream.encode(resampled):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return buffer.getvalue()
+
+class FakeGTTS:
+    """Заменяет модуль gtts: gTTS(...).write_to_fp пишет mp3 длиной примерно
+    seconds_per_char на символ через latency + per_char * длина текста секунд.
+    """
+
+    CLIP_SECONDS = 0.5
+
+    def __init__(self, latency=0.2, per_char=0.002, seconds_per_char=0.06):
+        self.latency = latency
+        self.per_char = per_char
+        self.seconds_per_char = seconds_per_char
+        self.calls = 0
+        self._clip = None
+        self._lock = threading.Lock()
+
+    def _audio(self, text):
+        with self._lock:
+            self.calls += 1
+            if self._clip is None:
+                self._clip = _tone_mp3(self.CLIP_SECONDS)
+        repeats = max(1, math.ceil(len(text) * self.seconds_per_char / self.CLIP_SECONDS))
+        return self._clip + _strip_id3(self._clip) * (repeats - 1)
+
+    def gTTS(self, text, lang="ru", slow=False):
+        fake = self
+
+        class Speech:
+            def write_to_fp(self, fp):
+                time.sleep(fake.latency + fake.per_char * len(text))
+                fp.write(fake._audio(text))
+
+        return Speech()
+
+def install(recognizer=None, synthesizer=None):
+    """Подменяет speech_recognition и gTTS в модулях stt и tts заглушками."""
+    import stt
+    import tts
+    recognizer = recognizer or FakeSpeechRecognition()
+    synthesizer = synthesizer or FakeGTTS()
+    stt.sr = recognizer
+    tts.gtts = synthesizer
+    return recognizer, synthesizer
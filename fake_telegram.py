@@ -0,0 +1,200 @@
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {"id": 1000, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+def _decode(value):
+    # Bot API клиенты передают сложные параметры как JSON-строки
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return value
+
+class FakeTelegram:
+    """Локальный сервер, имитирующий Telegram Bot API (для тестов режима webhook).
+
+    Бот подключается к нему через TG_API_URL=fake.base_url. Вызовы методов
+    сохраняются в requests, обновления доставляются на webhook через post_update.
+    """
+
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.requests = []
+        self.webhook = None
+        self.files = {}
+        self._update_id = 0
+        self._message_id = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def calls(self, method):
+        """Параметры всех вызовов метода Bot API."""
+        with self._lock:
+            return [params for name, params in self.requests if name == method]
+
+    def add_file(self, file_id, data):
+        """Регистрирует файл, который бот сможет скачать через getFile."""
+        self.files[file_id] = data
+
+    def _next_message(self, params, **fields):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = params.get("chat_id")
+        return {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id and int(chat_id) > 0 else "group"},
+            "from": BOT_USER, **fields,
+        }
+
+    def handle(self, method, params):
+        """Результат вызова метода Bot API (можно переопределить в тестах)."""
+        if method == "getMe":
+            return BOT_USER
+        if method == "setWebhook":
+            self.webhook = {"url": params["url"], "secret_token": params.get("secret_token")}
+            return True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+        if method in ("sendMessage", "editMessageText"):
+            return self._next_message(params, text=params.get("text", ""))
+        if method == "sendVoice":
+            return self._next_message(params, voice={
+                "file_id": f"voice{self._message_id + 1}", "file_unique_id": f"u{self._message_id + 1}",
+                "duration": 1,
+            })
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_path": f"voice/{file_id}.oga"}
+        return True
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                length = int(self.headers.get("Content-Length", 0))
+                params = self._parse(self.rfile.read(length))
+                with fake._lock:
+                    fake.requests.append((method, params))
+                if fake.latency:
+                    time.sleep(fake.latency)
+                self._send_json(200, {"ok": True, "result": fake.handle(method, params)})
+
+            def do_GET(self):
+                # Загрузка файлов: /file/bot<token>/voice/<file_id>.oga
+                file_id = self.path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+                data = fake.files.get(file_id)
+                if data is None:
+                    self._send_json(404, {"ok": False, "description": "file not found"})
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _parse(self, body):
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    message = BytesParser(policy=HTTP).parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+                    )
+                    params = {}
+                    for part in message.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        payload = part.get_payload(decode=True)
+                        params[name] = payload if part.get_filename() else _decode(payload.decode())
+                    return params
+                if content_type.startswith("application/json"):
+                    return json.loads(body or b"{}")
+                return {key: _decode(values[-1]) for key, values in parse_qs(body.decode()).items()}
+
+            def _send_json(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def make_update(self, chat_id, text=None, voice_file_id=None, user_id=None):
+        """Формирует обновление с текстовым или голосовым сообщением."""
+        with self._lock:
+            self._update_id += 1
+            self._message_id += 1
+            update_id, message_id = self._update_id, self._message_id
+        user_id = user_id or chat_id
+        message = {
+            "message_id": message_id, "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        }
+        if voice_file_id is not None:
+            message["voice"] = {"file_id": voice_file_id, "file_unique_id": voice_file_id, "duration": 1}
+        else:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": update_id, "message": message}
+
+    def post_update(self, update):
+        """Доставляет обновление на установленный webhook, возвращает HTTP-статус."""
+        if self.webhook is None:
+            raise RuntimeError("webhook is not set")
+        request = urllib.request.Request(
+            self.webhook["url"], data=json.dumps(update).encode("utf-8"), method="POST",
+            headers={"Content-Type": "application/json"},
+        )
+        if self.webhook["secret_token"]:
+            request.add_header("X-Telegram-Bot-Api-Secret-Token", self.webhook["secret_token"])
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    with FakeTelegram(port=8082) as fake:
+        print(f"Fake Telegram Bot API on {fake.base_url} (TG_API_URL={fake.base_url})")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
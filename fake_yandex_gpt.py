@@ -0,0 +1,117 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeYandexGPT:
+    """Локальный сервер, имитирующий endpoint completion YandexGPT (для тестов)."""
+
+    def __init__(self, reply="Расскажите подробнее, что вы сейчас чувствуете?", latency=0.0,
+                 fail_statuses=(), stream_delay=0.0, host="127.0.0.1", port=0):
+        self.reply = reply
+        self.latency = latency
+        # Пауза между фрагментами в режиме stream
+        self.stream_delay = stream_delay
+        # Коды ошибок, которые сервер вернет на первые запросы (например, (429, 503))
+        self.fail_statuses = list(fail_statuses)
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/foundationModels/v1/completion"
+
+    def _next_status(self):
+        with self._lock:
+            return self.fail_statuses.pop(0) if self.fail_statuses else 200
+
+    def make_reply(self, payload):
+        """Формирует ответ модели (можно переопределить в тестах)."""
+        return self.reply
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                with fake._lock:
+                    fake.requests.append(payload)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status = fake._next_status()
+                stream = payload.get("completionOptions", {}).get("stream", False)
+                if status == 200 and stream:
+                    self._send_stream(fake.make_reply(payload))
+                    return
+                if status == 200:
+                    body = {"result": {"alternatives": [{
+                        "message": {"role": "assistant", "text": fake.make_reply(payload)},
+                        "status": "ALTERNATIVE_STATUS_FINAL",
+                    }]}}
+                else:
+                    body = {"error": {"httpCode": status, "message": "fake error"}}
+                self._send_json(status, body)
+
+            def _send_json(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, text):
+                # Как и YandexGPT, отдаем по строке JSON с накопленным текстом
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                words = text.split(" ")
+                for i in range(1, len(words) + 1):
+                    final = i == len(words)
+                    body = {"result": {"alternatives": [{
+                        "message": {"role": "assistant", "text": " ".join(words[:i])},
+                        "status": "ALTERNATIVE_STATUS_FINAL" if final else "ALTERNATIVE_STATUS_PARTIAL",
+                    }]}}
+                    line = (json.dumps(body, ensure_ascii=False) + "\n").encode("utf-8")
+                    self.wfile.write(f"{len(line):X}\r\n".encode() + line + b"\r\n")
+                    self.wfile.flush()
+                    if fake.stream_delay and not final:
+                        time.sleep(fake.stream_delay)
+                self.wfile.write(b"0\r\n\r\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        """Запускает сервер в фоновом потоке."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Останавливает сервер."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    # Запуск вручную: YAGPT_URL=<url> python psycho_1.py
+    server = FakeYandexGPT(port=8081)
+    print(f"Fake YandexGPT: {server.url}")
+    server._server.serve_forever()
@@ -0,0 +1,121 @@
+"""Ленивая загрузка тяжелых модулей и отчет о времени запуска.
+
+Запуск как скрипта печатает время импорта каждого бота по данным
+python -X importtime и завершается с кодом 1, если бюджет превышен:
+
+    python lazy.py [модуль ...]
+"""
+import os
+import sys
+import time
+import logging
+import importlib
+import subprocess
+
+logger = logging.getLogger('lazy')
+
+# Бюджет холодного старта: секунды от запуска процесса до начала приема сообщений
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "1.5"))
+
+# Модули, появление которых при старте означает, что ленивая загрузка где-то сломана
+HEAVY_MODULES = (
+    "torch", "torchaudio", "librosa", "numba", "scipy", "numpy", "av",
+    "soundfile", "speech_recognition", "pydub", "gtts", "vosk",
+)
+
+# Время импорта модулей, загруженных лениво: имя -> секунды
+import_timings = {}
+
+_loaded_at = time.perf_counter()
+
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к его атрибуту."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            started = time.perf_counter()
+            module = importlib.import_module(self._name)
+            import_timings.setdefault(self._name, round(time.perf_counter() - started, 3))
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+def lazy_import(name):
+    """Возвращает модуль, который будет импортирован при первом использовании."""
+    return LazyModule(name)
+
+def process_uptime():
+    """Секунды с момента запуска процесса (на Linux - по /proc, иначе с импорта этого модуля)."""
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.perf_counter() - _loaded_at
+
+def report_startup(name):
+    """Пишет в лог время запуска и уже загруженные тяжелые модули."""
+    elapsed = process_uptime()
+    heavy = [module for module in HEAVY_MODULES if module in sys.modules]
+    logger.info(
+        f"{name} ready in {elapsed:.2f}s (budget {STARTUP_BUDGET:.2f}s), "
+        f"heavy modules loaded: {heavy or 'none'}, lazy imports: {import_timings}"
+    )
+    if elapsed > STARTUP_BUDGET:
+        logger.warning(f"{name}: startup {elapsed:.2f}s exceeds budget {STARTUP_BUDGET:.2f}s")
+    return elapsed
+
+def import_report(module):
+    """Импортирует модуль в чистом интерпретаторе с -X importtime.
+
+    Возвращает список (накопленное время, собственное время, имя) в секундах,
+    отсортированный по накопленному времени.
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else module)
+    timings = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative_us) / 1e6, int(self_us) / 1e6, name.strip()))
+    return sorted(timings, reverse=True)
+
+def main(modules):
+    over_budget = False
+    for module in modules:
+        try:
+            timings = import_report(module)
+        except RuntimeError as e:
+            print(f"{module}: import failed: {e}")
+            over_budget = True
+            continue
+        total = next((t for t in timings if t[2] == module), timings[0])[0]
+        heavy = sorted({name.split(".")[0] for _, _, name in timings} & set(HEAVY_MODULES))
+        status = "OK" if total <= STARTUP_BUDGET else "OVER BUDGET"
+        print(f"{module}: {total:.3f}s [{status}], heavy: {heavy or 'none'}")
+        for cumulative, own, name in timings[:10]:
+            print(f"    {cumulative:8.3f}s {own:8.3f}s  {name}")
+        over_budget = over_budget or total > STARTUP_BUDGET
+    return 1 if over_budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:] or [
+        "service", "main", "psycho_1", "psycho_2", "speech_to_speech_librosa", "speech_to_speech_modificator",
+    ]))
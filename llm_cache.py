@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from tts_cache import normalize_text
+from yandex_gpt import get_gpt_client
+from metrics import get_metrics, span
+
+logger = logging.getLogger('llm_cache')
+
+# Сколько секунд ответ модели считается актуальным
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "300"))
+LLM_CACHE_ENTRIES = int(os.getenv("LLM_CACHE_ENTRIES", "2048"))
+
+def normalize_prompt(text):
+    """Нормализация реплики для ключа: регистр, пробелы и пунктуация по краям
+    не меняют смысл короткого сообщения («Привет!» и «привет» - один запрос).
+    """
+    return normalize_text(text).casefold().strip(" .,!?…")
+
+def make_prompt_key(messages, model, temperature, max_tokens):
+    """Ключ по всем сообщениям (системный промпт, история, запрос), модели и параметрам."""
+    parts = [[message["role"], normalize_prompt(message["text"])] for message in messages]
+    raw = json.dumps([parts, model, temperature, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class RequestAborted(Exception):
+    """Запрос, к которому присоединились другие, был прерван без ответа."""
+
+class ResponseCache:
+    """Слой перед запросами к YandexGPT: кэш точных совпадений с коротким TTL
+    и объединение одновременных одинаковых запросов в один вызов.
+
+    Повторяет интерфейс клиента: complete и stream_complete.
+    """
+
+    def __init__(self, client, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_ENTRIES):
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # ключ -> (время записи, текст)
+        self._entries = OrderedDict()
+        # ключ -> Future с ответом выполняющегося запроса
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+    def _key(self, messages, temperature, max_tokens):
+        return make_prompt_key(
+            messages,
+            self.client.model_uri,
+            self.client.temperature if temperature is None else temperature,
+            self.client.max_tokens if max_tokens is None else max_tokens,
+        )
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored, text = entry
+        if time.monotonic() - stored > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return text
+
+    def _put(self, key, text):
+        self._entries[key] = (time.monotonic(), text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, key):
+        """Возвращает (ответ из кэша, Future выполняющегося запроса)."""
+        text = self._get(key)
+        if text is not None:
+            self.stats["hits"] += 1
+            return text, None
+        future = self._inflight.get(key)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            return None, future
+        self.stats["misses"] += 1
+        return None, None
+
+    def _lead(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        return future
+
+    def _finish(self, key, future, text=None, error=None):
+        self._inflight.pop(key, None)
+        if error is not None:
+            self.stats["errors"] += 1
+            future.set_exception(error)
+            # Ошибку получат только ожидающие, неполученное исключение не логируется
+            future.exception()
+            return
+        self._put(key, text)
+        future.set_result(text)
+
+    async def complete(self, messages, temperature=None, max_tokens=None):
+        """Ответ модели: из кэша, из уже выполняющегося запроса или новым запросом."""
+        with span("llm"):
+            return await self._complete(messages, temperature, max_tokens)
+
+    async def _complete(self, messages, temperature, max_tokens):
+        key = self._key(messages, temperature, max_tokens)
+        text, future = self._lookup(key)
+        if text is None and future is not None:
+            try:
+                text = await asyncio.shield(future)
+            except RequestAborted:
+                # Запрос-лидер отменен (например, пользователь ушел) - запрашиваем сами
+                text = None
+        if text is not None:
+            return text
+        future = self._lead(key)
+        try:
+            text = await self.client.complete(messages, temperature, max_tokens)
+        except BaseException as e:
+            self._finish(key, future, error=e if isinstance(e, Exception) else RequestAborted())
+            raise
+        self._finish(key, future, text)
+        return text
+
+    async def stream_complete(self, messages, temperature=None, max_tokens=None):
+        """Накопленный текст ответа. Ответ из кэша или чужого запроса отдается целиком.
+
+        Замеряются время до первого фрагмента (llm_first) и до последнего (llm);
+        второе включает ожидание потребителя между фрагментами.
+        """
+        started = time.monotonic()
+        first = True
+        with span("llm"):
+            async for text in self._stream_complete(messages, temperature, max_tokens):
+                if first:
+                    get_metrics().observe("llm_first", time.monotonic() - started)
+                    first = False
+                yield text
+
+    async def _stream_complete(self, messages, temperature, max_tokens):
+        key = self._key(messages, temperature, max_tokens)
+        text, future = self._lookup(key)
+        if text is None and future is not None:
+            try:
+                text = await asyncio.shield(future)
+            except RequestAborted:
+                # Запрос-лидер отменен (например, пользователь ушел) - запрашиваем сами
+                text = None
+        if text is not None:
+            yield text
+            return
+        future = self._lead(key)
+        text = None
+        try:
+            async for text in self.client.stream_complete(messages, temperature, max_tokens):
+                yield text
+        except BaseException as e:
+            self._finish(key, future, error=e if isinstance(e, Exception) else RequestAborted())
+            raise
+        if text is None:
+            self._finish(key, future, error=RequestAborted())
+            return
+        self._finish(key, future, text)
+
+    def snapshot(self):
+        """Счетчики попаданий для мониторинга."""
+        total = self.stats["hits"] + self.stats["misses"] + self.stats["coalesced"]
+        saved = self.stats["hits"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hit_rate": round(saved / total, 3) if total else 0.0,
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+# Общий слой на процесс
+_cache = None
+
+def get_response_cache() -> ResponseCache:
+    """Возвращает общий кэш ответов поверх общего клиента YandexGPT."""
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(get_gpt_client())
+    return _cache
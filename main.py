@@ -1,17 +1,21 @@
 import os
-import tempfile
-import speech_recognition as sr
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import logging
-from pydub import AudioSegment
+from audio_codec import download_voice
+from stt import STTError, SpeechNotRecognized, load_stt_backend, transcribe_stream
+from streaming import ThrottledMessage
+from lazy import report_startup
+from metrics import span, timed_handler
+from scheduler import SchedulerRejected, get_scheduler
+from webhook import application_builder, run
 
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
-# logger = logging.getLogger(name)
+logger = logging.getLogger('main')
 
 # Токен бота из BotFather
 TOKEN = os.getenv("TG_TOKEN")
@@ -28,79 +32,88 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "Просто отправь мне голосовое сообщение, и я преобразую его в текст."
     )
 
+@timed_handler("main")
 async def voice_to_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает голосовые сообщения и конвертирует их в текст."""
+    """Ставит голосовое сообщение в очередь распознавания.
+
+    Голосовые, пересланные пачкой, ждут в очереди вместе и не мешают другим пользователям.
+    """
+    try:
+        get_scheduler().submit(
+            update.effective_user.id, update.effective_chat.id, "main", update.message, transcribe_messages
+        )
+    except SchedulerRejected as e:
+        await update.message.reply_text(e.reply_text)
+
+async def transcribe_messages(messages) -> None:
+    """Распознает голосовые сообщения одного чата по порядку (выполняется планировщиком)."""
+    for message in messages:
+        await transcribe_voice(message)
+
+async def transcribe_voice(message) -> None:
+    """Распознает одно голосовое сообщение и отправляет текст."""
     # Сообщение о начале обработки
-    processing_msg = await update.message.reply_text("Обрабатываю ваше голосовое сообщение...")
+    processing_msg = await message.reply_text("Обрабатываю ваше голосовое сообщение...")
     
     try:
-        # Получаем информацию о голосовом сообщении
-        voice = update.message.voice
-        
-        # Получаем файл
-        voice_file = await context.bot.get_file(voice.file_id)
-        
-        # Создаем временный файл для сохранения аудио
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_ogg:
-            ogg_path = temp_ogg.name
-        
-        # Скачиваем голосовое сообщение во временный файл
-        await voice_file.download_to_drive(ogg_path)
+        # Получаем файл голосового сообщения
+        voice_file = await message.voice.get_file()
         
-        # Конвертируем OGG в WAV (speech_recognition работает с WAV)
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as temp_wav:
-            wav_path = temp_wav.name
+        # Скачиваем голосовое сообщение в память
+        ogg_bytes = await download_voice(voice_file)
         
-        # Используем pydub для конвертации
-        audio = AudioSegment.from_file(ogg_path, format="ogg")
-        audio.export(wav_path, format="wav")
+        # Распознаем речь (движок выбирается через STT_BACKEND), промежуточные
+        # результаты показываем в сообщении о ходе обработки
+        progress = ThrottledMessage(message, message=processing_msg)
+        text = ""
+        async for text, final in transcribe_stream(ogg_bytes, language="ru-RU"):
+            if not final:
+                await progress.update(f"Распознаю: {text}…")
         
-        # Инициализируем распознаватель речи
-        recognizer = sr.Recognizer()
-        
-        # Открываем аудиофайл
-        with sr.AudioFile(wav_path) as source:
-            # Чтение аудиоданных из файла
-            audio_data = recognizer.record(source)
-            
-            # Пытаемся распознать речь
-            text = recognizer.recognize_google(audio_data, language="ru-RU")
-            
-            # Отправляем результат пользователю
-            await update.message.reply_text(f"Распознанный текст: {text}")
+        # Отправляем результат пользователю
+        with span("reply"):
+            await message.reply_text(f"Распознанный текст: {text}")
     
-    except sr.UnknownValueError:
-        await update.message.reply_text("Извините, не удалось распознать речь.")
-    except sr.RequestError as e:
-        await update.message.reply_text(f"Ошибка сервиса распознавания: {e}")
+    except SpeechNotRecognized:
+        await message.reply_text("Извините, не удалось распознать речь.")
+    except STTError as e:
+        await message.reply_text(f"Ошибка сервиса распознавания: {e}")
     except Exception as e:
-        # logger.error(f"Ошибка при обработке голосового сообщения: {e}")
-        await update.message.reply_text("Произошла ошибка при обработке голосового сообщения.")
+        logger.error(f"Ошибка при обработке голосового сообщения: {e}")
+        await message.reply_text("Произошла ошибка при обработке голосового сообщения.")
     finally:
         # Удаляем сообщение о процессе обработки
         await processing_msg.delete()
-        
-        # Удаляем временные файлы
-        try:
-            os.remove(ogg_path)
-            os.remove(wav_path)
-        except:
-            pass
+
+# Подготовка, которая выполняется в фоне после запуска (модель распознавания)
+BACKGROUND_STARTUP = [load_stt_backend]
+
+async def post_init(application: Application) -> None:
+    """Загружает модель распознавания в фоне и пишет отчет о времени запуска."""
+    for startup in BACKGROUND_STARTUP:
+        application.create_task(startup())
+    report_startup("main")
+
+def build_handlers() -> list:
+    """Обработчики бота (используются и отдельным ботом, и общим сервисом)."""
+    return [
+        # Обработчики команд
+        CommandHandler("start", start),
+        CommandHandler("help", help_command),
+        # Обработчик голосовых сообщений
+        MessageHandler(filters.VOICE, voice_to_text),
+    ]
 
 def main() -> None:
     """Запускает бота."""
     # Создаем приложение и передаем ему токен бота
-    application = Application.builder().token(TOKEN).build()
-
-    # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
+    application = application_builder().token(TOKEN).post_init(post_init).build()
 
-    # Обработчик голосовых сообщений
-    application.add_handler(MessageHandler(filters.VOICE,voice_to_text))
+    # Добавляем обработчики
+    application.add_handlers(build_handlers())
 
     # Запускаем бота
-    application.run_polling()
+    run(application)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,239 @@
+"""Замеры стадий обработки: гистограммы длительности, счетчики ошибок и число
+выполняющихся операций, доступные по HTTP в формате Prometheus.
+
+Стадия измеряется блоком `with span("decode"):`. Конвейер (бот), к которому
+относится замер, берется из контекста обработчика: обработчики бота обернуты
+`timed_handler("main")`, поэтому замеры в общих модулях (stt, tts_cache,
+llm_cache, audio_codec) подписываются конвейером, который их вызвал.
+
+Настройка через переменные окружения:
+    METRICS_LISTEN - адрес сервера метрик (по умолчанию только локальный)
+    METRICS_PORT   - порт (по умолчанию 9464, 0 - не поднимать сервер)
+
+GET /metrics отдает текстовый формат Prometheus, GET /metrics.json - JSON.
+"""
+import os
+import json
+import time
+import bisect
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('metrics')
+
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Границы корзин гистограммы (секунды): от кодирования короткого сообщения до ответа LLM
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Конвейер, обрабатывающий текущее обновление
+_pipeline = contextvars.ContextVar("pipeline", default="-")
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (без хранения самих значений)."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Оценка квантиля по корзинам (верхняя граница корзины)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+class Metrics:
+    """Реестр замеров процесса. Операции дешевые: пара вызовов perf_counter,
+    блокировка и поиск корзины - можно держать включенным постоянно.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # (конвейер, стадия) -> Histogram
+        self._histograms = {}
+        # (конвейер, стадия, тип ошибки) -> число
+        self._errors = {}
+        # (конвейер, стадия) -> число выполняющихся
+        self._in_flight = {}
+        # Дополнительные показатели: имя -> функция, возвращающая число
+        self._gauges = {}
+        # Замеры идут из event loop, чтение - из потока сервера метрик
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, pipeline=None):
+        key = (pipeline or _pipeline.get(), stage)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def error(self, stage, error, pipeline=None):
+        key = (pipeline or _pipeline.get(), stage, type(error).__name__)
+        with self._lock:
+            self._errors[key] = self._errors.get(key, 0) + 1
+
+    @contextmanager
+    def span(self, stage):
+        """Замер стадии: длительность, ошибка (если была) и число выполняющихся."""
+        key = (_pipeline.get(), stage)
+        with self._lock:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(stage, e, key[0])
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._in_flight[key] -= 1
+            self.observe(stage, elapsed, key[0])
+
+    def gauge(self, name, func):
+        """Регистрирует показатель, значение которого читается при каждом запросе метрик."""
+        self._gauges[name] = func
+
+    def snapshot(self):
+        """Состояние в JSON-виде: p50/p95/p99 оцениваются по корзинам."""
+        with self._lock:
+            stages = [
+                {
+                    "pipeline": pipeline, "stage": stage, "count": histogram.count,
+                    "sum": round(histogram.sum, 3),
+                    **{f"p{q}": histogram.quantile(q / 100) for q in (50, 95, 99)},
+                    "in_flight": self._in_flight.get((pipeline, stage), 0),
+                }
+                for (pipeline, stage), histogram in sorted(self._histograms.items())
+            ]
+            errors = [
+                {"pipeline": pipeline, "stage": stage, "error": error, "count": count}
+                for (pipeline, stage, error), count in sorted(self._errors.items())
+            ]
+        return {"stages": stages, "errors": errors, "gauges": self._read_gauges()}
+
+    def _read_gauges(self):
+        values = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                values[name] = func()
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {e}")
+        return values
+
+    def render(self):
+        """Текстовый формат Prometheus."""
+        lines = [
+            "# HELP bot_stage_seconds Длительность стадии обработки",
+            "# TYPE bot_stage_seconds histogram",
+        ]
+        with self._lock:
+            for (pipeline, stage), histogram in sorted(self._histograms.items()):
+                total = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    total += count
+                    lines.append(f"bot_stage_seconds_bucket{_labels(pipeline=pipeline, stage=stage, le=bound)} {total}")
+                lines.append(f"bot_stage_seconds_bucket{_labels(pipeline=pipeline, stage=stage, le='+Inf')} {histogram.count}")
+                lines.append(f"bot_stage_seconds_sum{_labels(pipeline=pipeline, stage=stage)} {histogram.sum:.6f}")
+                lines.append(f"bot_stage_seconds_count{_labels(pipeline=pipeline, stage=stage)} {histogram.count}")
+            lines += ["# HELP bot_stage_errors_total Ошибки стадии по типу", "# TYPE bot_stage_errors_total counter"]
+            for (pipeline, stage, error), count in sorted(self._errors.items()):
+                lines.append(f"bot_stage_errors_total{_labels(pipeline=pipeline, stage=stage, error=error)} {count}")
+            lines += ["# HELP bot_stage_in_flight Выполняющиеся операции стадии", "# TYPE bot_stage_in_flight gauge"]
+            for (pipeline, stage), count in sorted(self._in_flight.items()):
+                lines.append(f"bot_stage_in_flight{_labels(pipeline=pipeline, stage=stage)} {count}")
+        for name, value in sorted(self._read_gauges().items()):
+            lines += [f"# TYPE bot_{name} gauge", f"bot_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+# Общий реестр на процесс
+_metrics = Metrics()
+
+def get_metrics() -> Metrics:
+    """Возвращает общий реестр замеров."""
+    return _metrics
+
+def current_pipeline():
+    """Конвейер текущего обработчика (для замеров в потоках пула, куда контекст не передается)."""
+    return _pipeline.get()
+
+def span(stage):
+    """Замер стадии в общем реестре: `with span("stt"): ...`."""
+    return _metrics.span(stage)
+
+def timed_handler(pipeline):
+    """Декоратор обработчика: задает конвейер для замеров внутри и измеряет
+    обработку обновления целиком (стадия "total").
+    """
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            token = _pipeline.set(pipeline)
+            try:
+                with _metrics.span("total"):
+                    return await callback(*args, **kwargs)
+            finally:
+                _pipeline.reset(token)
+        return wrapper
+    return decorator
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send(_metrics.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+        elif self.path == "/metrics.json":
+            self._send(json.dumps(_metrics.snapshot(), ensure_ascii=False).encode("utf-8"), "application/json")
+        else:
+            self.send_error(404)
+
+    def _send(self, data, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+# Сервер метрик (один на процесс)
+_server = None
+
+def start_metrics_server(listen=METRICS_LISTEN, port=METRICS_PORT):
+    """Поднимает сервер метрик в фоновом потоке (не зависит от event loop бота)."""
+    global _server
+    if _server is not None or not port:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((listen, port), _Handler)
+    except OSError as e:
+        logger.warning(f"Metrics server not started on {listen}:{port}: {e}")
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics on http://{listen}:{_server.server_address[1]}/metrics")
+    return _server
@@ -0,0 +1,153 @@
+import os
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger('pitch')
+
+# Движок оценки высоты тона: "yin" (быстрый векторизованный) или "pyin" (librosa)
+PITCH_ENGINE = os.getenv("PITCH_ENGINE", "yin")
+
+# Диапазон основной частоты речи (C2-C7 у pyin избыточен для голоса)
+SPEECH_FMIN = 65.0
+SPEECH_FMAX = 400.0
+
+# Калиброванная высота тона голоса gTTS
+TTS_BASELINE_PATH = os.getenv("TTS_BASELINE_PATH", "tts_baseline.json")
+CALIBRATION_TEXT = (
+    "Здравствуйте! Расскажите, пожалуйста, как прошел ваш день. "
+    "Я внимательно вас слушаю и постараюсь помочь."
+)
+
+def _frames(y, frame_length, hop_length):
+    """Нарезает сигнал на перекрывающиеся кадры без копирования."""
+    if len(y) < frame_length:
+        y = np.pad(y, (0, frame_length - len(y)))
+    return np.lib.stride_tricks.sliding_window_view(y, frame_length)[::hop_length]
+
+def yin(y, sr, fmin=SPEECH_FMIN, fmax=SPEECH_FMAX, hop_length=None, threshold=0.15,
+        energy_threshold=0.05, batch_size=256):
+    """Оценивает основную частоту по кадрам алгоритмом YIN.
+
+    Разностная функция всех кадров пачки считается одной операцией через FFT,
+    тихие кадры (RMS ниже energy_threshold от максимума) пропускаются.
+    Как и librosa.pyin, возвращает массив f0 с NaN для невокализованных кадров.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    hop_length = hop_length or sr // 100
+    tau_min = max(2, int(sr / fmax))
+    tau_max = int(np.ceil(sr / fmin))
+    window = tau_max
+    frame_length = window + tau_max + 1
+    n_fft = 1 << (frame_length + window).bit_length()
+
+    frames = _frames(y, frame_length, hop_length)
+    f0 = np.full(len(frames), np.nan)
+
+    rms = np.sqrt(np.mean(frames[:, :window] ** 2, axis=1))
+    if not len(rms) or rms.max() <= 0:
+        return f0
+    active = np.flatnonzero(rms > energy_threshold * rms.max())
+
+    taus = np.arange(1, tau_max + 1)
+    for start in range(0, len(active), batch_size):
+        idx = active[start:start + batch_size]
+        x = frames[idx]
+        rows = np.arange(len(idx))
+
+        # r(tau) = sum_j x[j] * x[j + tau] для j < window
+        spectrum = np.fft.rfft(x, n_fft)
+        spectrum_window = np.fft.rfft(x[:, :window], n_fft)
+        r = np.fft.irfft(spectrum * np.conj(spectrum_window), n_fft)[:, :tau_max + 1]
+
+        # Энергии окон через префиксные суммы квадратов
+        sq = np.zeros((len(idx), frame_length + 1))
+        np.cumsum(x ** 2, axis=1, out=sq[:, 1:])
+        e1 = sq[:, window][:, None]
+        e2 = sq[:, window:window + tau_max + 1] - sq[:, :tau_max + 1]
+        d = e1 + e2 - 2 * r
+        d[:, 0] = 0
+
+        # Нормированная кумулятивным средним разностная функция
+        cmnd = np.ones_like(d)
+        cmnd[:, 1:] = d[:, 1:] * taus / np.maximum(np.cumsum(d[:, 1:], axis=1), 1e-12)
+
+        # Первый локальный минимум ниже порога
+        seg = cmnd[:, tau_min:tau_max]
+        candidates = (seg < threshold) & (cmnd[:, tau_min + 1:tau_max + 1] >= seg)
+        voiced = candidates.any(axis=1)
+        tau = np.argmax(candidates, axis=1) + tau_min
+
+        # Параболическая интерполяция для субсэмпловой точности
+        a, b, c = cmnd[rows, tau - 1], cmnd[rows, tau], cmnd[rows, tau + 1]
+        denom = a - 2 * b + c
+        shift = np.where(np.abs(denom) > 1e-12, 0.5 * (a - c) / np.where(denom == 0, 1, denom), 0.0)
+        period = tau + np.clip(shift, -1, 1)
+
+        f0[idx[voiced]] = sr / period[voiced]
+    return f0
+
+def pyin(y, sr):
+    """Оценка f0 через librosa.pyin в исходном диапазоне C2-C7."""
+    import librosa
+    f0, voiced_flag, voiced_probs = librosa.pyin(
+        y,
+        fmin=librosa.note_to_hz('C2'),
+        fmax=librosa.note_to_hz('C7'),
+        sr=sr
+    )
+    return f0
+
+def estimate_f0(y, sr, engine=None):
+    """Возвращает f0 по кадрам выбранным движком."""
+    engine = engine or PITCH_ENGINE
+    if engine == "pyin":
+        return pyin(y, sr)
+    if engine == "yin":
+        return yin(y, sr)
+    raise ValueError(f"Неизвестный движок оценки высоты тона: {engine}")
+
+def estimate_mean_f0(y, sr, default=None, engine=None):
+    """Средняя основная частота по вокализованным кадрам или default."""
+    f0 = estimate_f0(y, sr, engine)
+    f0_clean = f0[~np.isnan(f0)]
+    if len(f0_clean) > 0:
+        return float(np.mean(f0_clean))
+    return default
+
+def f0_stats(y, sr, engine=None):
+    """Статистика f0 образца голоса: (секунды вокализованной речи, средняя, дисперсия).
+
+    Без вокализованных кадров возвращает (0.0, 0.0, 0.0).
+    """
+    f0 = estimate_f0(y, sr, engine)
+    voiced = f0[~np.isnan(f0)]
+    if not len(voiced):
+        return 0.0, 0.0, 0.0
+    voiced_seconds = len(voiced) / len(f0) * len(y) / sr
+    return float(voiced_seconds), float(np.mean(voiced)), float(np.var(voiced))
+
+def load_tts_baseline(lang='ru'):
+    """Возвращает сохраненную высоту тона голоса gTTS (или из TTS_BASELINE_F0)."""
+    value = os.getenv("TTS_BASELINE_F0")
+    if value:
+        return float(value)
+    try:
+        with open(TTS_BASELINE_PATH, encoding="utf-8") as f:
+            return json.load(f).get(lang)
+    except (OSError, ValueError):
+        return None
+
+def save_tts_baseline(lang, f0):
+    """Сохраняет откалиброванную высоту тона голоса gTTS."""
+    try:
+        with open(TTS_BASELINE_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    data[lang] = f0
+    tmp_path = f"{TTS_BASELINE_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, TTS_BASELINE_PATH)
+    logger.info(f"TTS baseline for '{lang}': {f0:.1f} Hz")
@@ -1,12 +1,16 @@
 import os
 import logging
-import requests
-import json
-import tempfile
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from gtts import gTTS
-import uuid
+from yandex_gpt import YandexGPTError, get_gpt_client
+from streaming import stream_reply
+from tts import text_to_speech, text_to_speech_chunked
+from tts_cache import get_tts_cache
+from conversation import get_conversation_memory
+from llm_cache import get_response_cache
+from lazy import report_startup
+from metrics import span, timed_handler
+from webhook import application_builder, run
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,22 +21,26 @@ logger = logging.getLogger('name')
 
 # Конфигурация
 TELEGRAM_TOKEN = os.getenv("TG_TOKEN")  # Замените на ваш токен Telegram бота
-YANDEX_API_KEY = os.getenv("YAGPT_TOKEN")  # Замените на ваш ключ API YandexGPT
-YANDEX_FOLDER_ID = os.getenv("FOLDER_ID")  # Замените на ваш folder_id из Yandex Cloud
+# Ключ API YandexGPT (YAGPT_TOKEN), folder_id (FOLDER_ID) и URL (YAGPT_URL)
+# клиент читает из окружения
 
 # Предварительный промпт для модели
 SYSTEM_PROMPT = """
 Ты профессиональный психолог на сеансе психотерапии. Помоги мне разобраться в моих чувствах, иногда задавай мне уточняющий вопрос. Отвечай сообщением короче 4 предложений.
 """  # Можете изменить на свой промпт
 
-# URL для запросов к YandexGPT
-YANDEX_GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+# Клиент YandexGPT с пулом соединений (один на процесс, общий для всех конвейеров)
+gpt_client = get_gpt_client()
+# Кэш ответов с коротким TTL и объединением одинаковых одновременных запросов
+responses = get_response_cache()
 
-# Создание временной директории для аудиофайлов
-TEMP_DIR = tempfile.mkdtemp()
+# Потоковый режим: ответ показывается по мере генерации (YAGPT_STREAM=0 отключает)
+STREAM_RESPONSES = os.getenv("YAGPT_STREAM", "1") == "1"
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
+    # Новая сессия начинается без памяти о предыдущей
+    get_conversation_memory().reset(update.effective_chat.id)
     await update.message.reply_text(
         "Привет! Я бот, который использует YandexGPT для ответов на ваши сообщения. "
         "Я буду отправлять как текстовые, так и голосовые сообщения. Просто напишите что-нибудь!"
@@ -44,17 +52,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "Просто отправьте мне текстовое сообщение, и я отвечу вам текстом и голосовым сообщением."
     )
 
-def text_to_speech(text, lang='ru'):
-    """Преобразует текст в речь и сохраняет в аудиофайл"""
-    # Создаем уникальное имя файла
-    filename = os.path.join(TEMP_DIR, f"audio_{uuid.uuid4()}.mp3")
-    
-    # Генерируем аудио из текста
-    tts = gTTS(text=text, lang=lang, slow=False)
-    tts.save(filename)
-    
-    return filename
+async def send_voice_reply(update: Update, speech):
+    """Отправляет голосовой ответ (повторные ответы - по file_id, без загрузки)"""
+    await get_tts_cache().send(update.message, speech, caption="Голосовой ответ")
 
+@timed_handler("psycho_1")
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик текстовых сообщений"""
     user_message = update.message.text
@@ -63,87 +65,77 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.chat.send_action(action="typing")
     
     try:
-        # Формирование заголовков для запроса
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Api-Key {YANDEX_API_KEY}",
-            "x-folder-id": YANDEX_FOLDER_ID
-        }
+        # Системный промпт, сводка и последние реплики разговора в пределах бюджета токенов
+        memory = get_conversation_memory()
+        chat_id = update.effective_chat.id
+        messages = memory.build_messages(chat_id, SYSTEM_PROMPT, user_message)
         
-        # Формирование тела запроса
-        payload = {
-            "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt-lite",  # Можно изменить на другую модель YandexGPT
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.6,
-                "maxTokens": 1000
-            },
-            "messages": [
-                {
-                    "role": "system",
-                    "text": SYSTEM_PROMPT
-                },
-                {
-                    "role": "user",
-                    "text": user_message
-                }
-            ]
-        }
+        if STREAM_RESPONSES:
+            # Текст появляется по мере генерации, готовые предложения сразу озвучиваются
+            bot_response = await stream_reply(
+                update.message,
+                responses.stream_complete(messages),
+                lambda sentence: get_tts_cache().synthesize(sentence, text_to_speech),
+                lambda speech: send_voice_reply(update, speech),
+            )
+            memory.remember(chat_id, user_message, bot_response)
+            return
         
-        # Отправка запроса к YandexGPT
-        response = requests.post(YANDEX_GPT_URL, headers=headers, json=payload)
+        # Запрос к YandexGPT через кэш ответов и общий клиент (keep-alive, таймауты, повторы)
+        bot_response = await responses.complete(messages)
+        memory.remember(chat_id, user_message, bot_response)
         
-        # Проверка успешности запроса
-        if response.status_code == 200:
-            # Парсинг ответа
-            response_json = response.json()
-            bot_response = response_json["result"]["alternatives"][0]["message"]["text"]
-            
-            # Отправка текстового ответа пользователю
+        # Отправка текстового ответа пользователю
+        with span("reply"):
             await update.message.reply_text(bot_response)
-            
-            # Озвучивание ответа
-            await update.message.chat.send_action(action="record_voice")
-            audio_file =text_to_speech(bot_response)
-            
-            # Отправка голосового сообщения
-            await update.message.reply_voice(
-                voice=open(audio_file, 'rb'),
-                caption="Голосовой ответ"
-            )
-            
-            # Удаление временного файла
-            try:
-                os.remove(audio_file)
-            except Exception as e:
-                logger.error(f"Ошибка при удалении аудиофайла: {e}")
-            
-        else:
-            logger.error(f"Ошибка API YandexGPT: {response.status_code}, {response.text}")
-            await update.message.reply_text(
-                "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
-            )
         
+        # Озвучивание ответа
+        await update.message.chat.send_action(action="record_voice")
+        speech = await get_tts_cache().synthesize(bot_response, text_to_speech_chunked)
+        
+        # Отправка голосового сообщения
+        await send_voice_reply(update, speech)
+        
+    except YandexGPTError as e:
+        logger.error(f"Ошибка API YandexGPT: {e}")
+        await update.message.reply_text(
+            "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+        )
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
         await update.message.reply_text(
             "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
         )
 
+async def post_init(application: Application) -> None:
+    """Отчет о времени запуска перед началом приема сообщений"""
+    report_startup("psycho_1")
+
+async def shutdown(application: Application) -> None:
+    """Закрывает соединения клиента YandexGPT при остановке бота"""
+    logger.info(f"LLM response cache: {responses.snapshot()}")
+    await gpt_client.aclose()
+
+def build_handlers() -> list:
+    """Обработчики бота (используются и отдельным ботом, и общим сервисом)"""
+    return [
+        # Обработчики команд
+        CommandHandler("start", start),
+        CommandHandler("help", help_command),
+        # Обработчик текстовых сообщений
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message),
+    ]
+
 def main() -> None:
     """Запуск бота"""
     # Создание приложения
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = application_builder().token(TELEGRAM_TOKEN).post_init(post_init).post_shutdown(shutdown).build()
 
-    # Добавление обработчиков команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    
-    # Добавление обработчика текстовых сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    # Добавление обработчиков
+    application.add_handlers(build_handlers())
 
     # Запуск бота
-    application.run_polling()
+    run(application)
 
 if __name__ == "__main__":
     main()
@@ -1,15 +1,19 @@
 import os
 import logging
-import requests
-import json
-import tempfile
-import uuid
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from gtts import gTTS
-import speech_recognition as sr
-from pydub import AudioSegment
-import io
+from audio_codec import download_voice
+from stt import STTError, SpeechNotRecognized, load_stt_backend, transcribe_stream
+from streaming import ThrottledMessage, stream_reply
+from yandex_gpt import YandexGPTError, get_gpt_client
+from tts import text_to_speech, text_to_speech_chunked
+from tts_cache import get_tts_cache
+from conversation import get_conversation_memory
+from llm_cache import get_response_cache
+from lazy import report_startup
+from metrics import span, timed_handler
+from scheduler import SchedulerRejected, get_scheduler
+from webhook import application_builder, run
 
 # Настройка логирования
 logging.basicConfig(
@@ -20,22 +24,26 @@ logger = logging.getLogger('name')
 
 # Конфигурация
 TELEGRAM_TOKEN = os.getenv("TG_TOKEN")  # Замените на ваш токен Telegram бота
-YANDEX_API_KEY = os.getenv("YAGPT_TOKEN")  # Замените на ваш ключ API YandexGPT
-YANDEX_FOLDER_ID = os.getenv("FOLDER_ID")  # Замените на ваш folder_id из Yandex Cloud
+# Ключ API YandexGPT (YAGPT_TOKEN), folder_id (FOLDER_ID) и URL (YAGPT_URL)
+# клиент читает из окружения
 
 # Предварительный промпт для модели
 SYSTEM_PROMPT = """
 Ты профессиональный психолог на сеансе психотерапии. Помоги мне разобраться в моих чувствах, иногда задавай мне уточняющий вопрос. Отвечай сообщением короче 4 предложений.
 """  # Можете изменить на свой промпт
 
-# URL для запросов к YandexGPT
-YANDEX_GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+# Клиент YandexGPT с пулом соединений (один на процесс, общий для всех конвейеров)
+gpt_client = get_gpt_client()
+# Кэш ответов с коротким TTL и объединением одинаковых одновременных запросов
+responses = get_response_cache()
 
-# Создание временной директории для аудиофайлов
-TEMP_DIR = tempfile.mkdtemp()
+# Потоковый режим: ответ показывается по мере генерации (YAGPT_STREAM=0 отключает)
+STREAM_RESPONSES = os.getenv("YAGPT_STREAM", "1") == "1"
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start"""
+    # Новая сессия начинается без памяти о предыдущей
+    get_conversation_memory().reset(update.effective_chat.id)
     await update.message.reply_text(
         "Привет! Я бот, который использует YandexGPT для ответов на ваши сообщения. "
         "Я могу принимать как текстовые, так и голосовые сообщения, "
@@ -50,53 +58,46 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "- Отправьте мне голосовое сообщение, я распознаю его и также отвечу в обоих форматах"
     )
 
-def text_to_speech(text, lang='ru'):
-    """Преобразует текст в речь и сохраняет в аудиофайл"""
-    # Создаем уникальное имя файла
-    filename = os.path.join(TEMP_DIR, f"audio_{uuid.uuid4()}.mp3")
-    
-    # Генерируем аудио из текста
-    tts = gTTS(text=text, lang=lang, slow=False)
-    tts.save(filename)
-    
-    return filename
+async def send_voice_reply(update: Update, speech):
+    """Отправляет голосовой ответ (повторные ответы - по file_id, без загрузки)"""
+    await get_tts_cache().send(update.message, speech)
 
+@timed_handler("psycho_2")
 async def process_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает голосовые сообщения"""
+    """Обрабатывает голосовые сообщения в очереди планировщика (справедливо между пользователями)"""
+    try:
+        await get_scheduler().run(
+            update.effective_user.id, update.effective_chat.id, lambda: recognize_and_reply(update)
+        )
+    except SchedulerRejected as e:
+        await update.message.reply_text(e.reply_text)
+
+async def recognize_and_reply(update: Update):
+    """Распознает голосовое сообщение и отвечает на распознанный текст"""
     # Получение информации о файле
     voice_file = await update.message.voice.get_file()
     
-    # Скачивание голосового сообщения
-    voice_ogg = os.path.join(TEMP_DIR, f"voice_{uuid.uuid4()}.ogg")
-    await voice_file.download_to_drive(voice_ogg)
-    
-    # Конвертирование из .ogg в .wav (для распознавания)
-    voice_wav = os.path.join(TEMP_DIR, f"voice_{uuid.uuid4()}.wav")
-    audio = AudioSegment.from_file(voice_ogg, format="ogg")
-    audio.export(voice_wav, format="wav")
+    # Скачивание голосового сообщения в память
+    voice_ogg = await download_voice(voice_file)
     
-    # Распознавание речи
-    r = sr.Recognizer()
-    with sr.AudioFile(voice_wav) as source:
-        audio_data = r.record(source)
-        try:
-            # Определяем язык автоматически или можно задать конкретный язык
-            user_message = r.recognize_google(audio_data, language="ru-RU")
-            # Сообщаем пользователю, что мы распознали
-            await update.message.reply_text(f"Я распознал: {user_message}")
-            # Обрабатываем распознанный текст
-            await process_text_query(update, user_message)
-        except sr.UnknownValueError:
-            await update.message.reply_text("Извините, я не смог распознать ваше сообщение.")
-        except sr.RequestError as e:
-            await update.message.reply_text(f"Ошибка при распознавании речи: {str(e)}")
-    
-    # Удаление временных файлов
+    # Распознавание речи (движок выбирается через STT_BACKEND)
+    recognized = ThrottledMessage(update.message)
     try:
-        os.remove(voice_ogg)
-        os.remove(voice_wav)
-    except Exception as e:
-        logger.error(f"Ошибка при удалении временных файлов: {e}")
+        user_message = ""
+        async for user_message, final in transcribe_stream(voice_ogg, language="ru-RU"):
+            # Промежуточные результаты показываем, пока запись еще распознается
+            if not final:
+                await recognized.update(f"Распознаю: {user_message}…")
+        # Сообщаем пользователю, что мы распознали
+        await recognized.update(f"Я распознал: {user_message}", force=True)
+    except SpeechNotRecognized:
+        await update.message.reply_text("Извините, я не смог распознать ваше сообщение.")
+        return
+    except STTError as e:
+        await update.message.reply_text(f"Ошибка при распознавании речи: {str(e)}")
+        return
+    # Обрабатываем распознанный текст
+    await process_text_query(update, user_message)
 
 async def process_text_query(update: Update, user_message):
     """Обрабатывает текстовый запрос и генерирует ответ от YandexGPT"""
@@ -104,94 +105,90 @@ async def process_text_query(update: Update, user_message):
     await update.message.chat.send_action(action="typing")
     
     try:
-        # Формирование заголовков для запроса
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Api-Key {YANDEX_API_KEY}",
-            "x-folder-id": YANDEX_FOLDER_ID
-        }
+        # Системный промпт, сводка и последние реплики разговора в пределах бюджета токенов
+        memory = get_conversation_memory()
+        chat_id = update.effective_chat.id
+        messages = memory.build_messages(chat_id, SYSTEM_PROMPT, user_message)
         
-        # Формирование тела запроса
-        payload = {
-            "modelUri": f"gpt://{YANDEX_FOLDER_ID}/yandexgpt-lite",  # Можно изменить на другую модель YandexGPT
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.6,
-                "maxTokens": 1000
-            },
-            "messages": [
-                {
-                    "role": "system",
-                    "text": SYSTEM_PROMPT
-                },
-                {
-                    "role": "user",
-                    "text": user_message
-                }
-            ]
-        }
+        if STREAM_RESPONSES:
+            # Текст появляется по мере генерации, готовые предложения сразу озвучиваются
+            bot_response = await stream_reply(
+                update.message,
+                responses.stream_complete(messages),
+                lambda sentence: get_tts_cache().synthesize(sentence, text_to_speech),
+                lambda speech: send_voice_reply(update, speech),
+            )
+            memory.remember(chat_id, user_message, bot_response)
+            return
         
-        # Отправка запроса к YandexGPT
-        response = requests.post(YANDEX_GPT_URL, headers=headers, json=payload)
+        # Запрос к YandexGPT через кэш ответов и общий клиент (keep-alive, таймауты, повторы)
+        bot_response = await responses.complete(messages)
+        memory.remember(chat_id, user_message, bot_response)
         
-        # Проверка успешности запроса
-        if response.status_code == 200:
-            # Парсинг ответа
-            response_json = response.json()
-            bot_response = response_json["result"]["alternatives"][0]["message"]["text"]
-            
-            # Отправка текстового ответа пользователю
+        # Отправка текстового ответа пользователю
+        with span("reply"):
             await update.message.reply_text(bot_response)
-            
-            # Озвучивание ответа
-            await update.message.chat.send_action(action="record_voice")
-            audio_file = text_to_speech(bot_response)
-            
-            # Отправка голосового сообщения
-            await update.message.reply_voice(
-                voice=open(audio_file, 'rb')
-            )
-            
-            # Удаление временного файла
-            try:
-                os.remove(audio_file)
-            except Exception as e:
-                logger.error(f"Ошибка при удалении аудиофайла: {e}")
-            
-        else:
-            logger.error(f"Ошибка API YandexGPT: {response.status_code}, {response.text}")
-            await update.message.reply_text(
-                "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
-            )
         
+        # Озвучивание ответа
+        await update.message.chat.send_action(action="record_voice")
+        speech = await get_tts_cache().synthesize(bot_response, text_to_speech_chunked)
+        
+        # Отправка голосового сообщения
+        await send_voice_reply(update, speech)
+        
+    except YandexGPTError as e:
+        logger.error(f"Ошибка API YandexGPT: {e}")
+        await update.message.reply_text(
+            "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+        )
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
         await update.message.reply_text(
             "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
         )
 
+@timed_handler("psycho_2")
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик текстовых сообщений"""
     user_message = update.message.text
     await process_text_query(update, user_message)
 
+# Подготовка, которая выполняется в фоне после запуска (модель распознавания)
+BACKGROUND_STARTUP = [load_stt_backend]
+
+async def post_init(application: Application) -> None:
+    """Загружает модель распознавания в фоне и пишет отчет о времени запуска"""
+    for startup in BACKGROUND_STARTUP:
+        application.create_task(startup())
+    report_startup("psycho_2")
+
+async def shutdown(application: Application) -> None:
+    """Закрывает соединения клиента YandexGPT при остановке бота"""
+    logger.info(f"LLM response cache: {responses.snapshot()}")
+    await gpt_client.aclose()
+
+def build_handlers() -> list:
+    """Обработчики бота (используются и отдельным ботом, и общим сервисом)"""
+    return [
+        # Обработчики команд
+        CommandHandler("start", start),
+        CommandHandler("help", help_command),
+        # Обработчик текстовых сообщений
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message),
+        # Обработчик голосовых сообщений
+        MessageHandler(filters.VOICE, process_voice_message),
+    ]
+
 def main() -> None:
     """Запуск бота"""
     # Создание приложения
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = application_builder().token(TELEGRAM_TOKEN).post_init(post_init).post_shutdown(shutdown).build()
 
-    # Добавление обработчиков команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    
-    # Обработчик текстовых сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-    
-    # Обработчик голосовых сообщений
-    application.add_handler(MessageHandler(filters.VOICE, process_voice_message))
+    # Добавление обработчиков
+    application.add_handlers(build_handlers())
 
     # Запуск бота
-    application.run_polling()
+    run(application)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,307 @@
+"""Планировщик тяжелых задач (обработка голосовых сообщений) перед конвейерами.
+
+- у каждого пользователя ограничены число одновременно выполняемых задач
+  и частота новых (token bucket);
+- свободные места отдаются пользователям по кругу, поэтому один пользователь,
+  переславший двадцать голосовых, не задерживает остальных;
+- задачи одного чата, еще ожидающие в очереди, объединяются в одну
+  (обработчик получает их списком и может обработать вместе);
+- если в очереди уже SCHED_MAX_QUEUE задач, новые отклоняются сразу
+  с ответом «попробуйте позже», а не ухудшают задержку всем;
+- обработчиков, ждущих результата run(), не больше SCHED_MAX_INLINE: каждый
+  держит место обработки обновлений, и часть мест остается остальным.
+
+Задачи одного чата выполняются строго по порядку. При остановке процесса
+принятые задачи дорабатывают (drain, до SCHED_DRAIN_TIMEOUT секунд).
+"""
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from collections import OrderedDict, deque
+from metrics import current_pipeline, get_metrics, span
+
+logger = logging.getLogger('scheduler')
+
+# Сколько задач выполняется одновременно (всего)
+SCHED_WORKERS = int(os.getenv("SCHED_WORKERS", "8"))
+# Сколько задач одного пользователя выполняется одновременно
+SCHED_USER_CONCURRENCY = int(os.getenv("SCHED_USER_CONCURRENCY", "1"))
+# Сколько задач пользователь может поставить в минуту и сколько подряд (всплеск)
+SCHED_USER_RATE = float(os.getenv("SCHED_USER_RATE", "12"))
+SCHED_USER_BURST = int(os.getenv("SCHED_USER_BURST", "6"))
+# Глубина очереди, после которой новые задачи отклоняются
+SCHED_MAX_QUEUE = int(os.getenv("SCHED_MAX_QUEUE", "100"))
+# Сколько обработчиков могут одновременно ждать результата run() (в очереди и
+# во время выполнения). Каждый такой обработчик занимает одно из CONCURRENT_UPDATES
+# мест обработки обновлений (webhook), поэтому значение должно быть меньше:
+# CONCURRENT_UPDATES - SCHED_MAX_INLINE мест всегда остаются для остальных
+# обновлений, в том числе для быстрых submit() других конвейеров сервиса
+SCHED_MAX_INLINE = int(os.getenv("SCHED_MAX_INLINE", "32"))
+# Сколько ожидающих задач одного чата объединяется в одну
+SCHED_COALESCE_MAX = int(os.getenv("SCHED_COALESCE_MAX", "5"))
+# Сколько ждать выполнения принятых задач при остановке, секунды
+SCHED_DRAIN_TIMEOUT = float(os.getenv("SCHED_DRAIN_TIMEOUT", "30"))
+# Сколько пользователей помнить для ограничения частоты
+SCHED_MAX_USERS = 10000
+
+class SchedulerRejected(Exception):
+    """Задача не принята; reply_text - ответ пользователю."""
+
+    reply_text = "Сейчас не получается обработать сообщение, попробуйте позже."
+
+class QueueFull(SchedulerRejected):
+    """Очередь переполнена (сброс нагрузки)."""
+
+    reply_text = "Сейчас много запросов, попробуйте, пожалуйста, через пару минут."
+
+class RateLimited(SchedulerRejected):
+    """Пользователь превысил частоту задач."""
+
+    reply_text = "Слишком много сообщений подряд, подождите немного и отправьте еще раз."
+
+class TokenBucket:
+    """Ограничение частоты: rate задач в секунду, не больше capacity подряд."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class _Batch:
+    """Ожидающая задача: одна или несколько объединенных задач одного чата."""
+
+    __slots__ = ("user_id", "chat_id", "key", "runner", "items", "enqueued", "context", "pipeline", "cancelled")
+
+    def __init__(self, user_id, chat_id, key, runner, item):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        # Объединяются только задачи с одинаковым ключом (None - никогда)
+        self.key = key
+        self.runner = runner
+        self.items = [item]
+        self.enqueued = time.monotonic()
+        # Контекст постановки (конвейер для метрик) сохраняется и для выполнения
+        self.context = contextvars.copy_context()
+        self.pipeline = current_pipeline()
+        self.cancelled = False
+
+class JobScheduler:
+    """Очередь задач с ограничениями по пользователям и справедливым обходом."""
+
+    def __init__(self, workers=SCHED_WORKERS, user_concurrency=SCHED_USER_CONCURRENCY,
+                 user_rate=SCHED_USER_RATE, user_burst=SCHED_USER_BURST,
+                 max_queue=SCHED_MAX_QUEUE, coalesce_max=SCHED_COALESCE_MAX, max_inline=SCHED_MAX_INLINE):
+        self.workers = workers
+        self.user_concurrency = user_concurrency
+        self.user_rate = user_rate / 60
+        self.user_burst = user_burst
+        self.max_queue = max_queue
+        self.coalesce_max = coalesce_max
+        self.max_inline = max_inline
+        # Пользователь -> очередь его задач; порядок ключей - порядок обхода
+        self._queues = OrderedDict()
+        self._buckets = {}
+        self._running_users = {}
+        self._running_chats = set()
+        # Выполняющиеся задачи asyncio: без ссылки на них задача может быть удалена сборщиком мусора
+        self._tasks = set()
+        self.pending = 0
+        self.running = 0
+        # Обработчики, ожидающие результата run()
+        self.inline = 0
+        self.stats = {
+            "accepted": 0, "coalesced": 0, "rejected_busy": 0, "rejected_rate": 0,
+            "completed": 0, "failed": 0,
+        }
+
+    def _bucket(self, user_id):
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= SCHED_MAX_USERS:
+                # Полные корзины ничего не ограничивают, их можно забыть
+                for key in [key for key, value in self._buckets.items() if value.full]:
+                    del self._buckets[key]
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    def _admit(self, user_id):
+        if self.pending >= self.max_queue:
+            self.stats["rejected_busy"] += 1
+            raise QueueFull()
+        if not self._bucket(user_id).take():
+            self.stats["rejected_rate"] += 1
+            raise RateLimited()
+        self.stats["accepted"] += 1
+
+    def _enqueue(self, batch):
+        self._queues.setdefault(batch.user_id, deque()).append(batch)
+        self.pending += 1
+        self._dispatch()
+
+    def submit(self, user_id, chat_id, key, item, runner):
+        """Ставит задачу в очередь и сразу возвращается.
+
+        runner(items) - корутина, выполняющая задачи. Если последняя ожидающая
+        задача этого чата имеет тот же key, item добавляется к ней, и runner
+        получит все объединенные items по порядку. Бросает SchedulerRejected.
+        """
+        self._admit(user_id)
+        queue = self._queues.get(user_id, ())
+        last = next((batch for batch in reversed(queue) if batch.chat_id == chat_id), None)
+        if (last is not None and key is not None and last.key == key
+                and len(last.items) < self.coalesce_max):
+            last.items.append(item)
+            self.pending += 1
+            self.stats["coalesced"] += 1
+            return
+        self._enqueue(_Batch(user_id, chat_id, key, runner, item))
+
+    async def run(self, user_id, chat_id, func):
+        """Выполняет корутину func() в свою очередь и возвращает ее результат.
+
+        Для обработчиков, которым результат нужен сразу (без объединения).
+        Ожидающий обработчик держит место обработки обновлений, поэтому таких
+        одновременно не больше max_inline. Бросает SchedulerRejected.
+        """
+        if self.inline >= self.max_inline:
+            self.stats["rejected_busy"] += 1
+            raise QueueFull()
+        self._admit(user_id)
+        future = asyncio.get_running_loop().create_future()
+
+        async def runner(items):
+            # Ошибку обрабатывает тот, кто ждет результат
+            try:
+                result = await func()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                return
+            if not future.done():
+                future.set_result(result)
+
+        batch = _Batch(user_id, chat_id, None, runner, None)
+        self.inline += 1
+        try:
+            self._enqueue(batch)
+            return await future
+        except asyncio.CancelledError:
+            # Обработка отменена, пока задача ждала очереди - выполнять ее уже не нужно
+            batch.cancelled = True
+            raise
+        finally:
+            self.inline -= 1
+
+    def _next_batch(self):
+        """Следующая задача по кругу пользователей: первая задача, чей чат сейчас не занят."""
+        for user_id, queue in list(self._queues.items()):
+            if self._running_users.get(user_id, 0) >= self.user_concurrency:
+                continue
+            for batch in queue:
+                if batch.chat_id in self._running_chats:
+                    continue
+                queue.remove(batch)
+                # Пользователь уходит в конец круга
+                del self._queues[user_id]
+                if queue:
+                    self._queues[user_id] = queue
+                return batch
+        return None
+
+    def _dispatch(self):
+        while self.running < self.workers:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self.pending -= len(batch.items)
+            if batch.cancelled:
+                continue
+            self.running += 1
+            self._running_users[batch.user_id] = self._running_users.get(batch.user_id, 0) + 1
+            self._running_chats.add(batch.chat_id)
+            get_metrics().observe("queue_wait", time.monotonic() - batch.enqueued, batch.pipeline)
+            task = asyncio.create_task(self._execute(batch), context=batch.context)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, batch):
+        try:
+            with span("job"):
+                await batch.runner(batch.items)
+            self.stats["completed"] += 1
+        except Exception as e:
+            self.stats["failed"] += 1
+            logger.error(f"Job for chat {batch.chat_id} failed: {e!r}")
+        finally:
+            self.running -= 1
+            self._running_users[batch.user_id] -= 1
+            if not self._running_users[batch.user_id]:
+                del self._running_users[batch.user_id]
+            self._running_chats.discard(batch.chat_id)
+            self._dispatch()
+
+    async def drain(self, timeout=SCHED_DRAIN_TIMEOUT):
+        """Дожидается выполнения всех принятых задач (при остановке процесса).
+
+        Задачи submit() уже подтверждены Telegram, и без ожидания перезапуск их
+        потерял бы. Возвращает True, если все задачи выполнены за timeout секунд.
+        """
+        deadline = time.monotonic() + timeout
+        # Ожидающие задачи запускаются по мере завершения выполняющихся
+        while self._tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.wait(set(self._tasks), timeout=remaining)
+        if self._tasks or self.pending:
+            logger.warning(
+                f"Scheduler drain timed out: {self.running} running, {self.pending} pending jobs are lost"
+            )
+            return False
+        return True
+
+    def snapshot(self):
+        """Состояние очереди для мониторинга."""
+        return {
+            **self.stats,
+            "pending": self.pending,
+            "running": self.running,
+            "inline": self.inline,
+            "users_waiting": len(self._queues),
+        }
+
+# Общий планировщик на процесс
+_scheduler = None
+
+def get_scheduler() -> JobScheduler:
+    """Возвращает общий планировщик задач (общий для всех конвейеров сервиса)."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler()
+        metrics = get_metrics()
+        metrics.gauge("scheduler_pending", lambda: _scheduler.pending)
+        metrics.gauge("scheduler_running", lambda: _scheduler.running)
+        metrics.gauge("scheduler_rejected", lambda: _scheduler.stats["rejected_busy"] + _scheduler.stats["rejected_rate"])
+    return _scheduler
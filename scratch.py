@@ -0,0 +1,243 @@
+"""Рабочее пространство для промежуточных аудиоданных, которые все же должны
+существовать вне памяти процесса.
+
+Таких данных два вида:
+- сегменты разделяемой памяти, через которые массивы передаются в процессы
+  пула обработки сигнала (dsp_pool);
+- временные файлы сторонних библиотек в процессах пула (все, что они
+  создают через tempfile).
+
+Все они размещаются в памяти (tmpfs, /dev/shm), а не на диске, имена содержат
+pid процесса-владельца, и на сегменты каждому процессу отведена квота в байтах. При
+выходе процесс удаляет свое; то, что осталось после аварийно завершенных
+процессов (или слишком старое), удаляет фоновый уборщик в основном процессе.
+
+Настройка через переменные окружения:
+    SCRATCH_ROOT           - каталог временных файлов (по умолчанию /dev/shm/voicebot_scratch)
+    SCRATCH_QUOTA_MB       - квота на процесс, МБ (по умолчанию 256)
+    SCRATCH_SWEEP_INTERVAL - период уборки, секунды (по умолчанию 60, 0 - не убирать)
+    SCRATCH_MAX_AGE        - возраст, после которого файл считается брошенным (по умолчанию 600)
+"""
+import os
+import time
+import atexit
+import shutil
+import logging
+import tempfile
+import threading
+from multiprocessing import shared_memory, util
+
+logger = logging.getLogger('scratch')
+
+# Каталог сегментов разделяемой памяти в Linux (tmpfs)
+SHM_DIR = "/dev/shm"
+
+def _default_root():
+    base = SHM_DIR if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK) else tempfile.gettempdir()
+    return os.path.join(base, "voicebot_scratch")
+
+SCRATCH_ROOT = os.getenv("SCRATCH_ROOT") or _default_root()
+SCRATCH_QUOTA_BYTES = int(float(os.getenv("SCRATCH_QUOTA_MB", "256")) * 1024 * 1024)
+SCRATCH_SWEEP_INTERVAL = float(os.getenv("SCRATCH_SWEEP_INTERVAL", "60"))
+SCRATCH_MAX_AGE = float(os.getenv("SCRATCH_MAX_AGE", "600"))
+
+# Префикс имен сегментов разделяемой памяти: vbs_<pid>_<номер>
+SHM_PREFIX = "vbs_"
+
+class ScratchQuotaExceeded(Exception):
+    """Процесс исчерпал квоту рабочего пространства."""
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _owner_pid(name, prefix=""):
+    """pid процесса-владельца из имени вида <prefix><pid>[_...] (None, если имя чужое)."""
+    if not name.startswith(prefix):
+        return None
+    pid = name[len(prefix):].split("_", 1)[0]
+    return int(pid) if pid.isdigit() else None
+
+class ScratchSpace:
+    """Рабочее пространство процесса: каталог root/<pid> и сегменты разделяемой
+    памяти с общей квотой quota байт.
+    """
+
+    def __init__(self, root=SCRATCH_ROOT, quota=SCRATCH_QUOTA_BYTES):
+        self.root = root
+        self.quota = quota
+        self.pid = os.getpid()
+        self.used = 0
+        self.peak = 0
+        self.rejected = 0
+        self._counter = 0
+        # Созданные и еще не удаленные сегменты: имя -> размер в счет квоты
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        """Каталог временных файлов процесса (создается при первом обращении)."""
+        path = os.path.join(self.root, str(self.pid))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _take(self, nbytes):
+        with self._lock:
+            if self.used + nbytes > self.quota:
+                self.rejected += 1
+                raise ScratchQuotaExceeded(
+                    f"Scratch quota exceeded: {self.used} + {nbytes} > {self.quota} bytes"
+                )
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+
+    def _give_back(self, nbytes):
+        with self._lock:
+            self.used -= nbytes
+
+    def create_shared(self, nbytes):
+        """Новый сегмент разделяемой памяти в счет квоты. Бросает ScratchQuotaExceeded."""
+        nbytes = max(nbytes, 1)
+        self._take(nbytes)
+        with self._lock:
+            self._counter += 1
+            name = f"{SHM_PREFIX}{self.pid}_{self._counter}"
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=nbytes)
+        except BaseException:
+            self._give_back(nbytes)
+            raise
+        with self._lock:
+            self._segments[shm.name] = nbytes
+        return shm
+
+    def release_shared(self, shm):
+        """Закрывает и удаляет сегмент, возвращая его размер в квоту."""
+        shm.close()
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            logger.warning(f"Shared memory segment {shm.name} already removed")
+        with self._lock:
+            self.used -= self._segments.pop(shm.name, 0)
+
+    def cleanup(self):
+        """Удаляет все, что осталось от процесса (вызывается при выходе)."""
+        if os.getpid() != self.pid:
+            return
+        with self._lock:
+            segments, self._segments = self._segments, {}
+        for name in segments:
+            _unlink_segment(name)
+        shutil.rmtree(os.path.join(self.root, str(self.pid)), ignore_errors=True)
+
+    def snapshot(self):
+        """Состояние квоты для мониторинга."""
+        return {
+            "used": self.used, "peak": self.peak, "quota": self.quota,
+            "segments": len(self._segments), "rejected": self.rejected,
+        }
+
+def _unlink_segment(name):
+    try:
+        os.remove(os.path.join(SHM_DIR, name))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Failed to remove shared memory segment {name}: {e}")
+
+def _remove(path):
+    """Удаляет файл или каталог, возвращает освобожденные байты."""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            size = sum(
+                os.path.getsize(os.path.join(dirpath, name))
+                for dirpath, _, names in os.walk(path) for name in names
+            )
+            shutil.rmtree(path)
+            return size
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logger.warning(f"Failed to remove scratch {path}: {e}")
+        return 0
+
+def sweep(root=SCRATCH_ROOT, max_age=SCRATCH_MAX_AGE):
+    """Удаляет брошенное: каталоги и сегменты завершившихся процессов, а также
+    файлы старше max_age секунд. Возвращает (число удаленных, освобождено байт).
+    """
+    removed, freed = 0, 0
+    deadline = time.time() - max_age
+    if os.path.isdir(root):
+        for entry in os.scandir(root):
+            pid = _owner_pid(entry.name)
+            if pid is not None and not _pid_alive(pid):
+                freed += _remove(entry.path)
+                removed += 1
+                continue
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            for dirpath, _, names in os.walk(entry.path):
+                for name in names:
+                    path = os.path.join(dirpath, name)
+                    try:
+                        stale = os.path.getmtime(path) < deadline
+                    except FileNotFoundError:
+                        continue
+                    if stale:
+                        freed += _remove(path)
+                        removed += 1
+    if os.path.isdir(SHM_DIR):
+        for entry in os.scandir(SHM_DIR):
+            pid = _owner_pid(entry.name, SHM_PREFIX)
+            if pid is not None and not _pid_alive(pid):
+                freed += _remove(entry.path)
+                removed += 1
+    if removed:
+        logger.info(f"Scratch sweep: removed {removed} orphaned entries, {freed} bytes")
+    return removed, freed
+
+# Рабочее пространство текущего процесса
+_scratch = None
+_scratch_lock = threading.Lock()
+
+def get_scratch() -> ScratchSpace:
+    """Возвращает рабочее пространство текущего процесса (удаляется при выходе)."""
+    global _scratch
+    with _scratch_lock:
+        if _scratch is None or _scratch.pid != os.getpid():
+            _scratch = ScratchSpace()
+            # Процессы пула завершаются без atexit, но с финализаторами multiprocessing
+            atexit.register(_scratch.cleanup)
+            util.Finalize(None, _scratch.cleanup, exitpriority=10)
+        return _scratch
+
+# Поток уборщика (один на процесс)
+_sweeper = None
+
+def start_sweeper(interval=SCRATCH_SWEEP_INTERVAL):
+    """Запускает фоновую уборку брошенных файлов и сегментов (в основном процессе)."""
+    global _sweeper
+    if _sweeper is not None or interval <= 0:
+        return _sweeper
+
+    def loop():
+        while True:
+            try:
+                sweep()
+            except Exception as e:
+                logger.warning(f"Scratch sweep failed: {e}")
+            time.sleep(interval)
+
+    _sweeper = threading.Thread(target=loop, name="scratch-sweeper", daemon=True)
+    _sweeper.start()
+    return _sweeper
@@ -0,0 +1,201 @@
+"""Единый сервис: несколько конвейеров (ботов) в одном процессе и одном Application.
+
+Конвейеры - модули ботов (main, psycho_1, psycho_2, speech_to_speech_librosa,
+speech_to_speech_modificator). Все они используют один HTTP-клиент Telegram,
+один клиент YandexGPT, один пул исполнителей и один кэш синтеза речи.
+
+Настройка через переменные окружения:
+    SERVICE_PIPELINES - какие конвейеры поднимать (через запятую, по умолчанию все)
+    SERVICE_DEFAULT   - конвейер по умолчанию (по умолчанию первый из списка)
+    SERVICE_ROUTES    - привязка чатов: "chat_id:конвейер,chat_id:конвейер"
+
+Пользователь может переключить свой чат командой /use <конвейер>,
+список доступных конвейеров - /pipelines.
+"""
+import os
+import logging
+import importlib
+from telegram import Update
+from telegram.ext import Application, BaseHandler, CommandHandler, ContextTypes
+from workers import get_pool
+from yandex_gpt import get_gpt_client
+from lazy import report_startup
+from scheduler import get_scheduler
+from webhook import application_builder, run
+
+# Настройка логирования (одна на весь сервис)
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger('service')
+
+TELEGRAM_TOKEN = os.getenv("TG_TOKEN")
+
+# Все известные конвейеры: имя -> модуль
+PIPELINES = {
+    "stt": "main",
+    "psycho": "psycho_1",
+    "psycho_voice": "psycho_2",
+    "voice_clone": "speech_to_speech_librosa",
+    "voice_effects": "speech_to_speech_modificator",
+}
+
+def _parse_routes(value):
+    """Разбирает SERVICE_ROUTES вида "chat_id:конвейер,..." в словарь."""
+    routes = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        chat_id, _, name = item.rpartition(":")
+        routes[int(chat_id)] = name.strip()
+    return routes
+
+class Router:
+    """Выбирает конвейер для чата: выбор пользователя, затем привязка из настроек,
+    затем конвейер по умолчанию.
+    """
+
+    def __init__(self, pipelines, default=None, chat_routes=None):
+        self.pipelines = list(pipelines)
+        if not self.pipelines:
+            raise ValueError("Не задано ни одного конвейера")
+        self.default = default or self.pipelines[0]
+        self.chat_routes = dict(chat_routes or {})
+        for name in [self.default, *self.chat_routes.values()]:
+            if name not in self.pipelines:
+                raise ValueError(f"Неизвестный конвейер: {name}")
+        # Выбор пользователей через /use (хранится в памяти процесса)
+        self.selected = {}
+
+    @classmethod
+    def from_env(cls):
+        names = os.getenv("SERVICE_PIPELINES", ",".join(PIPELINES))
+        pipelines = [name.strip() for name in names.split(",") if name.strip()]
+        return cls(
+            pipelines,
+            default=os.getenv("SERVICE_DEFAULT") or None,
+            chat_routes=_parse_routes(os.getenv("SERVICE_ROUTES", "")),
+        )
+
+    def resolve(self, chat_id):
+        """Возвращает имя конвейера, обслуживающего чат."""
+        if chat_id in self.selected:
+            return self.selected[chat_id]
+        return self.chat_routes.get(chat_id, self.default)
+
+    def select(self, chat_id, name):
+        """Переключает чат на другой конвейер."""
+        if name not in self.pipelines:
+            raise ValueError(f"Неизвестный конвейер: {name}")
+        if name == self.chat_routes.get(chat_id, self.default):
+            self.selected.pop(chat_id, None)
+        else:
+            self.selected[chat_id] = name
+
+class RoutedHandler(BaseHandler):
+    """Обертка над обработчиком конвейера: пропускает только обновления из чатов,
+    которые маршрутизированы на этот конвейер.
+    """
+
+    def __init__(self, handler, router, pipeline):
+        # У ConversationHandler нет callback, обработку все равно выполняет handler
+        super().__init__(getattr(handler, "callback", None), block=handler.block)
+        self.handler = handler
+        self.router = router
+        self.pipeline = pipeline
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or update.effective_chat is None:
+            return None
+        if self.router.resolve(update.effective_chat.id) != self.pipeline:
+            return None
+        return self.handler.check_update(update)
+
+    async def handle_update(self, update, application, check_result, context):
+        return await self.handler.handle_update(update, application, check_result, context)
+
+    def collect_additional_context(self, context, update, application, check_result):
+        self.handler.collect_additional_context(context, update, application, check_result)
+
+def load_pipelines(names):
+    """Импортирует модули конвейеров (тяжелые библиотеки в них загружаются лениво)."""
+    modules = {}
+    for name in names:
+        if name not in PIPELINES:
+            raise ValueError(f"Неизвестный конвейер: {name}")
+        modules[name] = importlib.import_module(PIPELINES[name])
+    return modules
+
+def build_application(router=None, token=None) -> Application:
+    """Собирает одно приложение со всеми конвейерами из маршрутизатора."""
+    router = router or Router.from_env()
+    modules = load_pipelines(router.pipelines)
+
+    async def use_pipeline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Переключает чат на другой конвейер: /use <конвейер>."""
+        name = context.args[0] if context.args else ""
+        try:
+            router.select(update.effective_chat.id, name)
+        except ValueError:
+            await update.message.reply_text(
+                f"Использование: /use <конвейер>. Доступны: {', '.join(router.pipelines)}"
+            )
+            return
+        await update.message.reply_text(f"Чат переключен на «{name}». Отправьте /start.")
+
+    async def list_pipelines(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Показывает доступные конвейеры и текущий выбор."""
+        current = router.resolve(update.effective_chat.id)
+        lines = [f"{'-> ' if name == current else '   '}{name}" for name in router.pipelines]
+        await update.message.reply_text("Конвейеры:\n" + "\n".join(lines))
+
+    async def post_init(application: Application) -> None:
+        # Один пул процессов на все конвейеры: предзагрузка объединяется
+        preload, warmups = [], []
+        for module in modules.values():
+            preload += getattr(module, "DSP_PRELOAD", [])
+            warmups += getattr(module, "DSP_WARMUPS", [])
+        if preload or warmups:
+            await get_pool().start_dsp(preload=preload, warmups=warmups, background=True)
+        # Фоновая подготовка конвейеров (например, загрузка модели распознавания) - один раз
+        startups = []
+        for module in modules.values():
+            startups += [startup for startup in getattr(module, "BACKGROUND_STARTUP", []) if startup not in startups]
+        for startup in startups:
+            application.create_task(startup())
+        logger.info(f"Pipelines: {router.pipelines}, default: {router.default}, chat routes: {router.chat_routes}")
+        report_startup("service")
+
+    async def post_shutdown(application: Application) -> None:
+        # Фоновые задачи используют клиент GPT и пул процессов - сначала дожидаемся их
+        await get_scheduler().drain()
+        shutdowns = []
+        for module in modules.values():
+            shutdowns += [shutdown for shutdown in getattr(module, "SHUTDOWN", []) if shutdown not in shutdowns]
+        for shutdown in shutdowns:
+            await shutdown()
+        await get_gpt_client().aclose()
+        get_pool().shutdown(wait=False)
+
+    application = (
+        application_builder()
+        .token(token or TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Команды сервиса обрабатываются раньше обработчиков конвейеров
+    application.add_handlers([
+        CommandHandler("use", use_pipeline),
+        CommandHandler("pipelines", list_pipelines),
+    ])
+    for name, module in modules.items():
+        application.add_handlers([RoutedHandler(handler, router, name) for handler in module.build_handlers()])
+    return application
+
+def main() -> None:
+    """Запуск сервиса."""
+    run(build_application())
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 import os
+import asyncio
 import logging
-import tempfile
-import numpy as np
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -11,10 +10,21 @@ from telegram.ext import (
     ConversationHandler,
     filters,
 )
-from gtts import gTTS
-import librosa
-import soundfile as sf
-import pyrubberband as pyrb
+from workers import get_pool, run_io, run_cpu
+from audio_codec import decode, download_voice, encode_opus
+from tts import text_to_speech_chunked
+from tts_cache import Speech, get_tts_cache, make_key
+from voice_profiles import get_voice_profiles
+from lazy import lazy_import, report_startup
+from metrics import span, timed_handler
+from scheduler import SchedulerRejected, get_scheduler
+from webhook import application_builder, run
+
+# Тяжелые библиотеки загружаются при первом использовании
+# (в процессах обработки сигнала - заранее, при прогреве пула)
+np = lazy_import("numpy")
+librosa = lazy_import("librosa")
+pitch = lazy_import("pitch")
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,89 +36,185 @@ logger = logging.getLogger('logger')
 # Состояния для ConversationHandler
 VOICE, TEXT = range(2)
 
-# Словарь для хранения голосовых образцов пользователей
-user_voice_samples = {}
-user_voice_features = {}  # Для хранения характеристик голоса
+# Характеристики голоса пользователей хранятся в voice_profiles (переживают перезапуск),
+# сами образцы на диск не сохраняются
+
+# Модули и функции прогрева для процессов обработки сигнала
+DSP_PRELOAD = ["librosa", "pitch"]
+DSP_WARMUPS = ["dsp_pool:warm_librosa", "dsp_pool:warm_pitch"]
+
+# Передискретизация при сдвиге высоты тона (librosa res_type): soxr_mq по качеству
+# не отличается от soxr_hq по умолчанию и немного быстрее (bench_pitch_shift.py)
+PITCH_SHIFT_RES_TYPE = os.getenv("PITCH_SHIFT_RES_TYPE", "soxr_mq")
+
+# Откалиброванная высота тона голоса gTTS (определяется один раз на процесс)
+tts_baseline_f0 = None
+tts_baseline_lock = asyncio.Lock()
+
+def analyze_voice(y, sr):
+    """Извлекает характеристики образца голоса (выполняется в пуле процессов).
+
+    Возвращает (секунды вокализованной речи, средняя f0, дисперсия f0, темп):
+    их накапливает профиль голоса, старые образцы повторно не анализируются.
+    """
+    # Извлекаем тональные характеристики
+    # Используем f0 (основная частота) для определения высоты голоса,
+    # движок выбирается через PITCH_ENGINE (по умолчанию быстрый YIN)
+    voiced_seconds, mean_f0, var_f0 = pitch.f0_stats(y, sr)
+    
+    # Определяем темп
+    onset_env = librosa.onset.onset_strength(y=y, sr=sr)
+    tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
+    
+    return voiced_seconds, mean_f0, var_f0, float(np.atleast_1d(tempo)[0])
+
+def shift_to_voice(y, sr, user_f0, tts_f0):
+    """Сдвигает высоту тона синтезированной речи к голосу пользователя (выполняется в пуле процессов)."""
+    # Вычисляем разницу в высоте тона между образцом и синтезом.
+    # Голос gTTS почти не меняется, поэтому используется откалиброванная заранее высота тона
+    # Конвертируем в полутоны (semitones)
+    pitch_diff = 12 * np.log2(user_f0 / tts_f0)
+    
+    # Изменяем высоту тона фазовым вокодером librosa в этом же процессе, без временных файлов
+    y_shifted = librosa.effects.pitch_shift(y, sr=sr, n_steps=pitch_diff, res_type=PITCH_SHIFT_RES_TYPE)
+    
+    # Можем также изменить темп, если нужно
+    # tempo_ratio = voice_features['tempo'] / 120.0  # 120 BPM считаем "стандартным" темпом
+    # y_modified = librosa.effects.time_stretch(y_shifted, rate=tempo_ratio)
+    
+    # Для простоты используем только изменение высоты тона
+    y_modified = y_shifted
+    
+    return y_modified, pitch_diff
+
+async def calibrate_tts_baseline(lang='ru'):
+    """Оценивает среднюю высоту тона голоса gTTS по эталонной фразе."""
+    audio = await text_to_speech_chunked(pitch.CALIBRATION_TEXT, lang)
+    y, sr = await run_io("codec", decode, audio)
+    # 200 Гц - стандартное значение для синтезированной речи
+    return await run_cpu("dsp", pitch.estimate_mean_f0, y, sr, 200.0)
+
+async def get_tts_baseline(lang='ru'):
+    """Возвращает высоту тона голоса gTTS: из файла калибровки или калибрует один раз."""
+    global tts_baseline_f0
+    if tts_baseline_f0 is None:
+        async with tts_baseline_lock:
+            if tts_baseline_f0 is None:
+                baseline = pitch.load_tts_baseline(lang)
+                if baseline is None:
+                    baseline = await calibrate_tts_baseline(lang)
+                    pitch.save_tts_baseline(lang, baseline)
+                tts_baseline_f0 = baseline
+    return tts_baseline_f0
+
+async def synthesize_in_voice(text, user_f0):
+    """Озвучивает текст и сдвигает высоту тона к голосу пользователя, возвращает ogg/opus."""
+    # Генерируем базовую речь с помощью Google TTS (повторяющиеся фразы берутся из кэша)
+    speech = await get_tts_cache().synthesize(text, text_to_speech_chunked, reuse_file_id=False)
+    
+    # Декодируем mp3 в массив для обработки
+    with span("decode"):
+        y, sr = await run_io("codec", decode, speech.audio)
+    
+    # Модифицируем синтезированную речь в пуле процессов
+    tts_mean_f0 = await get_tts_baseline()
+    with span("dsp"):
+        y_modified, pitch_diff = await run_cpu("dsp", shift_to_voice, y, sr, user_f0, tts_mean_f0)
+    
+    logger.info(f"Pitch difference: {pitch_diff} semitones (user: {user_f0}, tts: {tts_mean_f0})")
+    
+    # Кодируем в ogg/opus для Telegram
+    with span("encode"):
+        return await run_io("codec", encode_opus, y_modified, sr)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало разговора и запрос голосового сообщения."""
+    profile = get_voice_profiles().get(update.effective_user.id)
+    if profile is not None and profile.confident:
+        await update.message.reply_text(
+            "Привет! Я бот, который озвучивает ваш текст в стиле вашего голоса.\n"
+            "Ваш голос мне уже знаком - отправьте текст, который хотите озвучить."
+        )
+        return TEXT
     await update.message.reply_text(
         "Привет! Я бот, который попытается озвучить ваш текст в стиле вашего голоса.\n"
         "Сначала отправьте мне голосовое сообщение, чтобы я мог проанализировать характеристики вашего голоса."
     )
     return VOICE
 
+async def analyze_voice_message(voice_file):
+    """Скачивает образец голоса и возвращает его характеристики (analyze_voice)."""
+    # Скачиваем голосовое сообщение в память и декодируем для анализа
+    ogg_bytes = await download_voice(voice_file)
+    with span("decode"):
+        y, sr = await run_io("codec", decode, ogg_bytes)
+    
+    # Анализируем характеристики голоса в пуле процессов
+    with span("dsp"):
+        return await run_cpu("dsp", analyze_voice, y, sr)
+
+def state_after_sample(user_id) -> int:
+    """Состояние после неучтенного образца: с готовым профилем можно продолжать озвучку."""
+    return TEXT if get_voice_profiles().get(user_id) is not None else VOICE
+
+@timed_handler("speech_to_speech_librosa")
 async def voice_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка голосового сообщения."""
     user_id = update.effective_user.id
     
-    # Создаем временный файл для голосового сообщения
+    # Получаем файл голосового сообщения
     voice_file = await update.message.voice.get_file()
     
-    voice_sample_file = tempfile.NamedTemporaryFile(delete=False, suffix='.ogg')
-    voice_sample_path = voice_sample_file.name
-    voice_sample_file.close()
-    
-    # Скачиваем голосовое сообщение
-    await voice_file.download_to_drive(voice_sample_path)
-    
-    # Конвертируем в WAV для анализа
-    wav_path = voice_sample_path.replace('.ogg', '.wav')
-    os.system(f'ffmpeg -i {voice_sample_path} {wav_path} -y')
-    
     try:
-        # Анализируем характеристики голоса
-        y, sr = librosa.load(wav_path, sr=None)
-        
-        # Извлекаем тональные характеристики
-        # Используем f0 (основная частота) для определения высоты голоса
-        f0, voiced_flag, voiced_probs = librosa.pyin(
-            y, 
-            fmin=librosa.note_to_hz('C2'), 
-            fmax=librosa.note_to_hz('C7'),
-            sr=sr
+        # Анализ - тяжелая задача, она ждет своей очереди в планировщике
+        voiced_seconds, mean_f0, var_f0, tempo = await get_scheduler().run(
+            user_id, update.effective_chat.id, lambda: analyze_voice_message(voice_file)
         )
-        # Отфильтровываем NaN значения и усредняем
-        f0_clean = f0[~np.isnan(f0)]
-        if len(f0_clean) > 0:
-            mean_f0 = np.mean(f0_clean)
-        else:
-            mean_f0 = 100  # Значение по умолчанию, если не удалось определить высоту голоса
-        
-        # Определяем темп
-        onset_env = librosa.onset.onset_strength(y=y, sr=sr)
-        tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
-        
-        # Сохраняем характеристики для пользователя
-        user_voice_features[user_id] = {
-            'mean_f0': mean_f0,
-            'tempo': tempo
-        }
+        if not voiced_seconds:
+            await update.message.reply_text(
+                "Не удалось расслышать голос в этом сообщении. Пожалуйста, запишите образец еще раз."
+            )
+            return state_after_sample(user_id)
         
-        # Сохраняем путь к образцу голоса
-        user_voice_samples[user_id] = wav_path
+        # Добавляем образец к профилю пользователя (сам образец не храним)
+        profile = get_voice_profiles().add_sample(user_id, voiced_seconds, mean_f0, var_f0, tempo)
         
-        logger.info(f"Voice analysis for user {user_id}: f0={mean_f0}, tempo={tempo}")
-        
-        await update.message.reply_text(
-            "Отлично! Я проанализировал ваш голос. "
-            "Теперь отправьте текст, который вы хотите озвучить."
+        logger.info(
+            f"Voice sample for user {user_id}: f0={mean_f0:.1f}, voiced={voiced_seconds:.1f}s; "
+            f"profile f0={profile.mean_f0:.1f}±{profile.f0_std:.1f}, samples={profile.samples}, "
+            f"confidence={profile.confidence:.2f}"
         )
+        
+        if profile.confident:
+            await update.message.reply_text(
+                "Отлично! Я проанализировал ваш голос. "
+                "Теперь отправьте текст, который вы хотите озвучить."
+            )
+        else:
+            await update.message.reply_text(
+                f"Образец учтен (уверенность {profile.confidence:.0%}). "
+                "Можно уже отправить текст для озвучки, а еще одно голосовое сообщение сделает голос точнее."
+            )
         return TEXT
+    except SchedulerRejected as e:
+        await update.message.reply_text(e.reply_text)
+        return state_after_sample(user_id)
     except Exception as e:
         logger.error(f"Ошибка при анализе голоса: {e}")
         await update.message.reply_text(
             "Произошла ошибка при анализе вашего голоса. Пожалуйста, попробуйте снова или отправьте другой образец."
         )
-        return VOICE
+        return state_after_sample(user_id)
 
+@timed_handler("speech_to_speech_librosa")
 async def text_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка текста и генерация озвученного сообщения."""
     user_id = update.effective_user.id
     text = update.message.text
     
     #Проверяем, есть ли данные о голосе пользователя
-    if user_id not in user_voice_features:
+    profile = get_voice_profiles().get(user_id)
+    if profile is None:
         await update.message.reply_text(
             "Я не нашел данных о вашем голосе. Пожалуйста, начните сначала с команды /start."
         )
@@ -117,83 +223,31 @@ async def text_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     await update.message.reply_text("Генерирую голосовое сообщение, пожалуйста, подождите...")
     
     try:
-        # Создаем временные файлы
-        tts_output = tempfile.NamedTemporaryFile(delete=False, suffix='.mp3')
-        tts_output_path = tts_output.name
-        tts_output.close()
-        
-        modified_output = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-        modified_output_path = modified_output.name
-        modified_output.close()
-        
-        final_output = tempfile.NamedTemporaryFile(delete=False, suffix='.ogg')
-        final_output_path = final_output.name
-        final_output.close()
-        
-        # Генерируем базовую речь с помощью Google TTS
-        tts = gTTS(text=text, lang='ru', slow=False)
-        tts.save(tts_output_path)
-        
-        # Конвертируем mp3 в wav для обработки
-        temp_wav = tts_output_path.replace('.mp3', '_temp.wav')
-        os.system(f'ffmpeg -i {tts_output_path} {temp_wav} -y')
-        
-        # Загружаем аудио и модифицируем его в соответствии с характеристиками голоса пользователя
-        y, sr = librosa.load(temp_wav, sr=None)
-        
-        # Получаем характеристики голоса пользователя
-        voice_features = user_voice_features[user_id]
-        
-        # Анализируем текущий синтезированный голос
-        f0, voiced_flag, voiced_probs = librosa.pyin(
-            y, 
-            fmin=librosa.note_to_hz('C2'), 
-            fmax=librosa.note_to_hz('C7'),
-            sr=sr
-        )
-        f0_clean = f0[~np.isnan(f0)]
-        if len(f0_clean) > 0:
-            tts_mean_f0 = np.mean(f0_clean)
-        else:
-            tts_mean_f0 = 200  # Стандартное значение для синтезированной речи
-        
-        # Вычисляем разницу в высоте тона между образцом и синтезом
-        # Конвертируем в полутоны (semitones) для pyrubberband
-        pitch_diff = 12 * np.log2(voice_features['mean_f0'] / tts_mean_f0)
-        
-        logger.info(f"Pitch difference: {pitch_diff} semitones (user: {voice_features['mean_f0']}, tts: {tts_mean_f0})")
-        
-        # Используем pyrubberband для изменения высоты тона
-        y_shifted = pyrb.pitch_shift(y, sr, pitch_diff)
-        
-        # Можем также изменить темп, если нужно
-        # tempo_ratio = voice_features['tempo'] / 120.0  # 120 BPM считаем "стандартным" темпом
-        # y_modified = pyrb.time_stretch(y_shifted, sr, tempo_ratio)
+        tts_cache = get_tts_cache()
         
-        # Для простоты используем только изменение высоты тона
-        y_modified = y_shifted
+        # Если этот текст уже озвучивался таким голосом, результат берется из кэша
+        voice_key = make_key(text, 'ru', mean_f0=round(profile.mean_f0, 1))
+        file_id = tts_cache.get_file_id(voice_key)
+        audio = None if file_id else await run_io("tts", tts_cache.get, voice_key)
+        if file_id is None and audio is None:
+            # Синтез и сдвиг высоты тона ждут своей очереди в планировщике
+            audio = await get_scheduler().run(
+                user_id, update.effective_chat.id,
+                lambda: synthesize_in_voice(text, profile.mean_f0),
+            )
+            await run_io("tts", tts_cache.put, voice_key, audio)
         
-        # Сохраняем модифицированное аудио
-        sf.write(modified_output_path, y_modified, sr)
-        
-        # Конвертируем в формат ogg для Telegram
-        os.system(f'ffmpeg -i {modified_output_path} -c:a libopus {final_output_path} -y')
-        
-        # Отправляем аудио пользователю
-        await update.message.reply_voice(voice=open(final_output_path, 'rb'))
-        
-        # Очищаем временные файлы
-        for path in [tts_output_path, temp_wav, modified_output_path, final_output_path]:
-            try:
-                os.unlink(path)
-            except:
-                pass
+        # Отправляем аудио пользователю (повторно - по file_id, без загрузки)
+        await tts_cache.send(update.message, Speech(voice_key, audio=audio, file_id=file_id))
         
         await update.message.reply_text(
             "Готово! Отправьте еще текст, чтобы озвучить его, или /start чтобы начать заново с другим голосом."
         )
         return TEXT
         
+    except SchedulerRejected as e:
+        await update.message.reply_text(e.reply_text)
+        return TEXT
     except Exception as e:
         logger.error(f"Ошибка при генерации речи: {e}")
         await update.message.reply_text(
@@ -206,39 +260,43 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     
     # Удаляем данные пользователя
-    if user_id in user_voice_samples:
-        try:
-            os.unlink(user_voice_samples[user_id])
-            del user_voice_samples[user_id]
-        except:
-            pass
-    
-    if user_id in user_voice_features:
-        del user_voice_features[user_id]
+    get_voice_profiles().delete(user_id)
     
     await update.message.reply_text("Операция отменена. До свидания!")
     return ConversationHandler.END
 
-def main() -> None:
-    """Запуск бота."""
-    # Создаем приложение и добавляем обработчики
-    TG_TOKEN = os.getenv("TG_TOKEN")
-    application = Application.builder().token(TG_TOKEN).build()
-    
+async def post_init(application: Application) -> None:
+    """Запускает прогрев процессов обработки сигнала в фоне, не задерживая прием сообщений."""
+    await get_pool().start_dsp(preload=DSP_PRELOAD, warmups=DSP_WARMUPS, background=True)
+    report_startup("speech_to_speech_librosa")
+
+def build_handlers() -> list:
+    """Обработчики бота (используются и отдельным ботом, и общим сервисом)."""
     # Настраиваем разговорный обработчик с состояниями
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
             VOICE: [MessageHandler(filters.VOICE, voice_received)],
-            TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, text_received)],
+            # Новые образцы голоса принимаются и после первого: профиль уточняется
+            TEXT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, text_received),
+                MessageHandler(filters.VOICE, voice_received),
+            ],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
+    return [conv_handler]
+
+def main() -> None:
+    """Запуск бота."""
+    # Создаем приложение и добавляем обработчики
+    TG_TOKEN = os.getenv("TG_TOKEN")
+    application = application_builder().token(TG_TOKEN).post_init(post_init).build()
     
-    application.add_handler(conv_handler)
+    application.add_handlers(build_handlers())
     
     # Запускаем бота
-    application.run_polling()
+    run(application)
 
 if __name__ == "__main__":
     main()
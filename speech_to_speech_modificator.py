@@ -1,83 +1,110 @@
 import os
-import tempfile
+import asyncio
+import logging
 from pathlib import Path
-import numpy as np
-import torch
-import torchaudio
-import torchaudio.transforms as T
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import CommandHandler, ContextTypes, MessageHandler, filters
+from workers import get_pool, run_io
+from audio_codec import decode, download_voice, encode_opus
+from lazy import report_startup
+from voice_effects import get_effects_batcher
+from metrics import span, timed_handler
+from scheduler import SCHED_DRAIN_TIMEOUT, SchedulerRejected, get_scheduler
+from webhook import application_builder, run
+
+logger = logging.getLogger('speech_to_speech_modificator')
 
 # Настройка API токена Telegram бота
 TELEGRAM_TOKEN = os.getenv("TG_TOKEN")
 
+# Модули и функции прогрева для процессов обработки сигнала:
+# torch/torchaudio загружаются только там, основной процесс бота их не импортирует
+DSP_PRELOAD = ["torch", "torchaudio", "voice_effects"]
+DSP_WARMUPS = ["dsp_pool:warm_torchaudio"]
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет сообщение при команде /start."""
     await update.message.reply_text('Привет! Отправь мне голосовое сообщение, и я изменю голос.')
 
+@timed_handler("speech_to_speech_modificator")
 async def process_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает голосовые сообщения."""
+    """Ставит голосовое сообщение в очередь обработки."""
+    try:
+        get_scheduler().submit(
+            update.effective_user.id, update.effective_chat.id, "voice_effects", update.message, modify_voices
+        )
+    except SchedulerRejected as e:
+        await update.message.reply_text(e.reply_text)
+        return
     # Уведомление о начале обработки
     await update.message.reply_text("Обрабатываю ваше голосовое сообщение...")
+
+async def modify_voice(message):
+    """Изменяет голос в одном сообщении, возвращает ogg/opus."""
+    # Скачиваем голосовое сообщение в память и декодируем в массив
+    voice_message = await message.voice.get_file()
+    ogg_bytes = await download_voice(voice_message)
+    with span("decode"):
+        y, sample_rate = await run_io("codec", decode, ogg_bytes)
     
-    # Создаем временные файлы для обработки
-    with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as voice_file, \
-         tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as wav_file, \
-         tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as output_wav_file, \
-         tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as output_voice_file:
-        
-        voice_file_path = voice_file.name
-        wav_file_path = wav_file.name
-        output_wav_path = output_wav_file.name
-        output_voice_path = output_voice_file.name
-    
-    # Скачиваем голосовое сообщение
-    voice_message = await update.message.voice.get_file()
-    await voice_message.download_to_drive(voice_file_path)
-    
-    # Конвертируем .ogg в .wav для обработки
-    os.system(f"ffmpeg -i {voice_file_path} {wav_file_path} -y")
-    
-    # Загружаем аудиофайл с помощью torchaudio
-    waveform, sample_rate = torchaudio.load(wav_file_path)
+    # Изменяем голос в пуле процессов (вместе с другими сообщениями, пришедшими одновременно);
+    # результат уже на частоте Opus
+    with span("dsp"):
+        y_modified, modified_rate = await get_effects_batcher().process(y, sample_rate)
     
-    # Изменяем голос (в этом примере используем изменение высоты)
-    effects = [
-        ["pitch", "100"],  # Изменение высоты голоса
-        ["rate", "44100"],  # Установка частоты дискретизации
+    # Кодируем в формат .ogg/opus для отправки в Telegram
+    with span("encode"):
+        return await run_io("codec", encode_opus, y_modified, modified_rate)
+
+async def modify_voices(messages) -> None:
+    """Обрабатывает голосовые сообщения одного чата (выполняется планировщиком).
+
+    Сообщения, пришедшие пачкой, обрабатываются одновременно (эффекты - одним
+    пакетом), а ответы отправляются в исходном порядке.
+    """
+    results = await asyncio.gather(*(modify_voice(message) for message in messages), return_exceptions=True)
+    for message, voice in zip(messages, results):
+        if isinstance(voice, Exception):
+            logger.error(f"Ошибка при изменении голоса: {voice!r}")
+            await message.reply_text("Не удалось обработать голосовое сообщение, попробуйте еще раз.")
+            continue
+        # Отправляем обработанное голосовое сообщение обратно
+        with span("upload"):
+            await message.reply_voice(voice=voice)
+
+def build_handlers() -> list:
+    """Обработчики бота (используются и отдельным ботом, и общим сервисом)."""
+    return [
+        CommandHandler("start", start),
+        MessageHandler(filters.VOICE, process_voice),
     ]
-    
-    # Применяем эффекты
-    transformed_waveform, transformed_sample_rate = torchaudio.sox_effects.apply_effects_tensor(
-        waveform, sample_rate, effects
-    )
-    
-    # Сохраняем преобразованный файл
-    torchaudio.save(output_wav_path, transformed_waveform, transformed_sample_rate)
-    
-    # Конвертируем обратно в формат .ogg для отправки в Telegram
-    os.system(f"ffmpeg -i {output_wav_path} -c:a libopus {output_voice_path} -y")
-    
-    # Отправляем обработанное голосовое сообщение обратно
-    await update.message.reply_voice(voice=open(output_voice_path, 'rb'))
-    
-    # Удаляем временные файлы
-    for file_path in [voice_file_path, wav_file_path, output_wav_path, output_voice_path]:
-        try:
-            os.unlink(file_path)
-        except:
-            pass
+
+async def post_init(application) -> None:
+    """Запускает прогрев процессов обработки сигнала в фоне, не задерживая прием сообщений."""
+    await get_pool().start_dsp(preload=DSP_PRELOAD, warmups=DSP_WARMUPS, background=True)
+    report_startup("speech_to_speech_modificator")
+
+async def drain_effects() -> None:
+    """Дожидается пакетов изменения голоса, отправленных в пул до остановки."""
+    await get_effects_batcher().drain(SCHED_DRAIN_TIMEOUT)
+
+# Вызываются при остановке, после ожидания задач планировщика и до остановки пула процессов
+SHUTDOWN = [drain_effects]
+
+async def post_shutdown(application) -> None:
+    for shutdown in SHUTDOWN:
+        await shutdown()
+    get_pool().shutdown(wait=False)
 
 def main() -> None:
     """Запускает бота."""
     # Создаем приложение и добавляем обработчики
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    application = application_builder().token(TELEGRAM_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.VOICE, process_voice))
+    application.add_handlers(build_handlers())
     
     # Запускаем бота
-    application.run_polling()
+    run(application)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,105 @@
+import os
+import re
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger('streaming')
+
+# Минимальный интервал между правками сообщения (Telegram ограничивает частоту правок)
+EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Конец предложения: знаки препинания, закрывающие кавычки/скобки и пробел
+SENTENCE_END = re.compile(r'[.!?…]+["»)]*\s+')
+
+def split_sentences(text, start=0, final=False):
+    """Возвращает законченные предложения из text[start:] и позицию, до которой текст разобран.
+
+    Если final=True, остаток текста тоже считается предложением.
+    """
+    sentences = []
+    pos = start
+    for match in SENTENCE_END.finditer(text, start):
+        sentence = text[pos:match.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        pos = match.end()
+    if final and text[pos:].strip():
+        sentences.append(text[pos:].strip())
+        pos = len(text)
+    return sentences, pos
+
+class ThrottledMessage:
+    """Сообщение Telegram, которое правится по мере поступления текста, но не чаще interval.
+
+    message - уже отправленное сообщение, которое нужно править (иначе оно будет
+    отправлено ответом на reply_to при первом обновлении).
+    """
+
+    def __init__(self, reply_to, interval=EDIT_INTERVAL, message=None):
+        self.reply_to = reply_to
+        self.interval = interval
+        self.message = message
+        self.text = ""
+        self.last_edit = 0.0
+
+    async def update(self, text, force=False):
+        """Показывает новый текст: первое обновление отправляет сообщение, следующие его правят."""
+        if not text.strip() or text == self.text:
+            return
+        now = time.monotonic()
+        if self.message is None:
+            self.message = await self.reply_to.reply_text(text)
+        elif force or now - self.last_edit >= self.interval:
+            await self.message.edit_text(text)
+        else:
+            return
+        self.text = text
+        self.last_edit = now
+
+async def _send_in_order(queue, send_voice):
+    """Отправляет результаты синтеза в порядке предложений."""
+    while True:
+        task = await queue.get()
+        if task is None:
+            return
+        await send_voice(await task)
+
+async def stream_reply(message, chunks, synthesize, send_voice, edit_interval=EDIT_INTERVAL):
+    """Показывает ответ по мере генерации и озвучивает его по предложениям.
+
+    chunks - асинхронный итератор накопленного текста ответа,
+    synthesize(sentence) - корутина синтеза речи для одного предложения,
+    send_voice(result) - корутина отправки результата синтеза.
+    Каждое законченное предложение синтезируется сразу, пока модель генерирует
+    следующие, а голосовые сообщения отправляются строго по порядку.
+    Возвращает полный текст ответа.
+    """
+    reply = ThrottledMessage(message, edit_interval)
+    queue = asyncio.Queue()
+    sender = asyncio.create_task(_send_in_order(queue, send_voice))
+    text, pos = "", 0
+
+    def speak(sentences):
+        for sentence in sentences:
+            queue.put_nowait(asyncio.create_task(synthesize(sentence)))
+
+    try:
+        async for text in chunks:
+            await reply.update(text)
+            sentences, pos = split_sentences(text, pos)
+            speak(sentences)
+        # Финальная правка без ограничения частоты и озвучивание хвоста
+        await reply.update(text, force=True)
+        sentences, pos = split_sentences(text, pos, final=True)
+        speak(sentences)
+        queue.put_nowait(None)
+        await sender
+    except BaseException:
+        sender.cancel()
+        while not queue.empty():
+            task = queue.get_nowait()
+            if task is not None:
+                task.cancel()
+        raise
+    return text
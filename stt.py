@@ -0,0 +1,276 @@
+"""Распознавание речи с подключаемыми движками.
+
+STT_BACKEND выбирает движок:
+    google - бесплатный endpoint Google (speech_recognition), нужен доступ в сеть
+    vosk   - локальная модель Vosk на CPU (VOSK_MODEL_PATH), с промежуточными результатами
+
+Модель Vosk загружается один раз на процесс и используется всеми потоками пула.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from workers import run_io
+from audio_codec import decode_with_source, to_pcm16
+from vad import split_on_silence
+import stt_preprocess
+from lazy import lazy_import
+from metrics import current_pipeline, get_metrics, span
+
+sr = lazy_import("speech_recognition")
+vosk = lazy_import("vosk")
+
+logger = logging.getLogger('stt')
+
+STT_BACKEND = os.getenv("STT_BACKEND", "google")
+STT_LANGUAGE = os.getenv("STT_LANGUAGE", "ru-RU")
+# Частота, на которой работают обе модели распознавания
+STT_SAMPLE_RATE = 16000
+VOSK_MODEL_PATH = os.getenv("VOSK_MODEL_PATH", "models/vosk-model-small-ru-0.22")
+# Размер порции, подаваемой в распознаватель (чаще порции - чаще промежуточные результаты)
+VOSK_CHUNK_SECONDS = float(os.getenv("VOSK_CHUNK_SECONDS", "0.5"))
+# Сколько сегментов одной длинной записи распознается одновременно
+STT_PARALLEL_SEGMENTS = int(os.getenv("STT_PARALLEL_SEGMENTS", "4"))
+
+# speech_recognition работает с 16-битным моно PCM
+PCM_SAMPLE_WIDTH = 2
+
+class STTError(Exception):
+    """Ошибка сервиса или модели распознавания."""
+
+class SpeechNotRecognized(STTError):
+    """В записи не удалось распознать речь."""
+
+class STTBackend(ABC):
+    """Интерфейс движка распознавания. Методы блокирующие, вызываются в пуле потоков."""
+
+    name = "base"
+
+    def load(self):
+        """Загружает модель заранее (по умолчанию загружать нечего)."""
+
+    @abstractmethod
+    def recognize(self, y, sample_rate, language=STT_LANGUAGE):
+        """Возвращает распознанный текст моно float32 сигнала."""
+
+    def recognize_stream(self, y, sample_rate, language=STT_LANGUAGE):
+        """Отдает пары (текст, окончательный ли результат).
+
+        Движки без промежуточных результатов отдают одну окончательную пару.
+        """
+        yield self.recognize(y, sample_rate, language), True
+
+class GoogleSTT(STTBackend):
+    """Распознавание через бесплатный endpoint Google (speech_recognition)."""
+
+    name = "google"
+
+    def recognize(self, y, sample_rate, language=STT_LANGUAGE):
+        audio = sr.AudioData(to_pcm16(y), sample_rate, PCM_SAMPLE_WIDTH)
+        try:
+            return sr.Recognizer().recognize_google(audio, language=language)
+        except sr.UnknownValueError as e:
+            raise SpeechNotRecognized("Речь не распознана") from e
+        except sr.RequestError as e:
+            raise STTError(str(e)) from e
+
+class VoskSTT(STTBackend):
+    """Локальное распознавание моделью Vosk: без сети, с промежуточными результатами.
+
+    Язык определяется моделью (VOSK_MODEL_PATH), параметр language не используется.
+    """
+
+    name = "vosk"
+
+    # Модели общие для всех экземпляров в процессе: путь -> модель
+    _models = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model_path=VOSK_MODEL_PATH, chunk_seconds=VOSK_CHUNK_SECONDS):
+        self.model_path = model_path
+        self.chunk_seconds = chunk_seconds
+
+    def load(self):
+        with self._lock:
+            model = self._models.get(self.model_path)
+            if model is None:
+                if not os.path.isdir(self.model_path):
+                    raise STTError(f"Модель Vosk не найдена: {self.model_path}")
+                try:
+                    vosk.SetLogLevel(-1)
+                except ImportError as e:
+                    raise STTError("Для STT_BACKEND=vosk нужен пакет vosk") from e
+                model = self._models[self.model_path] = vosk.Model(self.model_path)
+                logger.info(f"Vosk model loaded from {self.model_path}")
+            return model
+
+    def recognize(self, y, sample_rate, language=STT_LANGUAGE):
+        text = ""
+        for text, final in self.recognize_stream(y, sample_rate, language):
+            pass
+        return text
+
+    def recognize_stream(self, y, sample_rate, language=STT_LANGUAGE):
+        model = self.load()
+        recognizer = vosk.KaldiRecognizer(model, sample_rate)
+        pcm = to_pcm16(y)
+        step = int(sample_rate * self.chunk_seconds) * PCM_SAMPLE_WIDTH
+        phrases = []
+        for start in range(0, len(pcm), step):
+            if recognizer.AcceptWaveform(pcm[start:start + step]):
+                phrases.append(json.loads(recognizer.Result()).get("text", ""))
+                partial = ""
+            else:
+                partial = json.loads(recognizer.PartialResult()).get("partial", "")
+            text = " ".join(filter(None, [*phrases, partial]))
+            if text:
+                yield text, False
+        phrases.append(json.loads(recognizer.FinalResult()).get("text", ""))
+        text = " ".join(filter(None, phrases))
+        if not text:
+            raise SpeechNotRecognized("Речь не распознана")
+        yield text, True
+
+BACKENDS = {backend.name: backend for backend in (GoogleSTT, VoskSTT)}
+
+# Общий движок на процесс
+_backend = None
+
+def get_stt_backend() -> STTBackend:
+    """Возвращает движок распознавания, выбранный через STT_BACKEND."""
+    global _backend
+    if _backend is None:
+        if STT_BACKEND not in BACKENDS:
+            raise STTError(f"Неизвестный движок распознавания: {STT_BACKEND}")
+        _backend = BACKENDS[STT_BACKEND]()
+        logger.info(f"STT backend: {_backend.name}")
+        # Сколько PCM ушло бы в распознавание без подготовки и сколько уходит
+        metrics = get_metrics()
+        metrics.gauge("stt_bytes_in", lambda: stt_preprocess.stats["bytes_in"])
+        metrics.gauge("stt_bytes_out", lambda: stt_preprocess.stats["bytes_out"])
+        metrics.gauge("stt_seconds_in", lambda: round(stt_preprocess.stats["seconds_in"], 3))
+        metrics.gauge("stt_seconds_out", lambda: round(stt_preprocess.stats["seconds_out"], 3))
+    return _backend
+
+async def load_stt_backend():
+    """Загружает модель распознавания заранее, чтобы первое сообщение не ждало ее."""
+    backend = get_stt_backend()
+    try:
+        await run_io("stt", backend.load)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить модель распознавания: {e}")
+
+async def _stream_backend(backend, y, sample_rate, language):
+    """Промежуточные и окончательный результаты движка для одного сегмента."""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    pipeline = current_pipeline()
+
+    def produce():
+        # Выполняется в пуле потоков, результаты передаются в event loop по мере появления.
+        # Время распознавания меряется здесь: ожидание правок сообщения в него не входит
+        started = time.perf_counter()
+        try:
+            for item in backend.recognize_stream(y, sample_rate, language):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except Exception as e:
+            get_metrics().error("stt", e, pipeline)
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+        finally:
+            get_metrics().observe("stt", time.perf_counter() - started, pipeline)
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    producer = asyncio.ensure_future(run_io("stt", produce))
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        await producer
+
+def _join_segments(texts):
+    """Текст сегментов по порядку; еще не распознанные обозначаются многоточием."""
+    parts = []
+    for text in texts:
+        part = "…" if text is None else text
+        if part and not (part == "…" and parts and parts[-1] == "…"):
+            parts.append(part)
+    return " ".join(parts)
+
+async def _recognize_segments(backend, y, sample_rate, segments, language):
+    """Распознает сегменты параллельно и отдает текст по мере готовности сегментов."""
+    texts = [None] * len(segments)
+    semaphore = asyncio.Semaphore(STT_PARALLEL_SEGMENTS)
+
+    async def recognize(index, start, end):
+        async with semaphore:
+            try:
+                with span("stt_segment"):
+                    text = await run_io("stt", backend.recognize, y[start:end], sample_rate, language)
+            except SpeechNotRecognized:
+                text = ""
+        return index, text
+
+    tasks = [asyncio.ensure_future(recognize(i, start, end)) for i, (start, end) in enumerate(segments)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, texts[index] = await next_done
+            if None in texts:
+                yield _join_segments(texts), False
+    finally:
+        for task in tasks:
+            task.cancel()
+    text = _join_segments(texts)
+    if not text:
+        raise SpeechNotRecognized("Речь не распознана")
+    yield text, True
+
+async def transcribe_stream(audio, language=STT_LANGUAGE, backend=None):
+    """Распознает голосовое сообщение (OGG/MP3/WAV в памяти).
+
+    Запись приводится к моно STT_SAMPLE_RATE, тишина по краям обрезается,
+    уровень нормализуется (stt_preprocess). Длинные записи делятся по паузам
+    на сегменты (vad), которые распознаются параллельно. Отдает пары
+    (текст, окончательный ли результат); последняя пара окончательная.
+    """
+    backend = backend or get_stt_backend()
+    with span("decode"):
+        # Параметры исходной записи нужны только для статистики stt_preprocess
+        y, sample_rate, source_rate, source_channels = await run_io(
+            "codec", decode_with_source, audio, STT_SAMPLE_RATE
+        )
+    with span("preprocess"):
+        y = await run_io("codec", stt_preprocess.prepare, y, sample_rate, source_rate, source_channels)
+    if not len(y):
+        # В записи нет речи - сервис распознавания не вызывается
+        raise SpeechNotRecognized("Речь не распознана")
+    with span("vad"):
+        segments = await run_io("codec", split_on_silence, y, sample_rate)
+    if len(segments) > 1:
+        logger.info(f"STT: {len(y) / sample_rate:.1f}s split into {len(segments)} segments")
+        results = _recognize_segments(backend, y, sample_rate, segments, language)
+    else:
+        results = _stream_backend(backend, y, sample_rate, language)
+    try:
+        async for item in results:
+            yield item
+    finally:
+        await results.aclose()
+
+async def transcribe(audio, language=STT_LANGUAGE, backend=None):
+    """Распознает голосовое сообщение целиком и возвращает текст."""
+    text = ""
+    async for text, final in transcribe_stream(audio, language, backend):
+        pass
+    return text
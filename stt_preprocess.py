@@ -0,0 +1,99 @@
+"""Подготовка записи к распознаванию речи: сервису отправляется только нужное.
+
+Голосовое сообщение Telegram - Opus 48 кГц; распознавателю достаточно моно
+16 кГц (это делает декодирование в stt), а тишина в начале и в конце записи
+только увеличивает запрос и время распознавания. Здесь запись обрезается
+по речи и приводится к одному уровню громкости. Все операции векторные
+(numpy), без проходов по отсчетам в Python.
+
+Сколько байт PCM ушло бы в распознавание без подготовки (исходные частота и
+число каналов, вся запись) и сколько уходит теперь, накапливается в stats.
+
+Настройка через переменные окружения:
+    STT_TRIM        - обрезать тишину в начале и в конце (по умолчанию 1)
+    STT_TRIM_PAD    - сколько тишины оставить вокруг речи, секунды (по умолчанию 0.2)
+    STT_TARGET_DBFS - уровень речи после нормализации, дБ (по умолчанию -20, пусто - не менять)
+    STT_MAX_GAIN_DB - максимальное усиление тихих записей, дБ (по умолчанию 20)
+"""
+import os
+import logging
+import threading
+from vad import VAD_FRAME_SECONDS, frame_levels, speech_frames
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+logger = logging.getLogger('stt_preprocess')
+
+STT_TRIM = os.getenv("STT_TRIM", "1") != "0"
+STT_TRIM_PAD = float(os.getenv("STT_TRIM_PAD", "0.2"))
+STT_TARGET_DBFS = float(os.getenv("STT_TARGET_DBFS", "-20") or "nan")
+STT_MAX_GAIN_DB = float(os.getenv("STT_MAX_GAIN_DB", "20"))
+# Пик после нормализации не должен доходить до перегрузки 16-битного PCM
+PEAK_LIMIT = 0.98
+# Запись тише этого уровня (дБ) считается пустой
+SILENCE_DBFS = -60.0
+
+# Байты 16-битного PCM: исходная запись -> отправлено в распознавание
+stats = {"requests": 0, "bytes_in": 0, "bytes_out": 0, "seconds_in": 0.0, "seconds_out": 0.0}
+# prepare вызывается из потоков пула
+_stats_lock = threading.Lock()
+
+def trim_silence(y, sr, pad=STT_TRIM_PAD):
+    """Границы речи в записи (начало, конец) в отсчетах с запасом pad секунд.
+
+    Запись без речи дает (0, 0).
+    """
+    frame_length = max(int(sr * VAD_FRAME_SECONDS), 1)
+    levels = frame_levels(y, frame_length)
+    if not len(y) or levels.max() < SILENCE_DBFS:
+        return 0, 0
+    active = np.flatnonzero(speech_frames(levels))
+    pad_samples = int(pad * sr)
+    start = max(int(active[0]) * frame_length - pad_samples, 0)
+    end = min((int(active[-1]) + 1) * frame_length + pad_samples, len(y))
+    return start, end
+
+def normalize(y, target_dbfs=STT_TARGET_DBFS, max_gain_db=STT_MAX_GAIN_DB):
+    """Приводит средний уровень записи к target_dbfs (дБ относительно полной шкалы).
+
+    Усиление ограничено max_gain_db, чтобы не поднимать шум почти пустых
+    записей, и пиком PEAK_LIMIT, чтобы не перегружать PCM.
+    """
+    if not len(y) or np.isnan(target_dbfs):
+        return y
+    rms = np.sqrt(np.mean(np.square(y, dtype=np.float64)))
+    peak = np.max(np.abs(y))
+    if rms <= 0 or peak <= 0:
+        return y
+    gain = min(10 ** ((target_dbfs - 20 * np.log10(rms)) / 20), 10 ** (max_gain_db / 20), PEAK_LIMIT / peak)
+    return (y * gain).astype(np.float32)
+
+def prepare(y, sr, source_rate=None, source_channels=1, trim=STT_TRIM):
+    """Обрезает тишину и нормализует уровень моно сигнала, уже приведенного к частоте sr.
+
+    source_rate и source_channels - параметры исходной записи, по ним считается,
+    сколько байт ушло бы в распознавание без подготовки.
+    """
+    seconds_in = len(y) / sr
+    if trim:
+        start, end = trim_silence(y, sr)
+        y = y[start:end]
+    y = normalize(y)
+    _account(seconds_in, len(y) / sr, sr, source_rate, source_channels)
+    return y
+
+def _account(seconds_in, seconds_out, sr, source_rate, source_channels):
+    """Учет байт в stats; статистика не должна мешать распознаванию."""
+    try:
+        bytes_in = int(seconds_in * (source_rate or sr)) * (source_channels or 1) * 2
+        bytes_out = int(seconds_out * sr) * 2
+        with _stats_lock:
+            stats["requests"] += 1
+            stats["bytes_in"] += bytes_in
+            stats["bytes_out"] += bytes_out
+            stats["seconds_in"] += seconds_in
+            stats["seconds_out"] += seconds_out
+        logger.debug(f"STT payload: {bytes_in} -> {bytes_out} bytes, {seconds_in:.1f}s -> {seconds_out:.1f}s")
+    except Exception as e:
+        logger.warning(f"Failed to account STT payload: {e!r}")
@@ -0,0 +1,117 @@
+import io
+import os
+import re
+import time
+import asyncio
+import logging
+import functools
+from workers import run_io
+from lazy import lazy_import
+
+# gTTS загружается при первом синтезе
+gtts = lazy_import("gtts")
+
+logger = logging.getLogger('tts')
+
+# Максимальная длина фрагмента: gTTS все равно режет текст по 100 символов
+# и запрашивает части последовательно, поэтому фрагменты такой длины
+# превращаются ровно в один запрос каждый
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "100"))
+# Сколько фрагментов одного ответа синтезируется одновременно
+TTS_FAN_OUT = int(os.getenv("TTS_FAN_OUT", "4"))
+
+# Границы предложений и, если предложение слишком длинное, частей предложения
+SENTENCE_SPLIT = re.compile(r'(?<=[.!?…])\s+')
+CLAUSE_SPLIT = re.compile(r'(?<=[,;:—])\s+')
+
+def _split_long(text, max_chars):
+    """Режет слишком длинный фрагмент по словам."""
+    chunks, current = [], ""
+    for word in text.split():
+        if current and len(current) + 1 + len(word) > max_chars:
+            chunks.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _merge(parts, max_chars):
+    """Объединяет соседние короткие части, не превышая max_chars."""
+    chunks, current = [], ""
+    for part in parts:
+        if current and len(current) + 1 + len(part) <= max_chars:
+            current = f"{current} {part}"
+        else:
+            if current:
+                chunks.append(current)
+            current = part
+    if current:
+        chunks.append(current)
+    return chunks
+
+def split_text(text, max_chars=TTS_CHUNK_CHARS):
+    """Делит текст на фрагменты по границам предложений, затем частей предложения и слов."""
+    parts = []
+    for sentence in SENTENCE_SPLIT.split(text.strip()):
+        if len(sentence) <= max_chars:
+            parts.append(sentence)
+            continue
+        for clause in CLAUSE_SPLIT.split(sentence):
+            if len(clause) <= max_chars:
+                parts.append(clause)
+            else:
+                parts.extend(_split_long(clause, max_chars))
+    return _merge([p for p in parts if p.strip()], max_chars)
+
+def _strip_id3(data):
+    """Удаляет заголовок ID3v2, чтобы склеенный mp3 был непрерывным потоком кадров."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return data
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return data[10 + size:]
+
+def text_to_speech(text, lang='ru'):
+    """Преобразует текст в речь (gTTS) и возвращает аудио в формате mp3."""
+    buffer = io.BytesIO()
+    tts = gtts.gTTS(text=text, lang=lang, slow=False)
+    tts.write_to_fp(buffer)
+    return buffer.getvalue()
+
+async def synthesize_chunked(text, lang='ru', synth_func=text_to_speech, max_chars=TTS_CHUNK_CHARS,
+                             fan_out=TTS_FAN_OUT, timings=None):
+    """Синтезирует длинный текст параллельно по фрагментам и склеивает mp3.
+
+    synth_func(text, lang) - блокирующая функция синтеза, возвращающая mp3.
+    MP3 состоит из независимых кадров, поэтому фрагменты склеиваются без
+    перекодирования (так же поступает сам gTTS). Время синтеза каждого
+    фрагмента пишется в лог и, если передан список timings, добавляется в него.
+    """
+    chunks = split_text(text, max_chars)
+    semaphore = asyncio.Semaphore(fan_out)
+    chunk_timings = [None] * len(chunks)
+
+    async def synthesize(index, chunk):
+        async with semaphore:
+            started = time.perf_counter()
+            audio = await run_io("tts", synth_func, chunk, lang)
+            chunk_timings[index] = {
+                "chunk": index,
+                "chars": len(chunk),
+                "bytes": len(audio),
+                "seconds": round(time.perf_counter() - started, 3),
+            }
+            return audio
+
+    started = time.perf_counter()
+    parts = await asyncio.gather(*(synthesize(i, chunk) for i, chunk in enumerate(chunks)))
+    total = time.perf_counter() - started
+
+    logger.info(f"TTS: {len(chunks)} chunks, {len(text)} chars in {total:.3f}s, per chunk: {chunk_timings}")
+    if timings is not None:
+        timings.extend(chunk_timings)
+    return b"".join(parts[:1] + [_strip_id3(part) for part in parts[1:]])
+
+# Длинные ответы синтезируются параллельно по фрагментам
+text_to_speech_chunked = functools.partial(synthesize_chunked, synth_func=text_to_speech)
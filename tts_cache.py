@@ -0,0 +1,204 @@
+import os
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from workers import run_io
+from metrics import span
+
+logger = logging.getLogger('tts_cache')
+
+# Настройки кэша (можно переопределить через переменные окружения)
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tts_cache"))
+TTS_CACHE_MEMORY_BYTES = int(os.getenv("TTS_CACHE_MEMORY_MB", "32")) * 1024 * 1024
+TTS_CACHE_DISK_BYTES = int(os.getenv("TTS_CACHE_DISK_MB", "512")) * 1024 * 1024
+TTS_CACHE_FILE_IDS = int(os.getenv("TTS_CACHE_FILE_IDS", "10000"))
+
+def normalize_text(text):
+    """Приводит текст к каноническому виду: NFC, без лишних пробелов."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def make_key(text, lang='ru', **voice_params):
+    """Ключ кэша по нормализованному тексту, языку и параметрам голоса."""
+    parts = [normalize_text(text), lang]
+    parts += [f"{name}={voice_params[name]}" for name in sorted(voice_params)]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+class Speech:
+    """Результат синтеза: либо file_id уже отправленного сообщения, либо аудио."""
+
+    __slots__ = ("key", "audio", "file_id")
+
+    def __init__(self, key, audio=None, file_id=None):
+        self.key = key
+        self.audio = audio
+        self.file_id = file_id
+
+class TTSCache:
+    """Кэш синтезированной речи: LRU в памяти, ограниченный по размеру каталог на диске
+    и file_id Telegram для повторной отправки без загрузки.
+
+    file_id действителен только для бота, который его получил, поэтому хранится в памяти процесса.
+    """
+
+    def __init__(self, cache_dir=TTS_CACHE_DIR, memory_bytes=TTS_CACHE_MEMORY_BYTES,
+                 disk_bytes=TTS_CACHE_DISK_BYTES, max_file_ids=TTS_CACHE_FILE_IDS):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_file_ids = max_file_ids
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._disk = OrderedDict()  # ключ -> размер файла, в порядке использования
+        self._disk_size = 0
+        self._file_ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"file_id": 0, "memory": 0, "disk": 0, "miss": 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.bin")
+
+    def _scan_disk(self):
+        """Восстанавливает индекс дискового кэша после перезапуска."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".bin"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def _remember(self, key, data):
+        """Кладет данные в LRU в памяти (вызывается под блокировкой)."""
+        if key in self._memory:
+            self._memory_size -= len(self._memory.pop(key))
+        if len(data) > self.memory_bytes:
+            return
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.memory_bytes:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+
+    def _evict_disk(self):
+        """Удаляет самые старые файлы, пока кэш не уложится в лимит (вызывается под блокировкой)."""
+        while self._disk_size > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError as e:
+                logger.warning(f"Не удалось удалить файл кэша {key}: {e}")
+
+    def get(self, key):
+        """Возвращает аудио по ключу или None (блокирующий вызов из-за чтения с диска)."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.stats["memory"] += 1
+                return self._memory[key]
+            if not self.cache_dir or key not in self._disk:
+                self.stats["miss"] += 1
+                return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._disk_size -= self._disk.pop(key, 0)
+                self.stats["miss"] += 1
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+            self._remember(key, data)
+            self.stats["disk"] += 1
+        return data
+
+    def put(self, key, data):
+        """Сохраняет аудио в память и на диск."""
+        with self._lock:
+            self._remember(key, data)
+        if not self.cache_dir or len(data) > self.disk_bytes:
+            return
+        # Запись через временный файл, чтобы другой процесс не прочитал файл частично
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._disk_size -= self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._disk_size += len(data)
+            self._evict_disk()
+
+    def get_file_id(self, key):
+        """Возвращает file_id ранее отправленного голосового сообщения."""
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+                self.stats["file_id"] += 1
+            return file_id
+
+    def set_file_id(self, key, file_id):
+        """Запоминает file_id, полученный от Telegram после отправки."""
+        with self._lock:
+            self._file_ids[key] = file_id
+            self._file_ids.move_to_end(key)
+            while len(self._file_ids) > self.max_file_ids:
+                self._file_ids.popitem(last=False)
+
+    async def synthesize(self, text, synth_func, lang='ru', reuse_file_id=True, **voice_params):
+        """Возвращает Speech: file_id, если такой ответ уже отправлялся,
+        иначе аудио из кэша или результат synth_func(text, lang).
+
+        synth_func может быть как блокирующей функцией (выполняется в пуле потоков),
+        так и корутиной. reuse_file_id=False нужен, когда аудио требуется для
+        дальнейшей обработки, а не для отправки как есть.
+        """
+        key = make_key(text, lang, **voice_params)
+        file_id = self.get_file_id(key) if reuse_file_id else None
+        if file_id is not None:
+            return Speech(key, file_id=file_id)
+        with span("tts"):
+            audio = await run_io("tts", self.get, key)
+            if audio is None:
+                if asyncio.iscoroutinefunction(synth_func):
+                    audio = await synth_func(text, lang)
+                else:
+                    audio = await run_io("tts", synth_func, text, lang)
+                await run_io("tts", self.put, key, audio)
+        return Speech(key, audio=audio)
+
+    async def send(self, message, speech, **kwargs):
+        """Отправляет голосовое сообщение по file_id или загружает аудио и запоминает file_id."""
+        with span("upload"):
+            sent = await message.reply_voice(voice=speech.file_id or speech.audio, **kwargs)
+        if sent is not None and sent.voice is not None:
+            self.set_file_id(speech.key, sent.voice.file_id)
+        return sent
+
+# Общий кэш на процесс
+_cache = None
+
+def get_tts_cache() -> TTSCache:
+    """Возвращает общий кэш синтеза речи, создавая его при первом обращении."""
+    global _cache
+    if _cache is None:
+        _cache = TTSCache()
+    return _cache
@@ -0,0 +1,74 @@
+import os
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+
+# Максимальная длина сегмента для распознавания (секунды)
+VAD_MAX_SEGMENT = float(os.getenv("VAD_MAX_SEGMENT", "25"))
+# Пауза, по которой можно резать запись (секунды)
+VAD_MIN_SILENCE = float(os.getenv("VAD_MIN_SILENCE", "0.3"))
+# Насколько речь должна быть громче фонового шума (дБ)
+VAD_MARGIN_DB = float(os.getenv("VAD_MARGIN_DB", "10"))
+VAD_FRAME_SECONDS = 0.03
+
+def frame_levels(y, frame_length):
+    """Уровень (дБ) каждого кадра сигнала, векторно."""
+    n_frames = max(len(y) // frame_length, 1)
+    frames = np.resize(y, n_frames * frame_length).reshape(n_frames, frame_length)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+def speech_frames(levels, margin_db=VAD_MARGIN_DB):
+    """Маска кадров с речью: порог адаптируется к уровню шума записи."""
+    noise_floor = np.percentile(levels, 10)
+    peak = levels.max()
+    if peak - noise_floor < margin_db:
+        # Пауз нет: вся запись - речь (или сплошной шум, его отбракует распознавание)
+        return np.ones(len(levels), dtype=bool)
+    # Очень тихие относительно пика кадры не считаются речью даже в тихой записи
+    return levels > max(noise_floor + margin_db, peak - 50)
+
+def _silence_cuts(speech, min_frames):
+    """Середины пауз длиной не меньше min_frames (номера кадров)."""
+    padded = np.concatenate(([True], speech, [True]))
+    changes = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    starts, ends = changes[0::2], changes[1::2]
+    long_enough = ends - starts >= min_frames
+    return ((starts + ends) // 2)[long_enough]
+
+def split_on_silence(y, sr, max_seconds=VAD_MAX_SEGMENT, min_silence=VAD_MIN_SILENCE,
+                     margin_db=VAD_MARGIN_DB):
+    """Делит запись на сегменты не длиннее max_seconds, разрезая по паузам.
+
+    Если подходящей паузы нет, сегмент режется в самом тихом месте второй
+    половины окна. Сегменты без речи отбрасываются.
+    Возвращает список (начало, конец) в отсчетах.
+    """
+    frame_length = max(int(sr * VAD_FRAME_SECONDS), 1)
+    levels = frame_levels(y, frame_length)
+    speech = speech_frames(levels, margin_db)
+    if not speech.any():
+        return []
+    n_frames = len(levels)
+    max_frames = max(int(max_seconds / VAD_FRAME_SECONDS), 2)
+    cuts = _silence_cuts(speech, max(int(min_silence / VAD_FRAME_SECONDS), 1))
+
+    bounds, start = [], 0
+    while n_frames - start > max_frames:
+        limit = start + max_frames
+        candidates = cuts[(cuts > start) & (cuts <= limit)]
+        if len(candidates):
+            end = int(candidates[-1])
+        else:
+            window = levels[start + max_frames // 2:limit]
+            end = start + max_frames // 2 + int(np.argmin(window))
+        bounds.append((start, end))
+        start = end
+    bounds.append((start, n_frames))
+
+    segments = []
+    for first, last in bounds:
+        if speech[first:last].any():
+            end = len(y) if last == n_frames else last * frame_length
+            segments.append((first * frame_length, end))
+    return segments
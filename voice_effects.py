@@ -0,0 +1,182 @@
+"""Изменение голоса на тензорах torch с переиспользуемыми преобразованиями.
+
+Ядра передискретизации и модули сдвига высоты тона создаются один раз на
+процесс пула (ключ - пара частот и число полутонов) и используются всеми
+последующими сообщениями. Сигнал передискретизируется один раз - сразу в
+частоту кодировщика Opus, поэтому при кодировании повторной передискретизации нет.
+
+Сообщения, пришедшие почти одновременно, обрабатываются одним пакетом
+(одна операция над тензором (пакет, время) в одном процессе пула).
+"""
+import os
+import asyncio
+import logging
+from audio_codec import OPUS_SAMPLE_RATE
+from workers import run_cpu
+from lazy import lazy_import
+
+np = lazy_import("numpy")
+torch = lazy_import("torch")
+torchaudio = lazy_import("torchaudio")
+
+logger = logging.getLogger('voice_effects')
+
+# Эффекты применяются на частоте кодировщика, чтобы передискретизировать один раз
+EFFECT_SAMPLE_RATE = OPUS_SAMPLE_RATE
+# Сдвиг высоты голоса в полутонах (прежняя цепочка sox "pitch 100" - это 1 полутон)
+VOICE_PITCH_STEPS = int(os.getenv("VOICE_PITCH_STEPS", "1"))
+# Сколько сообщений максимум обрабатывается одним пакетом
+EFFECTS_BATCH_SIZE = int(os.getenv("EFFECTS_BATCH_SIZE", "8"))
+# Сколько ждать других сообщений для пакета (секунды)
+EFFECTS_BATCH_WINDOW = float(os.getenv("EFFECTS_BATCH_WINDOW", "0.02"))
+# Сообщения в пакете дополняются нулями до самого длинного; слишком разные
+# по длине сообщения идут разными пакетами, чтобы не считать лишнее
+EFFECTS_BATCH_PAD_RATIO = 1.5
+
+# --- код, выполняемый в процессах пула ---
+
+# (исходная частота, новая частота) -> torchaudio.transforms.Resample
+_resamplers = {}
+# (частота, полутоны) -> torchaudio.transforms.PitchShift
+_pitch_shifters = {}
+
+def get_resampler(orig_freq, new_freq):
+    """Передискретизация с ядром, вычисленным один раз для пары частот."""
+    key = (orig_freq, new_freq)
+    if key not in _resamplers:
+        _resamplers[key] = torchaudio.transforms.Resample(orig_freq, new_freq)
+    return _resamplers[key]
+
+def get_pitch_shifter(sample_rate, n_steps):
+    """Сдвиг высоты тона; ядро его внутренней передискретизации создается
+    при первом вызове и дальше переиспользуется.
+    """
+    key = (sample_rate, n_steps)
+    if key not in _pitch_shifters:
+        _pitch_shifters[key] = torchaudio.transforms.PitchShift(sample_rate, n_steps)
+    return _pitch_shifters[key]
+
+def apply_voice_effects_batch(signals, lengths, sample_rate, n_steps=VOICE_PITCH_STEPS):
+    """Изменяет голос в пакете сигналов одной операцией (выполняется в пуле процессов).
+
+    signals - массив (пакет, время), дополненный нулями, lengths - длины сигналов.
+    Возвращает (массив на EFFECT_SAMPLE_RATE, длины сигналов в нем).
+    """
+    with torch.inference_mode():
+        waveform = torch.from_numpy(np.ascontiguousarray(signals, dtype=np.float32))
+        if sample_rate != EFFECT_SAMPLE_RATE:
+            waveform = get_resampler(sample_rate, EFFECT_SAMPLE_RATE)(waveform)
+        if n_steps:
+            waveform = get_pitch_shifter(EFFECT_SAMPLE_RATE, n_steps)(waveform)
+        result = waveform.numpy()
+    lengths = -(-np.asarray(lengths, dtype=np.int64) * EFFECT_SAMPLE_RATE // sample_rate)
+    return result, np.minimum(lengths, result.shape[-1])
+
+def apply_voice_effects(y, sample_rate, n_steps=VOICE_PITCH_STEPS):
+    """Изменяет голос в одном сигнале. Возвращает (сигнал, EFFECT_SAMPLE_RATE)."""
+    result, lengths = apply_voice_effects_batch(y[None, :], [len(y)], sample_rate, n_steps)
+    return result[0, :lengths[0]], EFFECT_SAMPLE_RATE
+
+def warm_up():
+    """Создает преобразования по умолчанию и прогоняет через них короткий сигнал."""
+    apply_voice_effects(np.zeros(EFFECT_SAMPLE_RATE // 10, dtype=np.float32), EFFECT_SAMPLE_RATE)
+
+# --- код, выполняемый в основном процессе ---
+
+def _group(requests, max_batch, pad_ratio):
+    """Делит запросы на пакеты: одна частота и близкие длины в каждом пакете."""
+    groups = []
+    for request in sorted(requests, key=lambda item: (item[1], len(item[0]))):
+        y, sample_rate, _ = request
+        group = groups[-1] if groups else None
+        if (group is None or len(group) >= max_batch or group[0][1] != sample_rate
+                or len(y) > max(len(group[0][0]), 1) * pad_ratio):
+            groups.append([request])
+        else:
+            group.append(request)
+    return groups
+
+class EffectsBatcher:
+    """Собирает сообщения, пришедшие в течение window секунд, в пакеты и
+    обрабатывает каждый пакет одним вызовом в пуле процессов.
+    """
+
+    def __init__(self, n_steps=VOICE_PITCH_STEPS, max_batch=EFFECTS_BATCH_SIZE,
+                 window=EFFECTS_BATCH_WINDOW, pad_ratio=EFFECTS_BATCH_PAD_RATIO):
+        self.n_steps = n_steps
+        self.max_batch = max_batch
+        self.window = window
+        self.pad_ratio = pad_ratio
+        # (сигнал, частота, Future с результатом)
+        self._pending = []
+        self._timer = None
+        # Выполняющиеся пакеты: без ссылки задача может быть удалена сборщиком мусора,
+        # и ожидающие ее сообщения не получили бы результат
+        self._tasks = set()
+        self.stats = {"messages": 0, "batches": 0}
+
+    async def process(self, y, sample_rate):
+        """Изменяет голос в сигнале. Возвращает (сигнал, EFFECT_SAMPLE_RATE)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((y, sample_rate, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        for group in _group(pending, self.max_batch, self.pad_ratio):
+            task = asyncio.ensure_future(self._run(group))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def drain(self, timeout):
+        """Отправляет накопленные сообщения и дожидается всех пакетов (при остановке).
+
+        Возвращает True, если все пакеты обработаны за timeout секунд.
+        """
+        if self._pending:
+            self._flush()
+        if self._tasks:
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+        if self._tasks:
+            logger.warning(f"Effects batcher drain timed out: {len(self._tasks)} batches are lost")
+            return False
+        return True
+
+    async def _run(self, group):
+        lengths = np.array([len(y) for y, _, _ in group], dtype=np.int64)
+        signals = np.zeros((len(group), max(int(lengths.max()), 1)), dtype=np.float32)
+        for row, (y, _, _) in enumerate(group):
+            signals[row, :len(y)] = y
+        self.stats["messages"] += len(group)
+        self.stats["batches"] += 1
+        try:
+            result, out_lengths = await run_cpu(
+                "dsp", apply_voice_effects_batch, signals, lengths, group[0][1], self.n_steps
+            )
+        except Exception as e:
+            for _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for row, (_, _, future) in enumerate(group):
+            # Ожидающий мог уйти (отмена обработки сообщения)
+            if not future.done():
+                future.set_result((result[row, :out_lengths[row]], EFFECT_SAMPLE_RATE))
+
+# Общий пакетировщик на процесс
+_batcher = None
+
+def get_effects_batcher() -> EffectsBatcher:
+    """Возвращает общий пакетировщик эффектов изменения голоса."""
+    global _batcher
+    if _batcher is None:
+        _batcher = EffectsBatcher()
+    return _batcher
@@ -0,0 +1,275 @@
+import os
+import math
+import mmap
+import time
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('voice_profiles')
+
+# Настройки хранилища (можно переопределить через переменные окружения)
+VOICE_PROFILES_PATH = os.getenv("VOICE_PROFILES_PATH", "voice_profiles.dat")
+VOICE_PROFILES_CAPACITY = int(os.getenv("VOICE_PROFILES_CAPACITY", "100000"))
+VOICE_PROFILES_TTL = float(os.getenv("VOICE_PROFILES_TTL_DAYS", "90")) * 24 * 3600
+
+# Уверенность профиля: сколько вокализованной речи нужно (секунды), какая погрешность
+# средней высоты голоса допустима (полутоны) и с какой уверенности образцов достаточно
+VOICE_PROFILE_MIN_SECONDS = float(os.getenv("VOICE_PROFILE_MIN_SECONDS", "5"))
+VOICE_PROFILE_TOLERANCE_ST = float(os.getenv("VOICE_PROFILE_TOLERANCE_ST", "1.0"))
+VOICE_PROFILE_CONFIDENT = float(os.getenv("VOICE_PROFILE_CONFIDENT", "0.6"))
+# Априорный разброс средней высоты между образцами (полутоны) и его вес в образцах:
+# вес меньше единицы, чтобы один четкий образец уже давал ненулевую уверенность
+VOICE_PROFILE_PRIOR_ST = 1.0
+VOICE_PROFILE_PRIOR_WEIGHT = 0.5
+
+# Формат файла: заголовок и массив записей фиксированной длины
+MAGIC = b"VPRF"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")  # сигнатура, версия, размер записи, число слотов
+# user_id, число образцов, секунды вокализованной речи, средняя f0, M2 f0, темп,
+# средняя высота образцов (полутоны), M2 высоты образцов, время последнего использования
+RECORD = struct.Struct("<qIddddddd")
+LAST_USED = 8
+EMPTY_USER = 0                    # у пользователей Telegram не бывает id 0
+
+# Как часто обновлять время использования при чтении (чтобы не писать на каждый запрос)
+TOUCH_INTERVAL = 3600
+
+class VoiceProfile:
+    """Характеристики голоса, накопленные по нескольким образцам.
+
+    Средняя и дисперсия f0 объединяются параллельным алгоритмом Чана с весом
+    образца - длительностью вокализованной речи, поэтому новый образец
+    учитывается без повторного анализа старых. Средние высоты самих образцов
+    (в полутонах) накапливаются по Уэлфорду: их разброс определяет уверенность.
+    """
+
+    __slots__ = ("samples", "voiced_seconds", "mean_f0", "m2_f0", "tempo", "mean_st", "m2_st")
+
+    def __init__(self, samples=0, voiced_seconds=0.0, mean_f0=0.0, m2_f0=0.0, tempo=0.0,
+                 mean_st=0.0, m2_st=0.0):
+        self.samples = samples
+        self.voiced_seconds = voiced_seconds
+        self.mean_f0 = mean_f0
+        self.m2_f0 = m2_f0
+        self.tempo = tempo
+        self.mean_st = mean_st
+        self.m2_st = m2_st
+
+    def add_sample(self, voiced_seconds, mean_f0, var_f0, tempo):
+        """Учитывает образец: длительность вокализованной речи, средняя и дисперсия f0, темп."""
+        if voiced_seconds <= 0 or mean_f0 <= 0:
+            raise ValueError("В образце нет вокализованной речи")
+        total = self.voiced_seconds + voiced_seconds
+        share = voiced_seconds / total
+        delta = mean_f0 - self.mean_f0
+        self.m2_f0 += var_f0 * voiced_seconds + delta * delta * self.voiced_seconds * share
+        self.mean_f0 += delta * share
+        self.tempo += (tempo - self.tempo) * share
+        self.voiced_seconds = total
+        self.samples += 1
+        semitones = 12 * math.log2(mean_f0)
+        delta = semitones - self.mean_st
+        self.mean_st += delta / self.samples
+        self.m2_st += delta * (semitones - self.mean_st)
+
+    @property
+    def f0_std(self):
+        """Стандартное отклонение f0 по всей вокализованной речи (Гц)."""
+        return math.sqrt(self.m2_f0 / self.voiced_seconds) if self.voiced_seconds else 0.0
+
+    @property
+    def confidence(self):
+        """Уверенность в средней высоте голоса от 0 до 1.
+
+        Погрешность средней высоты оценивается по разбросу высот образцов
+        (априорный разброс учитывается как VOICE_PROFILE_PRIOR_WEIGHT образца);
+        мало речи тоже снижает уверенность. С настройками по умолчанию один
+        образец дает около 18%, два совпадающих - выше порога VOICE_PROFILE_CONFIDENT.
+        """
+        if not self.samples:
+            return 0.0
+        weight = VOICE_PROFILE_PRIOR_WEIGHT
+        spread = (self.m2_st + weight * VOICE_PROFILE_PRIOR_ST ** 2) / (self.samples - 1 + weight)
+        error = math.sqrt(spread / (self.samples + weight))
+        amount = min(self.voiced_seconds / VOICE_PROFILE_MIN_SECONDS, 1.0)
+        return max(1.0 - error / VOICE_PROFILE_TOLERANCE_ST, 0.0) * amount
+
+    @property
+    def confident(self):
+        """Образцов достаточно, больше просить не нужно."""
+        return self.confidence >= VOICE_PROFILE_CONFIDENT
+
+    def _fields(self):
+        return (self.samples, self.voiced_seconds, self.mean_f0, self.m2_f0, self.tempo,
+                self.mean_st, self.m2_st)
+
+class VoiceProfileStore:
+    """Хранилище характеристик голоса в файле с записями фиксированной длины.
+
+    Файл отображается в память (mmap) и имеет фиксированный размер
+    HEADER + capacity * RECORD, поэтому занимаемое место на диске ограничено.
+    Индекс user_id -> слот хранится в памяти в порядке последнего использования
+    (от давнего к недавнему). Устаревшие профили удаляются по TTL, а при
+    заполнении вытесняется первый профиль индекса - без просмотра файла.
+    """
+
+    def __init__(self, path=VOICE_PROFILES_PATH, capacity=VOICE_PROFILES_CAPACITY, ttl=VOICE_PROFILES_TTL):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self._index = OrderedDict()
+        self._free = []
+        self._lock = threading.Lock()
+        self._file = None
+        self._mm = None
+        self._open()
+
+    def _offset(self, slot):
+        return HEADER.size + slot * RECORD.size
+
+    def _read_existing(self):
+        """Читает заголовок и записи существующего файла (если формат совпадает)."""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, []
+        if len(data) < HEADER.size:
+            return None, []
+        magic, version, record_size, capacity = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            logger.warning(f"Неизвестный формат файла профилей {self.path}, он будет пересоздан")
+            return None, []
+        records = []
+        for slot in range(min(capacity, (len(data) - HEADER.size) // RECORD.size)):
+            record = RECORD.unpack_from(data, self._offset(slot))
+            if record[0] != EMPTY_USER:
+                records.append((slot, record))
+        return capacity, records
+
+    def _open(self):
+        capacity, records = self._read_existing()
+        size = self._offset(self.capacity)
+        if capacity != self.capacity:
+            # Файла нет, изменилась емкость или формат: пересоздаем, сохраняя самые свежие профили
+            records = sorted(records, key=lambda item: item[1][LAST_USED], reverse=True)[:self.capacity]
+            records = [(slot, record) for slot, record in enumerate(r for _, r in records)]
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, self.capacity))
+                f.truncate(size)
+                for slot, record in records:
+                    f.seek(self._offset(slot))
+                    f.write(RECORD.pack(*record))
+            os.replace(tmp_path, self.path)
+        self._file = open(self.path, "r+b")
+        self._mm = mmap.mmap(self._file.fileno(), size)
+        used = set()
+        for slot, record in sorted(records, key=lambda item: item[1][LAST_USED]):
+            self._index[record[0]] = slot
+            used.add(slot)
+        self._free = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used]
+        self.evict_expired()
+        logger.info(f"Voice profiles: {len(self._index)} loaded from {self.path}")
+
+    def _clear(self, user_id, slot):
+        """Освобождает слот (вызывается под блокировкой)."""
+        RECORD.pack_into(self._mm, self._offset(slot), EMPTY_USER, 0, *[0.0] * 7)
+        del self._index[user_id]
+        self._free.append(slot)
+
+    def _evict_lru(self):
+        """Освобождает слот давно не использовавшегося профиля (вызывается под блокировкой)."""
+        user_id, slot = next(iter(self._index.items()))
+        self._clear(user_id, slot)
+
+    def evict_expired(self):
+        """Удаляет профили, не использовавшиеся дольше TTL."""
+        deadline = time.time() - self.ttl
+        with self._lock:
+            for user_id, slot in list(self._index.items()):
+                if RECORD.unpack_from(self._mm, self._offset(slot))[LAST_USED] < deadline:
+                    self._clear(user_id, slot)
+
+    def _get(self, user_id):
+        """Профиль пользователя или None (вызывается под блокировкой)."""
+        slot = self._index.get(user_id)
+        if slot is None:
+            return None
+        record = RECORD.unpack_from(self._mm, self._offset(slot))
+        now = time.time()
+        if now - record[LAST_USED] > self.ttl:
+            self._clear(user_id, slot)
+            return None
+        self._index.move_to_end(user_id)
+        if now - record[LAST_USED] > TOUCH_INTERVAL:
+            RECORD.pack_into(self._mm, self._offset(slot), *record[:LAST_USED], now)
+        return VoiceProfile(*record[1:LAST_USED])
+
+    def _put(self, user_id, profile):
+        """Записывает профиль (вызывается под блокировкой)."""
+        slot = self._index.get(user_id)
+        if slot is None:
+            if not self._free:
+                self._evict_lru()
+            slot = self._free.pop()
+            self._index[user_id] = slot
+        self._index.move_to_end(user_id)
+        RECORD.pack_into(self._mm, self._offset(slot), user_id, *profile._fields(), time.time())
+
+    def get(self, user_id):
+        """Возвращает профиль голоса пользователя (VoiceProfile) или None."""
+        with self._lock:
+            return self._get(user_id)
+
+    def put(self, user_id, profile):
+        """Сохраняет профиль голоса пользователя."""
+        with self._lock:
+            self._put(user_id, profile)
+
+    def add_sample(self, user_id, voiced_seconds, mean_f0, var_f0, tempo):
+        """Добавляет к профилю пользователя характеристики нового образца
+        и возвращает обновленный профиль.
+        """
+        with self._lock:
+            profile = self._get(user_id) or VoiceProfile()
+            profile.add_sample(voiced_seconds, mean_f0, var_f0, tempo)
+            self._put(user_id, profile)
+            return profile
+
+    def delete(self, user_id):
+        """Удаляет профиль пользователя."""
+        with self._lock:
+            slot = self._index.get(user_id)
+            if slot is not None:
+                self._clear(user_id, slot)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        """Сбрасывает изменения на диск и закрывает файл."""
+        with self._lock:
+            if self._mm is not None:
+                self._mm.flush()
+                self._mm.close()
+                self._mm = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+# Общее хранилище на процесс
+_store = None
+
+def get_voice_profiles() -> VoiceProfileStore:
+    """Возвращает хранилище профилей голоса, открывая его при первом обращении."""
+    global _store
+    if _store is None:
+        _store = VoiceProfileStore()
+    return _store
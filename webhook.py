@@ -0,0 +1,392 @@
+"""Режим webhook и параллельная обработка обновлений.
+
+Обновления разных чатов обрабатываются параллельно, обновления одного чата -
+строго по порядку (это нужно ConversationHandler в speech_to_speech_librosa).
+Входящие обновления проходят через ограниченную очередь: когда в обработке уже
+INTAKE_LIMIT обновлений, webhook отвечает 429 и Telegram повторит доставку позже.
+Глубина очереди и время ожидания доступны по GET WEBHOOK_STATS_PATH.
+
+Настройка через переменные окружения:
+    WEBHOOK_URL        - публичный адрес webhook (если не задан - режим опроса)
+    WEBHOOK_LISTEN     - адрес, на котором слушает сервер (по умолчанию 0.0.0.0)
+    WEBHOOK_PORT       - порт (по умолчанию 8443)
+    WEBHOOK_SECRET     - секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_CERT/KEY   - сертификат и ключ, если TLS завершается в самом боте
+    CONCURRENT_UPDATES - сколько обновлений обрабатывается одновременно
+                         (должно быть больше SCHED_MAX_INLINE, см. scheduler)
+    INTAKE_LIMIT       - сколько обновлений может быть принято и не обработано
+    TG_API_URL         - адрес Bot API (например, локальной заглушки fake_telegram)
+"""
+import os
+import ssl
+import hmac
+import json
+import time
+import signal
+import asyncio
+import logging
+import secrets
+from urllib.parse import urlsplit
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+from metrics import get_metrics, start_metrics_server
+from scratch import get_scratch, start_sweeper
+from scheduler import get_scheduler
+
+logger = logging.getLogger('webhook')
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Без заданного секрета генерируется случайный: чужие запросы на webhook отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY")
+WEBHOOK_STATS_PATH = os.getenv("WEBHOOK_STATS_PATH", "/intake")
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+INTAKE_LIMIT = int(os.getenv("INTAKE_LIMIT", "256"))
+# Ограничение базового BaseUpdateProcessor: места считает ChatOrderedProcessor, а число
+# ожидающих обновлений ограничивают INTAKE_LIMIT и Telegram
+UNBOUNDED_UPDATES = 1 << 20
+TG_API_URL = os.getenv("TG_API_URL")
+
+# Обновления Telegram небольшие, все крупнее - ошибка или атака
+MAX_BODY_BYTES = 1024 * 1024
+# Сколько держать открытым простаивающее keep-alive соединение
+IDLE_TIMEOUT = 75
+# Telegram держит не больше 100 параллельных соединений с webhook
+MAX_TELEGRAM_CONNECTIONS = 100
+
+class IntakeQueue:
+    """Учет принятых, но еще не обработанных обновлений с ограничением глубины."""
+
+    def __init__(self, limit=INTAKE_LIMIT):
+        self.limit = limit
+        # update_id -> время приема
+        self._received = {}
+        self.stats = {
+            "accepted": 0, "rejected": 0, "duplicates": 0, "processed": 0,
+            "wait_total": 0.0, "wait_max": 0.0, "wait_last": 0.0,
+        }
+
+    @property
+    def depth(self):
+        """Сколько обновлений принято и еще не обработано."""
+        return len(self._received)
+
+    def offer(self, update):
+        """Принимает обновление, если очередь не заполнена.
+
+        Возвращает "accepted", "duplicate" (Telegram повторил уже принятое
+        обновление) или "rejected".
+        """
+        update_id = getattr(update, "update_id", None)
+        if update_id in self._received:
+            self.stats["duplicates"] += 1
+            return "duplicate"
+        if self.depth >= self.limit:
+            self.stats["rejected"] += 1
+            return "rejected"
+        if update_id is not None:
+            self._received[update_id] = time.monotonic()
+        self.stats["accepted"] += 1
+        return "accepted"
+
+    def started(self, update):
+        """Отмечает начало обработки и учитывает время ожидания в очереди."""
+        received = self._received.get(getattr(update, "update_id", None))
+        if received is None:
+            return
+        wait = time.monotonic() - received
+        self.stats["wait_total"] += wait
+        self.stats["wait_last"] = wait
+        self.stats["wait_max"] = max(self.stats["wait_max"], wait)
+
+    def finished(self, update):
+        if self._received.pop(getattr(update, "update_id", None), None) is not None:
+            self.stats["processed"] += 1
+
+    def snapshot(self):
+        """Состояние очереди для мониторинга."""
+        processed = self.stats["processed"]
+        oldest = min(self._received.values(), default=None)
+        return {
+            "depth": self.depth,
+            "limit": self.limit,
+            "oldest_wait": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+            "accepted": self.stats["accepted"],
+            "rejected": self.stats["rejected"],
+            "duplicates": self.stats["duplicates"],
+            "processed": processed,
+            "wait_avg": round(self.stats["wait_total"] / processed, 3) if processed else 0.0,
+            "wait_max": round(self.stats["wait_max"], 3),
+            "wait_last": round(self.stats["wait_last"], 3),
+        }
+
+def _chat_key(update):
+    """Ключ упорядочивания: чат, а для обновлений без чата - пользователь."""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+    return None
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+    Обновление сначала дожидается своей очереди в чате и только потом занимает
+    одно из concurrent_updates мест обработки: поток сообщений из одного чата
+    не может занять все места и задержать остальные чаты. Поэтому места считает
+    собственный семафор, а ограничение базового класса (оно берется раньше
+    очереди чата) выставлено заведомо большим.
+    """
+
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES, intake_limit=INTAKE_LIMIT):
+        super().__init__(UNBOUNDED_UPDATES)
+        self.concurrent_updates = max_concurrent_updates
+        self.intake = IntakeQueue(intake_limit)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # Сколько обновлений обрабатывается (заняли место)
+        self.in_flight = 0
+        # Ключ чата -> [блокировка, число ожидающих обновлений]
+        self._chats = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = _chat_key(update)
+        if key is None:
+            await self._run(update, coroutine)
+            return
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock пропускает ожидающих в порядке очереди;
+            # место обработки занимается, только когда подошла очередь чата
+            async with entry[0]:
+                await self._run(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[key]
+
+    async def _run(self, update, coroutine):
+        async with self._slots:
+            self.in_flight += 1
+            self.intake.started(update)
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                self.intake.finished(update)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def application_builder():
+    """ApplicationBuilder с параллельной обработкой обновлений.
+
+    В режиме webhook встроенный механизм опроса не создается. Если задан TG_API_URL,
+    запросы к Bot API и загрузка файлов идут на этот адрес.
+    """
+    builder = Application.builder().concurrent_updates(ChatOrderedProcessor())
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
+    if TG_API_URL:
+        base = TG_API_URL.rstrip("/")
+        builder = builder.base_url(f"{base}/bot").base_file_url(f"{base}/file/bot")
+    return builder
+
+class WebhookServer:
+    """Минимальный HTTP-сервер на asyncio, принимающий обновления от Telegram."""
+
+    def __init__(self, application, path="/", secret_token=WEBHOOK_SECRET,
+                 listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, ssl_context=None,
+                 stats_path=WEBHOOK_STATS_PATH):
+        self.application = application
+        self.path = path or "/"
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.ssl_context = ssl_context
+        self.stats_path = stats_path
+        processor = application.update_processor
+        self.intake = processor.intake if isinstance(processor, ChatOrderedProcessor) else IntakeQueue()
+        self._server = None
+
+    @property
+    def address(self):
+        """Фактический адрес сервера (полезно при port=0)."""
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.listen, self.port, ssl=self.ssl_context
+        )
+        host, port = self.address
+        logger.info(f"Webhook server listening on {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, 413, {"ok": False}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, payload, extra = await self._dispatch(method, target, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, payload, keep_alive, extra)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, headers, body):
+        path = urlsplit(target).path
+        if method == "GET" and path == self.stats_path:
+            return 200, self.intake.snapshot(), {}
+        if path != self.path:
+            return 404, {"ok": False}, {}
+        if method != "POST":
+            return 405, {"ok": False}, {"Allow": "POST"}
+        token = headers.get("x-telegram-bot-api-secret-token", "")
+        if self.secret_token and not hmac.compare_digest(token, self.secret_token):
+            return 403, {"ok": False}, {}
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Invalid webhook payload: {e}")
+            return 400, {"ok": False}, {}
+        result = self.intake.offer(update)
+        if result == "rejected":
+            # Telegram повторит доставку позже, обновление не теряется
+            logger.warning(f"Intake queue full ({self.intake.depth}), update {update.update_id} rejected")
+            return 429, {"ok": False}, {"Retry-After": "1"}
+        if result == "accepted":
+            await self.application.update_queue.put(update)
+        return 200, {"ok": True}, {}
+
+    async def _respond(self, writer, status, payload, keep_alive=True, extra=None):
+        data = json.dumps(payload).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                  405: "Method Not Allowed", 413: "Payload Too Large", 429: "Too Many Requests"}
+        lines = [
+            f"HTTP/1.1 {status} {reason.get(status, 'Error')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(data)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            *(f"{name}: {value}" for name, value in (extra or {}).items()),
+        ]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+        await writer.drain()
+
+def _ssl_context():
+    if not (WEBHOOK_CERT and WEBHOOK_KEY):
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY)
+    return context
+
+async def serve_webhook(application, url=WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                        secret_token=WEBHOOK_SECRET, stop_event=None):
+    """Запускает приложение в режиме webhook до установки stop_event (или SIGINT/SIGTERM).
+
+    Хуки post_init/post_stop/post_shutdown вызываются так же, как в run_polling.
+    """
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+    server = WebhookServer(
+        application, path=urlsplit(url).path, secret_token=secret_token,
+        listen=listen, port=port, ssl_context=_ssl_context(),
+    )
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    try:
+        await application.start()
+        await server.start()
+        await application.bot.set_webhook(
+            url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES,
+            max_connections=min(MAX_TELEGRAM_CONNECTIONS, CONCURRENT_UPDATES),
+        )
+        logger.info(f"Webhook set to {url}")
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        # Принятые задачи дорабатывают, пока бот еще может отвечать
+        await get_scheduler().drain()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def _register_gauges(processor):
+    """Показатели очереди обновлений для сервера метрик."""
+    metrics = get_metrics()
+    if isinstance(processor, ChatOrderedProcessor):
+        metrics.gauge("updates_in_flight", lambda: processor.in_flight)
+        metrics.gauge("intake_depth", lambda: processor.intake.depth)
+        metrics.gauge("intake_rejected", lambda: processor.intake.stats["rejected"])
+    else:
+        metrics.gauge("updates_in_flight", lambda: processor.current_concurrent_updates)
+    # Квота scratch основного процесса (сегменты для передачи массивов в пул)
+    metrics.gauge("scratch_bytes", lambda: get_scratch().used)
+    metrics.gauge("scratch_rejected", lambda: get_scratch().rejected)
+
+def run(application):
+    """Запускает бота: webhook, если задан WEBHOOK_URL, иначе опрос (polling).
+
+    Метрики стадий обработки доступны на локальном сервере метрик (metrics),
+    брошенные временные данные убирает фоновый уборщик (scratch).
+    """
+    _register_gauges(application.update_processor)
+    processor = application.update_processor
+    limit = getattr(processor, "concurrent_updates", processor.max_concurrent_updates)
+    if get_scheduler().max_inline >= limit:
+        logger.warning(
+            f"SCHED_MAX_INLINE ({get_scheduler().max_inline}) >= CONCURRENT_UPDATES ({limit}): "
+            "handlers waiting for voice jobs can take every update slot"
+        )
+    start_metrics_server()
+    start_sweeper()
+    if WEBHOOK_URL:
+        asyncio.run(serve_webhook(application))
+    else:
+        # В режиме опроса принятые задачи дорабатывают после остановки приема, до закрытия бота
+        post_stop = application.post_stop
+
+        async def drain_jobs(application):
+            await get_scheduler().drain()
+            if post_stop:
+                await post_stop(application)
+
+        application.post_stop = drain_jobs
+        application.run_polling()
@@ -0,0 +1,119 @@
+import os
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dsp_pool import DSPPool
+
+logger = logging.getLogger('workers')
+
+# Размеры пулов (можно переопределить через переменные окружения)
+IO_WORKERS = int(os.getenv("IO_WORKERS", "32"))
+# Число процессов обработки сигнала лучше задавать по числу свободных ядер
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1)))
+
+# Ограничения параллелизма по стадиям обработки.
+# Переопределяются переменными окружения вида STAGE_LIMIT_STT=4
+DEFAULT_STAGE_LIMITS = {
+    "codec": 8,    # декодирование и кодирование аудио (audio_codec)
+    "stt": 8,      # распознавание речи
+    "llm": 16,     # запросы к YandexGPT
+    "tts": 8,      # синтез речи
+    "dsp": CPU_WORKERS,  # обработка сигнала (librosa, torchaudio)
+}
+
+def _stage_limits_from_env(defaults):
+    """Читает ограничения по стадиям из переменных окружения."""
+    limits = dict(defaults)
+    for name in defaults:
+        value = os.getenv(f"STAGE_LIMIT_{name.upper()}")
+        if value:
+            limits[name] = int(value)
+    return limits
+
+class WorkerPool:
+    """Пул потоков для I/O и пул процессов для CPU-задач с лимитами по стадиям."""
+
+    def __init__(self, io_workers=IO_WORKERS, cpu_workers=CPU_WORKERS, stage_limits=None):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.stage_limits = _stage_limits_from_env(stage_limits or DEFAULT_STAGE_LIMITS)
+        self._thread_pool = None
+        self.dsp = DSPPool(cpu_workers)
+        self._semaphores = {}
+        self._warm_up_task = None
+
+    @property
+    def thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.io_workers, thread_name_prefix="io-worker"
+            )
+        return self._thread_pool
+
+    async def start_dsp(self, preload=(), warmups=(), background=False):
+        """Запускает пул обработки сигнала заранее: процессы импортируют тяжелые
+        модули и прогревают JIT-ядра до первого сообщения.
+
+        background=True не задерживает старт бота: прогрев идет фоновой задачей,
+        а сообщения, пришедшие раньше, просто дождутся готовых процессов.
+        """
+        self.dsp.configure(preload, warmups)
+        if background:
+            self._warm_up_task = asyncio.create_task(self.dsp.warm_up())
+            self._warm_up_task.add_done_callback(self._warm_up_done)
+            return
+        await self.dsp.warm_up()
+
+    def _warm_up_done(self, task):
+        """Ошибка фонового прогрева: пул, скорее всего, сломан - следующая задача запустит новый."""
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.error(f"DSP pool warm-up failed: {task.exception()!r}")
+        self.dsp.discard()
+
+    def _semaphore(self, stage):
+        if stage not in self._semaphores:
+            limit = self.stage_limits.get(stage, self.io_workers)
+            self._semaphores[stage] = asyncio.Semaphore(limit)
+        return self._semaphores[stage]
+
+    async def run_io(self, stage, func, *args, **kwargs):
+        """Выполняет блокирующий I/O-вызов в пуле потоков."""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        async with self._semaphore(stage):
+            return await loop.run_in_executor(self.thread_pool, call)
+
+    async def run_cpu(self, stage, func, *args, **kwargs):
+        """Выполняет CPU-задачу в пуле процессов (функция должна сериализоваться,
+        numpy-массивы передаются через разделяемую память).
+        """
+        async with self._semaphore(stage):
+            return await self.dsp.run(func, *args, **kwargs)
+
+    def shutdown(self, wait=True):
+        """Останавливает пулы."""
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=wait)
+            self._thread_pool = None
+        self.dsp.shutdown(wait=wait)
+
+# Общий пул на процесс
+_pool = None
+
+def get_pool() -> WorkerPool:
+    """Возвращает общий пул исполнителей, создавая его при первом обращении."""
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool()
+        logger.info(f"Worker pool: io={_pool.io_workers}, cpu={_pool.cpu_workers}, limits={_pool.stage_limits}")
+    return _pool
+
+async def run_io(stage, func, *args, **kwargs):
+    """Выполняет блокирующий I/O-вызов вне event loop."""
+    return await get_pool().run_io(stage, func, *args, **kwargs)
+
+async def run_cpu(stage, func, *args, **kwargs):
+    """Выполняет CPU-задачу в отдельном процессе."""
+    return await get_pool().run_cpu(stage, func, *args, **kwargs)
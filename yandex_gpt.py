@@ -0,0 +1,200 @@
+import os
+import json
+import asyncio
+import random
+import logging
+import httpx
+
+logger = logging.getLogger('yandex_gpt')
+
+# URL для запросов к YandexGPT
+YANDEX_GPT_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class YandexGPTError(Exception):
+    """Ошибка при обращении к YandexGPT."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class YandexGPTClient:
+    """Асинхронный клиент YandexGPT с пулом соединений, таймаутами и повторами."""
+
+    def __init__(
+        self,
+        api_key,
+        folder_id,
+        model="yandexgpt-lite",
+        url=YANDEX_GPT_URL,
+        temperature=0.6,
+        max_tokens=1000,
+        connect_timeout=5.0,
+        read_timeout=60.0,
+        max_retries=3,
+        backoff=0.5,
+        max_backoff=8.0,
+        max_concurrency=16,
+        max_connections=32,
+    ):
+        self.url = url
+        self.model_uri = f"gpt://{folder_id}/{model}"
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Заголовки формируются один раз на клиента
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Api-Key {api_key}",
+            "x-folder-id": folder_id or "",
+        }
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+        self._client = None
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """Создает клиента из переменных окружения YAGPT_TOKEN, FOLDER_ID и YAGPT_URL."""
+        kwargs.setdefault("url", os.getenv("YAGPT_URL", YANDEX_GPT_URL))
+        return cls(os.getenv("YAGPT_TOKEN"), os.getenv("FOLDER_ID"), **kwargs)
+
+    @property
+    def client(self):
+        # httpx.AsyncClient создается лениво внутри работающего event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self._client
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._semaphore
+
+    def build_payload(self, messages, temperature=None, max_tokens=None, stream=False):
+        """Формирует тело запроса к модели."""
+        return {
+            "modelUri": self.model_uri,
+            "completionOptions": {
+                "stream": stream,
+                "temperature": self.temperature if temperature is None else temperature,
+                "maxTokens": self.max_tokens if max_tokens is None else max_tokens,
+            },
+            "messages": messages,
+        }
+
+    def _retry_delay(self, attempt, response=None):
+        """Экспоненциальная задержка с полным джиттером (учитывает Retry-After)."""
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _retry_delay_or_raise(self, attempt, response=None, error=None):
+        """Возвращает задержку перед повтором или выбрасывает YandexGPTError."""
+        last_attempt = attempt == self.max_retries
+        if error is not None:
+            if last_attempt:
+                raise YandexGPTError(f"Сетевая ошибка: {error!r}") from error
+            delay = self._retry_delay(attempt)
+            logger.warning(f"YandexGPT transport error {error!r}, retry in {delay:.2f}s")
+            return delay
+        if response.status_code not in RETRY_STATUSES or last_attempt:
+            raise YandexGPTError(
+                f"{response.status_code}, {response.text}", status_code=response.status_code
+            )
+        delay = self._retry_delay(attempt, response)
+        logger.warning(f"YandexGPT status {response.status_code}, retry in {delay:.2f}s")
+        return delay
+
+    async def _post(self, payload):
+        """Отправляет запрос с повторами при 429/5xx и сетевых ошибках."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    response = await self.client.post(self.url, headers=self.headers, json=payload)
+            except httpx.TransportError as e:
+                delay = self._retry_delay_or_raise(attempt, error=e)
+            else:
+                if response.status_code == 200:
+                    return response
+                delay = self._retry_delay_or_raise(attempt, response=response)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _parse_text(data):
+        try:
+            return data["result"]["alternatives"][0]["message"]["text"]
+        except (KeyError, IndexError, TypeError) as e:
+            raise YandexGPTError(f"Некорректный ответ: {data}") from e
+
+    async def complete(self, messages, temperature=None, max_tokens=None):
+        """Возвращает текст ответа модели на список сообщений."""
+        payload = self.build_payload(messages, temperature, max_tokens)
+        response = await self._post(payload)
+        try:
+            data = response.json()
+        except ValueError as e:
+            raise YandexGPTError(f"Некорректный ответ: {response.text}") from e
+        return self._parse_text(data)
+
+    async def stream_complete(self, messages, temperature=None, max_tokens=None):
+        """Отдает накопленный текст ответа по мере генерации (режим stream).
+
+        Повтор выполняется только до получения первого фрагмента, чтобы
+        пользователь не увидел ответ дважды.
+        """
+        payload = self.build_payload(messages, temperature, max_tokens, stream=True)
+        for attempt in range(self.max_retries + 1):
+            started = False
+            try:
+                async with self.semaphore:
+                    async with self.client.stream(
+                        "POST", self.url, headers=self.headers, json=payload
+                    ) as response:
+                        if response.status_code == 200:
+                            # Каждая строка - JSON с накопленным текстом ответа
+                            async for line in response.aiter_lines():
+                                if not line.strip():
+                                    continue
+                                try:
+                                    data = json.loads(line)
+                                except ValueError as e:
+                                    raise YandexGPTError(f"Некорректный фрагмент: {line}") from e
+                                started = True
+                                yield self._parse_text(data)
+                            return
+                        await response.aread()
+            except httpx.TransportError as e:
+                if started:
+                    raise YandexGPTError(f"Поток прерван: {e!r}") from e
+                delay = self._retry_delay_or_raise(attempt, error=e)
+            else:
+                delay = self._retry_delay_or_raise(attempt, response=response)
+            await asyncio.sleep(delay)
+
+    async def aclose(self):
+        """Закрывает пул соединений."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+# Общий клиент на процесс: все конвейеры используют один пул соединений
+_client = None
+
+def get_gpt_client() -> YandexGPTClient:
+    """Возвращает общий клиент YandexGPT (настройки из окружения), создавая его при первом обращении."""
+    global _client
+    if _client is None:
+        _client = YandexGPTClient.from_env()
+    return _client